@@ -14,44 +14,87 @@ Original file is located at
 # INSTALACIÓN DE DEPENDENCIAS
 # =============================================================================
 
-# Instalar todas las dependencias necesarias
-!pip install llama-index llama-index-embeddings-huggingface
-!pip install sqlalchemy pandas numpy matplotlib seaborn
-!pip install sentence-transformers transformers torch
-!pip install pytest pytest-cov python-dotenv
-!pip install gradio
+# Instalar todas las dependencias necesarias (en Colab, descomentar estas
+# líneas; fuera de Colab, ejecutar los mismos comandos sin "!" en la terminal)
+# !pip install llama-index llama-index-embeddings-huggingface
+# !pip install sqlalchemy pandas numpy matplotlib seaborn
+# !pip install sentence-transformers transformers torch
+# !pip install pytest pytest-cov python-dotenv
+# !pip install gradio
 
 # =============================================================================
 # IMPORTACIONES Y CONFIGURACIÓN
 # =============================================================================
 
+import time
+_IMPORT_START = time.perf_counter()
+
 import os
+import sys
 import sqlite3
-import pandas as pd
 import numpy as np
-from datetime import datetime
-from typing import List, Dict, Optional, Any
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Optional, Any, Iterable, Callable, Union
+from itertools import islice
+from collections import OrderedDict, deque
+from collections.abc import Mapping, MutableMapping
+from multiprocessing import shared_memory
 import json
+import hashlib
+import uuid
+import math
+import heapq
+import threading
+import queue
+import atexit
+import tempfile
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import fnmatch
+import unicodedata
+import re
 import logging
 from pathlib import Path
-
-# LlamaIndex imports
-from llama_index.core import VectorStoreIndex, Document, Settings
-from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core.storage.storage_context import StorageContext
-from llama_index.core.vector_stores import SimpleVectorStore
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from contextlib import contextmanager
 
 # SQLAlchemy imports
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Float
+from sqlalchemy import create_engine, event, insert, inspect, select, text, table, column, literal_column, tuple_, update, bindparam
+from sqlalchemy import Column, Index, Integer, String, Text, DateTime, Float, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import func
+from urllib.parse import quote
+
+# LlamaIndex (y con él torch) se importa bajo demanda en _load_llama_index()
+# para que los procesos que solo consultan analíticas arranquen rápido
+VectorStoreIndex = Document = Settings = None
+SentenceSplitter = StorageContext = SimpleVectorStore = SimpleDocumentStore = None
+TextNode = NodeRelationship = BaseNode = MetadataMode = None
+BasePydanticVectorStore = VectorStoreQuery = VectorStoreQueryResult = PrivateAttr = None
+NumpyVectorStore = LazyHuggingFaceEmbedding = None
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Desglose de tiempos de arranque (segundos por etapa)
+STARTUP_TIMINGS: Dict[str, float] = {"imports": time.perf_counter() - _IMPORT_START}
+
+@contextmanager
+def _startup_stage(name: str):
+    """Medir una etapa de arranque y acumularla en STARTUP_TIMINGS"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[name] = STARTUP_TIMINGS.get(name, 0.0) + time.perf_counter() - start
+
+def get_startup_timings() -> Dict[str, float]:
+    """Tiempos de arranque por etapa, en milisegundos"""
+    return {stage: round(seconds * 1000, 1) for stage, seconds in STARTUP_TIMINGS.items()}
+
 # =============================================================================
 # CONFIGURACIÓN DE API Y MODELOS
 # =============================================================================
@@ -62,12 +105,176 @@ os.environ["HUGGINGFACE_API_KEY"] = HF_API_KEY
 
 # Configuración de modelos
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_BATCH_SIZE = 64
+
+# Entradas máximas de la caché de metadatos usada por search()
+METADATA_CACHE_SIZE = 10000
+
+# Caché de embeddings de consultas: entradas en memoria, filas máximas en SQLite
+# y escrituras entre dos podas de la tabla persistente
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_PERSISTENT_SIZE = 100000
+QUERY_CACHE_PRUNE_INTERVAL = 100
+
+# Caché semántica de resultados: entradas y similitud coseno mínima entre consultas
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_THRESHOLD = 0.95
+
+# Celdas máximas de la matriz de scores consulta x nodo calculada de una vez
+SCORE_BLOCK_CELLS = 2 ** 24
+
+# Búsqueda híbrida: modos de search(), constante k de Reciprocal Rank Fusion y
+# candidatos que aporta cada recuperador por resultado final
+SEARCH_MODES = ("vector", "hybrid", "lexical")
+RRF_K = 60
+HYBRID_CANDIDATES_FACTOR = 4
+
+# Paginación: páginas de top_k resultados que se puntúan en la primera
+# búsqueda y cursores (rankings pendientes) que se conservan como máximo
+SEARCH_PAGE_DEPTH = 5
+SEARCH_CURSOR_LIMIT = 256
+
+_LLAMA_INDEX_LOADED = False
+_LLAMA_INDEX_LOCK = threading.Lock()
+
+def _load_llama_index():
+    """Importar LlamaIndex y configurar el modelo de embeddings (solo la primera vez)
+
+    El modelo de Hugging Face no se carga aquí: Settings.embed_model es un
+    LazyHuggingFaceEmbedding que lo instancia en la primera llamada de
+    embedding (o en SemanticSearchSystem.warmup()).
+    """
+    global _LLAMA_INDEX_LOADED, VectorStoreIndex, Document, Settings
+    global SentenceSplitter, StorageContext, SimpleVectorStore, SimpleDocumentStore
+    global TextNode, NodeRelationship, BaseNode, MetadataMode
+    global BasePydanticVectorStore, VectorStoreQuery, VectorStoreQueryResult, PrivateAttr
+    global NumpyVectorStore, LazyHuggingFaceEmbedding
+
+    if _LLAMA_INDEX_LOADED:
+        return
+
+    with _LLAMA_INDEX_LOCK:
+        if _LLAMA_INDEX_LOADED:
+            return
+
+        with _startup_stage("llama_index"):
+            # LlamaIndex imports
+            from llama_index.core import VectorStoreIndex, Document, Settings
+            from llama_index.core.node_parser import SentenceSplitter
+            from llama_index.core.schema import TextNode, NodeRelationship, BaseNode, MetadataMode
+            from llama_index.core.storage.storage_context import StorageContext
+            from llama_index.core.storage.docstore import SimpleDocumentStore
+            from llama_index.core.vector_stores import SimpleVectorStore
+            from llama_index.core.vector_stores.types import (
+                BasePydanticVectorStore, VectorStoreQuery, VectorStoreQueryResult
+            )
+            from llama_index.core.bridge.pydantic import PrivateAttr
+
+            NumpyVectorStore = _define_numpy_vector_store()
+            LazyHuggingFaceEmbedding = _define_lazy_embedding()
+
+            # Configurar LlamaIndex - Solo embedding model
+            Settings.embed_model = LazyHuggingFaceEmbedding(
+                model_name=EMBEDDING_MODEL,
+                embed_batch_size=EMBED_BATCH_SIZE,
+                trust_remote_code=True
+            )
+
+        _LLAMA_INDEX_LOADED = True
+
+def _define_lazy_embedding():
+    """Definir el embedding diferido (requiere LlamaIndex ya importado)"""
+    from llama_index.core.base.embeddings.base import BaseEmbedding
+
+    class LazyHuggingFaceEmbedding(BaseEmbedding):
+        """HuggingFaceEmbedding que carga torch y el modelo en la primera llamada"""
+
+        _model: Any = PrivateAttr(default=None)
+        _model_kwargs: Dict = PrivateAttr(default_factory=dict)
+        _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+        def __init__(self, model_name: str, embed_batch_size: int = EMBED_BATCH_SIZE, **model_kwargs: Any):
+            super().__init__(model_name=model_name, embed_batch_size=embed_batch_size)
+            self._model_kwargs = model_kwargs
+
+        @property
+        def is_loaded(self) -> bool:
+            return self._model is not None
+
+        def load(self):
+            """Instanciar el modelo de Hugging Face si aún no existe"""
+            if self._model is None:
+                with self._lock:
+                    if self._model is None:
+                        with _startup_stage("embedding_model"):
+                            from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+                            self._model = HuggingFaceEmbedding(
+                                model_name=self.model_name,
+                                embed_batch_size=self.embed_batch_size,
+                                **self._model_kwargs
+                            )
+                        logger.info(f"Modelo de embeddings cargado: {self.model_name}")
+            return self._model
+
+        def _get_query_embedding(self, query: str) -> List[float]:
+            return self.load()._get_query_embedding(query)
 
-# Configurar LlamaIndex - Solo embedding model
-Settings.embed_model = HuggingFaceEmbedding(
-    model_name=EMBEDDING_MODEL,
-    trust_remote_code=True
-)
+        async def _aget_query_embedding(self, query: str) -> List[float]:
+            return await self.load()._aget_query_embedding(query)
+
+        def _get_text_embedding(self, text: str) -> List[float]:
+            return self.load()._get_text_embedding(text)
+
+        def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+            return self.load()._get_text_embeddings(texts)
+
+        def get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+            """Embeddings de varias consultas en un solo lote del modelo
+
+            Usa el prompt "query" de HuggingFaceEmbedding (la instrucción de
+            consulta del modelo, si la tiene), igual que _get_query_embedding;
+            las versiones sin ``prompt_name`` se embeben una a una.
+            """
+            model = self.load()
+            try:
+                return model._embed(list(queries), prompt_name="query")
+            except (AttributeError, TypeError):
+                return [model._get_query_embedding(query) for query in queries]
+
+    return LazyHuggingFaceEmbedding
+
+# Modelos de embeddings distintos del configurado, creados bajo demanda (migraciones)
+_EMBED_MODELS: Dict[str, Any] = {}
+
+def _query_embedding_batch(embed_model, queries: List[str]) -> List[List[float]]:
+    """Embeddings de consulta de ``queries`` con una llamada al modelo si la admite
+
+    Los modelos de este módulo exponen get_query_embeddings(); el resto se
+    embeben consulta a consulta con get_query_embedding().
+    """
+    batch = getattr(embed_model, "get_query_embeddings", None)
+    if batch is not None:
+        return batch(queries)
+    return [embed_model.get_query_embedding(query) for query in queries]
+
+def get_embed_model(model_name: str = EMBEDDING_MODEL):
+    """Modelo de embeddings diferido para ``model_name``
+
+    EMBEDDING_MODEL corresponde a Settings.embed_model (también cuando se ha
+    sustituido, p. ej. por use_hashing_embedding()); el resto se instancian
+    una vez y se reutilizan.
+    """
+    _load_llama_index()
+    if model_name in (EMBEDDING_MODEL, Settings.embed_model.model_name):
+        return Settings.embed_model
+    with _LLAMA_INDEX_LOCK:
+        if model_name not in _EMBED_MODELS:
+            _EMBED_MODELS[model_name] = LazyHuggingFaceEmbedding(
+                model_name=model_name,
+                embed_batch_size=EMBED_BATCH_SIZE,
+                trust_remote_code=True
+            )
+        return _EMBED_MODELS[model_name]
 
 # =============================================================================
 # MODELOS DE BASE DE DATOS
@@ -75,239 +282,4660 @@ Settings.embed_model = HuggingFaceEmbedding(
 
 Base = declarative_base()
 
-class DocumentMetadata(Base):
-    """Modelo para almacenar metadatos de documentos"""
-    __tablename__ = "document_metadata"
+class DocumentMetadata(Base):
+    """Modelo para almacenar metadatos de documentos"""
+    __tablename__ = "document_metadata"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    doc_id = Column(String(255), unique=True, nullable=False)
+    title = Column(String(500), nullable=False)
+    content = Column(Text, nullable=False)
+    file_path = Column(String(1000))
+    file_type = Column(String(50))
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    word_count = Column(Integer)
+    embedding_model = Column(String(100))
+    content_hash = Column(String(64))  # SHA-256 del contenido, para deduplicar
+
+    # Índices para resolver en SQL los filtros de search() y la deduplicación
+    __table_args__ = (
+        Index("ix_document_metadata_file_type", "file_type"),
+        Index("ix_document_metadata_created_at", "created_at"),
+        Index("ix_document_metadata_file_path", "file_path"),
+        Index("ix_document_metadata_content_hash", "content_hash"),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'doc_id': self.doc_id,
+            'title': self.title,
+            'content': self.content[:200] + '...' if len(self.content) > 200 else self.content,
+            'file_path': self.file_path,
+            'file_type': self.file_type,
+            'created_at': self.created_at,
+            'word_count': self.word_count
+        }
+
+class SearchQuery(Base):
+    """Modelo para almacenar consultas de búsqueda"""
+    __tablename__ = "search_queries"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    query_text = Column(Text, nullable=False)
+    timestamp = Column(DateTime, default=func.now())
+    results_count = Column(Integer)
+    avg_similarity = Column(Float)
+    execution_time = Column(Float)
+
+    # Tiempos por etapa (opcionales, ver store_stage_timings)
+    filter_time = Column(Float)
+    embed_time = Column(Float)
+    retrieval_time = Column(Float)
+    lexical_time = Column(Float)
+    metadata_time = Column(Float)
+
+    # "Consultas recientes" ordena por timestamp
+    __table_args__ = (Index("ix_search_queries_timestamp", "timestamp"),)
+
+class SearchRollup(Base):
+    """Agregados de búsquedas por minuto, hora y total, mantenidos al registrar"""
+    __tablename__ = "search_rollups"
+
+    granularity = Column(String(10), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    searches = Column(Integer, nullable=False, default=0)
+    total_execution_time = Column(Float, nullable=False, default=0.0)
+    max_execution_time = Column(Float, nullable=False, default=0.0)
+    total_results = Column(Integer, nullable=False, default=0)
+    total_similarity = Column(Float, nullable=False, default=0.0)
+    latency_sketch = Column(Text)  # JSON de LatencySketch
+    stage_totals = Column(Text)  # JSON {etapa: [suma, número]}
+
+class QueryCount(Base):
+    """Número de veces que se ha buscado cada consulta normalizada"""
+    __tablename__ = "query_counts"
+
+    query_text = Column(Text, primary_key=True)
+    count = Column(Integer, nullable=False, default=0, index=True)
+    last_seen = Column(DateTime)
+
+class DocumentStats(Base):
+    """Documentos y palabras por tipo de archivo, mantenidos por triggers"""
+    __tablename__ = "document_stats"
+
+    file_type = Column(String(50), primary_key=True)  # '' para documentos sin tipo
+    documents = Column(Integer, nullable=False, default=0)
+    words = Column(Integer, nullable=False, default=0)
+
+# Etapa de búsqueda -> columna de SearchQuery donde se guarda su duración
+STAGE_COLUMNS = {
+    "filter": "filter_time",
+    "embed": "embed_time",
+    "retrieve": "retrieval_time",
+    "lexical": "lexical_time",
+    "metadata": "metadata_time"
+}
+
+class EmbeddingMigrationRun(Base):
+    """Modelo para migraciones de modelo de embeddings (una fila por migración)"""
+    __tablename__ = "embedding_migrations"
+
+    id = Column(Integer, primary_key=True)
+    model_name = Column(String(100), nullable=False)
+    previous_model = Column(String(100))
+    status = Column(String(20), nullable=False, index=True)
+    total_documents = Column(Integer, default=0)
+    embedded_documents = Column(Integer, default=0)
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    completed_at = Column(DateTime)
+    error = Column(Text)
+
+class EmbeddingMigrationDocument(Base):
+    """Modelo para el progreso por documento de una migración"""
+    __tablename__ = "embedding_migration_documents"
+
+    migration_id = Column(Integer, primary_key=True)
+    doc_id = Column(String(100), primary_key=True)
+    node_count = Column(Integer, nullable=False)
+    embedded_at = Column(DateTime, nullable=False)
+
+class ChunkEmbeddingCacheEntry(Base):
+    """Modelo para reutilizar embeddings de fragmentos por hash de contenido"""
+    __tablename__ = "chunk_embedding_cache"
+
+    chunk_hash = Column(String(64), primary_key=True)
+    model_name = Column(String(100), primary_key=True)
+    embedding = Column(LargeBinary, nullable=False)
+    created_at = Column(Float, nullable=False)
+
+class QueryEmbeddingCacheEntry(Base):
+    """Modelo para persistir embeddings de consultas frecuentes"""
+    __tablename__ = "query_embedding_cache"
+
+    cache_key = Column(String(64), primary_key=True)
+    model_name = Column(String(100), nullable=False)
+    query_text = Column(Text, nullable=False)
+    embedding = Column(LargeBinary, nullable=False)
+    created_at = Column(Float, nullable=False)
+
+    __table_args__ = (Index("ix_query_embedding_cache_created_at", "created_at"),)
+
+# Índice FTS5 de contenido externo sobre document_metadata, mantenido por triggers
+# para que cualquier ruta de ingesta (ORM, inserción masiva, borrados) lo actualice
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS document_fts USING fts5(
+        title, content,
+        content='document_metadata', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS document_fts_ai AFTER INSERT ON document_metadata BEGIN
+        INSERT INTO document_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS document_fts_ad AFTER DELETE ON document_metadata BEGIN
+        INSERT INTO document_fts(document_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    # Solo cambios de texto: actualizar embedding_model (migraciones) no reindexa FTS
+    "DROP TRIGGER IF EXISTS document_fts_au",
+    """CREATE TRIGGER IF NOT EXISTS document_fts_au_text AFTER UPDATE OF title, content ON document_metadata BEGIN
+        INSERT INTO document_fts(document_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO document_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END"""
+]
+
+# Estadísticas de documentos por tipo mantenidas por triggers, como el FTS
+DOCUMENT_STATS_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS document_stats_ai AFTER INSERT ON document_metadata BEGIN
+        INSERT OR IGNORE INTO document_stats(file_type, documents, words)
+        VALUES (COALESCE(new.file_type, ''), 0, 0);
+        UPDATE document_stats SET documents = documents + 1, words = words + COALESCE(new.word_count, 0)
+        WHERE file_type = COALESCE(new.file_type, '');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS document_stats_ad AFTER DELETE ON document_metadata BEGIN
+        UPDATE document_stats SET documents = documents - 1, words = words - COALESCE(old.word_count, 0)
+        WHERE file_type = COALESCE(old.file_type, '');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS document_stats_au AFTER UPDATE OF file_type, word_count ON document_metadata BEGIN
+        UPDATE document_stats SET documents = documents - 1, words = words - COALESCE(old.word_count, 0)
+        WHERE file_type = COALESCE(old.file_type, '');
+        INSERT OR IGNORE INTO document_stats(file_type, documents, words)
+        VALUES (COALESCE(new.file_type, ''), 0, 0);
+        UPDATE document_stats SET documents = documents + 1, words = words + COALESCE(new.word_count, 0)
+        WHERE file_type = COALESCE(new.file_type, '');
+    END"""
+]
+
+# =============================================================================
+# CONFIGURACIÓN DE SQLITE
+# =============================================================================
+
+# Pragmas comunes a todas las conexiones
+SQLITE_PRAGMAS = {
+    "busy_timeout": 30000,        # ms de espera ante un bloqueo antes de fallar
+    "cache_size": -64000,         # 64 MB de caché de páginas por conexión
+    "mmap_size": 268435456,       # 256 MB leídos mediante memory-mapping
+    "temp_store": "MEMORY"
+}
+# Pragmas de la conexión de escritura
+SQLITE_WRITER_PRAGMAS = {
+    "journal_mode": "WAL",        # los lectores no bloquean al escritor ni al revés
+    "synchronous": "NORMAL"       # seguro con WAL y mucho más barato que FULL
+}
+READ_POOL_SIZE = 8
+
+def _apply_pragmas(engine, pragmas: Dict[str, Any]):
+    """Ejecutar los pragmas en cada conexión nueva del engine"""
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+def create_sqlite_engines(db_path: str, read_pool_size: int = READ_POOL_SIZE) -> tuple:
+    """Crear el engine de escritura y el de lectura para una base SQLite
+
+    El de escritura tiene una única conexión (pool de tamaño 1), de modo que
+    las escrituras de todos los hilos se serializan esperando turno en el
+    pool en lugar de fallar con "database is locked". El de lectura abre la
+    base en modo solo lectura con un pool de ``read_pool_size`` conexiones;
+    gracias a WAL las lecturas ven lo último confirmado y nunca esperan al
+    escritor. Las bases en memoria (":memory:") son una base con nombre
+    propio en caché compartida, con el mismo reparto escritor/lectores y
+    sin compartir una conexión entre hilos; como la caché compartida
+    bloquea por tabla, los lectores usan read_uncommitted para no chocar
+    con una escritura en curso.
+    """
+    connect_args = {"check_same_thread": False, "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000}
+    if db_path in ("", ":memory:"):
+        url = f"sqlite:///file:memoria-{uuid.uuid4().hex}?mode=memory&cache=shared&uri=true"
+        write_engine = create_engine(
+            url, connect_args=connect_args, poolclass=QueuePool,
+            pool_size=1, max_overflow=0, pool_timeout=SQLITE_PRAGMAS["busy_timeout"] / 1000
+        )
+        _apply_pragmas(write_engine, SQLITE_PRAGMAS)
+        read_engine = create_engine(url, connect_args=connect_args, poolclass=QueuePool,
+                                    pool_size=read_pool_size, max_overflow=read_pool_size)
+        _apply_pragmas(read_engine, {**SQLITE_PRAGMAS, "query_only": "ON", "read_uncommitted": "ON"})
+        return write_engine, read_engine
+
+    write_engine = create_engine(
+        f"sqlite:///{db_path}", connect_args=connect_args,
+        pool_size=1, max_overflow=0, pool_timeout=SQLITE_PRAGMAS["busy_timeout"] / 1000
+    )
+    _apply_pragmas(write_engine, {**SQLITE_PRAGMAS, **SQLITE_WRITER_PRAGMAS})
+
+    # Crear el fichero (y activar WAL) antes de abrirlo en modo solo lectura
+    with write_engine.connect():
+        pass
+
+    read_engine = create_engine(
+        f"sqlite:///file:{quote(os.path.abspath(db_path))}?mode=ro&uri=true",
+        connect_args=connect_args, pool_size=read_pool_size, max_overflow=read_pool_size
+    )
+    _apply_pragmas(read_engine, {**SQLITE_PRAGMAS, "query_only": "ON"})
+    return write_engine, read_engine
+
+# =============================================================================
+# CACHÉ DE EMBEDDINGS DE CONSULTAS
+# =============================================================================
+
+class QueryEmbeddingCache:
+    """Caché LRU/TTL de embeddings de consultas
+
+    Las claves combinan el nombre del modelo y el texto normalizado de la
+    consulta (NFC, minúsculas y espacios colapsados). Si se indica
+    ``session_factory`` las entradas también se guardan en SQLite y sobreviven
+    a reinicios del proceso: put() escribe con ``session_factory`` (el
+    escritor) y get() lee con ``read_session_factory`` (el pool de solo
+    lectura; por defecto, la misma factoría). Cada ``prune_interval``
+    escrituras (y en la primera) put() borra de la tabla las filas caducadas
+    según ``ttl`` y las más antiguas por encima de ``max_persistent_size``.
+    """
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE, ttl: Optional[float] = None,
+                 session_factory: Callable[[], Session] = None,
+                 read_session_factory: Callable[[], Session] = None,
+                 max_persistent_size: Optional[int] = QUERY_CACHE_PERSISTENT_SIZE,
+                 prune_interval: int = QUERY_CACHE_PRUNE_INTERVAL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.session_factory = session_factory
+        self.read_session_factory = read_session_factory or session_factory
+        self.max_persistent_size = max_persistent_size
+        self.prune_interval = max(1, prune_interval)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.persistent_hits = 0
+        self.persistent_pruned = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Normalizar el texto de una consulta para usarlo como clave"""
+        return " ".join(unicodedata.normalize("NFC", query).lower().split())
+
+    def _key(self, query: str, model_name: str) -> str:
+        return hashlib.sha1(f"{model_name}\x1f{self.normalize(query)}".encode("utf-8")).hexdigest()
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def get(self, query: str, model_name: str) -> Optional[List[float]]:
+        """Obtener el embedding guardado de una consulta, si existe y no ha caducado"""
+        key = self._key(query, model_name)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[1]):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0].tolist()
+                del self._entries[key]
+
+        if self.read_session_factory is not None:
+            with self.read_session_factory() as session:
+                stored = session.get(QueryEmbeddingCacheEntry, key)
+                if stored is not None and not self._expired(stored.created_at):
+                    embedding = np.frombuffer(stored.embedding, dtype=np.float32)
+                    with self._lock:
+                        self._store(key, embedding, stored.created_at)
+                        self.hits += 1
+                        self.persistent_hits += 1
+                    return embedding.tolist()
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, query: str, model_name: str, embedding: List[float]):
+        """Guardar el embedding de una consulta"""
+        key = self._key(query, model_name)
+        vector = np.asarray(embedding, dtype=np.float32)
+        created_at = time.time()
+
+        with self._lock:
+            self._store(key, vector, created_at)
+
+        if self.session_factory is not None:
+            with self._lock:
+                prune = self._writes % self.prune_interval == 0
+                self._writes += 1
+            with self.session_factory() as session:
+                session.merge(QueryEmbeddingCacheEntry(
+                    cache_key=key,
+                    model_name=model_name,
+                    query_text=self.normalize(query),
+                    embedding=vector.tobytes(),
+                    created_at=created_at
+                ))
+                if prune:
+                    self._prune(session)
+                session.commit()
+
+    def _prune(self, session: Session):
+        """Borrar de SQLite las filas caducadas y las más antiguas que sobran"""
+        pruned = 0
+        if self.ttl is not None:
+            pruned += session.query(QueryEmbeddingCacheEntry).filter(
+                QueryEmbeddingCacheEntry.created_at < time.time() - self.ttl
+            ).delete(synchronize_session=False)
+        if self.max_persistent_size is not None:
+            pruned += session.execute(text(
+                f"DELETE FROM {QueryEmbeddingCacheEntry.__tablename__} WHERE cache_key IN ("
+                f"SELECT cache_key FROM {QueryEmbeddingCacheEntry.__tablename__} "
+                f"ORDER BY created_at DESC LIMIT -1 OFFSET :keep)"
+            ), {"keep": self.max_persistent_size}).rowcount
+        with self._lock:
+            self.persistent_pruned += pruned
+
+    def _store(self, key: str, vector: np.ndarray, created_at: float):
+        self._entries[key] = (vector, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Vaciar la caché en memoria y reiniciar los contadores"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.persistent_hits = self.persistent_pruned = 0
+
+    def stats(self) -> Dict:
+        """Contadores de aciertos, fallos y expulsiones de la caché"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'persistent_hits': self.persistent_hits,
+                'persistent_pruned': self.persistent_pruned,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+def _estimate_bytes(value: Any) -> int:
+    """Tamaño aproximado en memoria de resultados (SearchResult, dicts, listas y escalares)
+
+    Un SearchResult cuenta sus IDs y, si ya se cargaron, sus campos.
+    """
+    if isinstance(value, SearchResult):
+        return (sys.getsizeof(value) + sys.getsizeof(value.doc_id) + sys.getsizeof(value.node_id) +
+                _estimate_bytes(value._fields))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_estimate_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_estimate_bytes(item) for item in value)
+    return sys.getsizeof(value)
+
+class SemanticResultCache:
+    """Caché de resultados de search() por proximidad de la consulta
+
+    Guarda, por entrada, el embedding normalizado de la consulta, la clave
+    de la búsqueda (modo, top_k y filtros), la versión de los datos con la
+    que se calculó y los resultados. Una consulta nueva reutiliza los
+    resultados de la entrada más parecida con la misma clave y versión si su
+    similitud coseno llega a ``threshold``, así que las paráfrasis cercanas
+    no repiten recuperación ni SQL. Cualquier escritura cambia la versión y
+    las entradas anteriores dejan de servirse (y se liberan). Expulsión LRU
+    con ``max_entries`` entradas. Los SearchResult guardados cargan sus
+    campos más tarde; _ResultLoader avisa con reaccount() para que
+    memory_bytes() los incluya.
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_SIZE, threshold: float = RESULT_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None
+        self._key_ids = np.full(max_entries, -1, dtype=np.int64)
+        self._last_used = np.zeros(max_entries, dtype=np.int64)
+        self._entries: List[Optional[tuple]] = [None] * max_entries
+        # Clave de búsqueda -> id; se retira al expulsar su última entrada
+        self._key_index: Dict[tuple, int] = {}
+        self._next_key_id = 0
+        # id() de cada SearchResult guardado -> slot de su entrada
+        self._result_slots: Dict[int, int] = {}
+        self._version = None
+        self._clock = 0
+        self._results_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _sync_version(self, version: Any):
+        """Descartar todas las entradas si los datos han cambiado"""
+        if version != self._version:
+            self.invalidations += sum(entry is not None for entry in self._entries)
+            self._key_ids[:] = -1
+            self._entries = [None] * self.max_entries
+            self._key_index.clear()
+            self._result_slots.clear()
+            self._results_bytes = 0
+            self._version = version
+
+    def get(self, vector: np.ndarray, key: tuple, version: Any) -> Optional[List["SearchResult"]]:
+        """Resultados de la consulta guardada más parecida, o None"""
+        with self._lock:
+            self._sync_version(version)
+            key_id = self._key_index.get(key)
+            if key_id is not None and self._vectors is not None and self._vectors.shape[1] == len(vector):
+                slots = np.flatnonzero(self._key_ids == key_id)
+                if len(slots):
+                    scores = self._vectors[slots] @ vector
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.threshold:
+                        slot = slots[best]
+                        entry_version, results, _, _ = self._entries[slot]
+                        if entry_version == version:
+                            self._clock += 1
+                            self._last_used[slot] = self._clock
+                            self.hits += 1
+                            return list(results)
+            self.misses += 1
+            return None
+
+    def put(self, vector: np.ndarray, key: tuple, version: Any, results: List["SearchResult"]):
+        """Guardar resultados calculados con la versión ``version`` de los datos"""
+        with self._lock:
+            # Resultados calculados antes de la última escritura: no se guardan
+            if version != self._version:
+                return
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+                self._key_ids[:] = -1
+                self._entries = [None] * self.max_entries
+                self._key_index.clear()
+                self._result_slots.clear()
+                self._results_bytes = 0
+
+            free = np.flatnonzero(self._key_ids < 0)
+            if len(free):
+                slot = int(free[0])
+            else:
+                slot = int(np.argmin(self._last_used))
+                _, evicted, evicted_size, evicted_key = self._entries[slot]
+                for result in evicted:
+                    self._result_slots.pop(id(result), None)
+                self._results_bytes -= evicted_size
+                self.evictions += 1
+                evicted_key_id = self._key_ids[slot]
+                self._key_ids[slot] = -1
+                if not np.any(self._key_ids == evicted_key_id):
+                    del self._key_index[evicted_key]
+
+            size = _estimate_bytes(results)
+            key_id = self._key_index.get(key)
+            if key_id is None:
+                key_id = self._key_index[key] = self._next_key_id
+                self._next_key_id += 1
+            self._vectors[slot] = vector
+            self._key_ids[slot] = key_id
+            self._entries[slot] = (version, list(results), size, key)
+            self._result_slots.update((id(result), slot) for result in results)
+            self._results_bytes += size
+            self._clock += 1
+            self._last_used[slot] = self._clock
+
+    def reaccount(self, results: Iterable["SearchResult"]):
+        """Recalcular el tamaño de las entradas que contienen ``results``
+
+        Lo llama _ResultLoader al cargar los campos de una página.
+        """
+        with self._lock:
+            slots = {self._result_slots.get(id(result)) for result in results}
+            slots.discard(None)
+            for slot in slots:
+                entry_version, entry_results, size, key = self._entries[slot]
+                new_size = _estimate_bytes(entry_results)
+                self._entries[slot] = (entry_version, entry_results, new_size, key)
+                self._results_bytes += new_size - size
+
+    def clear(self):
+        """Vaciar la caché y reiniciar los contadores"""
+        with self._lock:
+            self._sync_version(object())
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def memory_bytes(self) -> int:
+        """Memoria aproximada: matriz de embeddings más resultados guardados"""
+        vectors = self._vectors.nbytes if self._vectors is not None else 0
+        return vectors + self._key_ids.nbytes + self._last_used.nbytes + self._results_bytes
+
+    def stats(self) -> Dict:
+        """Aciertos, fallos, invalidaciones y memoria de la caché"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': int(np.count_nonzero(self._key_ids >= 0)),
+                'keys': len(self._key_index),
+                'max_entries': self.max_entries,
+                'threshold': self.threshold,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'memory_bytes': self.memory_bytes(),
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+def content_hash(text: str) -> str:
+    """Hash SHA-256 (hex) de un texto, usado para documentos y fragmentos"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ChunkEmbeddingCache:
+    """Caché persistente en SQLite de embeddings de fragmentos
+
+    La clave es el hash del texto que se embebe (contenido y metadatos
+    incluidos en el embedding) junto con el nombre del modelo, así que un
+    fragmento idéntico nunca se vuelve a calcular, venga del documento que
+    venga. Las lecturas usan el pool de solo lectura y las escrituras van
+    en bloque al escritor.
+    """
+
+    def __init__(self, read_session_factory: Callable[[], Session],
+                 write_session_factory: Callable[[], Session], lookup_batch_size: int = 500):
+        self.read_session_factory = read_session_factory
+        self.write_session_factory = write_session_factory
+        self.lookup_batch_size = lookup_batch_size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    def get_many(self, hashes: List[str], model_name: str) -> Dict[str, List[float]]:
+        """Embeddings guardados para los hashes dados (solo los que existen)"""
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        with self.read_session_factory() as session:
+            for start in range(0, len(unique), self.lookup_batch_size):
+                rows = session.query(ChunkEmbeddingCacheEntry.chunk_hash, ChunkEmbeddingCacheEntry.embedding).filter(
+                    ChunkEmbeddingCacheEntry.model_name == model_name,
+                    ChunkEmbeddingCacheEntry.chunk_hash.in_(unique[start:start + self.lookup_batch_size])
+                )
+                for chunk_hash, embedding in rows:
+                    found[chunk_hash] = np.frombuffer(embedding, dtype=np.float32).tolist()
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(unique) - len(found)
+        return found
+
+    def put_many(self, embeddings: Dict[str, List[float]], model_name: str):
+        """Guardar embeddings nuevos en una sola transacción"""
+        if not embeddings:
+            return
+        created_at = time.time()
+        rows = [
+            {"chunk_hash": chunk_hash, "model_name": model_name,
+             "embedding": np.asarray(embedding, dtype=np.float32).tobytes(), "created_at": created_at}
+            for chunk_hash, embedding in embeddings.items()
+        ]
+        with self.write_session_factory() as session:
+            session.execute(insert(ChunkEmbeddingCacheEntry).prefix_with("OR IGNORE"), rows)
+            session.commit()
+        with self._lock:
+            self.stored += len(rows)
+
+    def clear(self):
+        """Borrar todas las entradas guardadas y reiniciar los contadores"""
+        with self.write_session_factory() as session:
+            session.query(ChunkEmbeddingCacheEntry).delete()
+            session.commit()
+        with self._lock:
+            self.hits = self.misses = self.stored = 0
+
+    def stats(self) -> Dict:
+        """Aciertos y fallos por fragmento desde el arranque"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stored': self.stored,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+# =============================================================================
+# MOTORES DE BÚSQUEDA VECTORIAL
+# =============================================================================
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Posiciones de los k mayores scores, ordenadas de mayor a menor"""
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+def _rows_top_k(scores: np.ndarray, k: int):
+    """Top-k por fila de una matriz de scores: (columnas, scores), de mayor a menor"""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((len(scores), 0))
+        return empty.astype(np.int64), empty.astype(scores.dtype)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+class FlatVectorEngine:
+    """Búsqueda exacta por fuerza bruta sobre una matriz float32 contigua
+
+    Los vectores se guardan normalizados, de modo que el producto escalar
+    equivale a la similitud coseno. Cada vector se identifica por su fila
+    (``key``); los borrados se marcan y se excluyen de los resultados.
+    """
+
+    exact = True
+    # False si el scoring se hace fuera de este proceso: el sistema no debe
+    # copiar la matriz para puntuar localmente (ver _score_queries)
+    in_process = True
+
+    def __init__(self):
+        self.dim = None
+        self.size = 0
+        self.num_deleted = 0
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._deleted = np.zeros(0, dtype=bool)
+
+    @property
+    def count(self) -> int:
+        """Número de vectores activos"""
+        return self.size - self.num_deleted
+
+    def active_keys(self) -> np.ndarray:
+        """Claves de los vectores no borrados"""
+        return np.flatnonzero(~self._deleted[:self.size])
+
+    def _append(self, vectors: np.ndarray) -> np.ndarray:
+        """Copiar vectores al final de la matriz, ampliando la capacidad si hace falta"""
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+
+        needed = self.size + len(vectors)
+        if needed > len(self._vectors):
+            capacity = max(needed, 2 * len(self._vectors), 1024)
+            grown = np.zeros((capacity, self.dim), dtype=np.float32)
+            grown[:self.size] = self._vectors[:self.size]
+            self._vectors = grown
+            self._deleted = np.concatenate([self._deleted, np.zeros(capacity - len(self._deleted), dtype=bool)])
+
+        keys = np.arange(self.size, needed)
+        self._vectors[keys] = vectors
+        self.size = needed
+        return keys
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        """Agregar vectores normalizados y devolver sus claves"""
+        return self._append(vectors)
+
+    def remove(self, keys: np.ndarray):
+        """Marcar vectores como borrados"""
+        keys = np.asarray(keys, dtype=np.int64)
+        self.num_deleted += int(np.count_nonzero(~self._deleted[keys]))
+        self._deleted[keys] = True
+
+    def get_vectors(self, keys: np.ndarray) -> np.ndarray:
+        """Vectores almacenados para las claves dadas"""
+        return self._vectors[np.asarray(keys, dtype=np.int64)]
+
+    def exact_search(self, query: np.ndarray, k: int, candidates: np.ndarray = None):
+        """Top-k exacto, opcionalmente restringido a un conjunto de claves"""
+        if candidates is None:
+            scores = self._vectors[:self.size] @ query
+            scores[self._deleted[:self.size]] = -np.inf
+            keys = np.arange(self.size)
+        else:
+            keys = np.asarray(candidates, dtype=np.int64)
+            keys = keys[~self._deleted[keys]]
+            scores = self._vectors[keys] @ query
+
+        top = _top_k(scores, min(k, self.count))
+        return keys[top], scores[top]
+
+    def search(self, query: np.ndarray, k: int, candidates: np.ndarray = None):
+        """Top-k de claves y scores para un vector de consulta normalizado"""
+        return self.exact_search(query, k, candidates)
+
+    def search_batch(self, queries: np.ndarray, k: int) -> List[tuple]:
+        """search() para una matriz de consultas: lista de (claves, scores)"""
+        return [self.search(query, k) for query in queries]
+
+    def memory_bytes(self) -> int:
+        """Memoria ocupada por los vectores y las marcas de borrado"""
+        return self._vectors.nbytes + self._deleted.nbytes
+
+    def bytes_per_vector(self) -> int:
+        """Bytes residentes por vector, sin contar la capacidad reservada"""
+        return self._vectors.itemsize * (self.dim or 0) + self._deleted.itemsize
+
+    def close(self):
+        """Liberar recursos externos del motor (ninguno en memoria pura)"""
+
+class HNSWVectorEngine(FlatVectorEngine):
+    """Grafo HNSW (Hierarchical Navigable Small World) en NumPy puro
+
+    ``m`` controla el grado del grafo, ``ef_construction`` la calidad de la
+    inserción y ``ef_search`` el compromiso recall/latencia de cada consulta.
+    La inserción es incremental; los nodos borrados siguen sirviendo de paso
+    en el grafo pero nunca se devuelven.
+    """
+
+    exact = False
+
+    def __init__(self, m: int = 16, ef_construction: int = 100, ef_search: int = 50, seed: int = 42):
+        super().__init__()
+        self.m = m
+        self.m0 = 2 * m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._level_mult = 1 / math.log(m)
+        self._rng = np.random.default_rng(seed)
+        self._layers: List[Dict[int, List[int]]] = []
+        self._entry_point = None
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        keys = self._append(vectors)
+        for key in keys:
+            self._insert(int(key))
+        return keys
+
+    def _insert(self, key: int):
+        vector = self._vectors[key]
+        level = int(-math.log(1.0 - self._rng.random()) * self._level_mult)
+
+        if self._entry_point is None:
+            self._layers = [{key: []} for _ in range(level + 1)]
+            self._entry_point = key
+            return
+
+        entry_points = [self._entry_point]
+        top_level = len(self._layers) - 1
+
+        # Descenso voraz por las capas superiores al nivel del nuevo nodo
+        for layer in range(top_level, level, -1):
+            entry_points = [self._search_layer(vector, entry_points, 1, layer)[0][1]]
+
+        for layer in range(min(level, top_level), -1, -1):
+            found = self._search_layer(vector, entry_points, self.ef_construction, layer)
+            max_degree = self.m0 if layer == 0 else self.m
+            neighbors = [neighbor for _, neighbor in found[:self.m]]
+            graph = self._layers[layer]
+            graph[key] = neighbors
+
+            for neighbor in neighbors:
+                links = graph[neighbor]
+                links.append(key)
+                if len(links) > max_degree:
+                    scores = self._vectors[links] @ self._vectors[neighbor]
+                    graph[neighbor] = [links[i] for i in _top_k(scores, max_degree)]
+
+            entry_points = [candidate for _, candidate in found]
+
+        if level > top_level:
+            self._layers.extend({key: []} for _ in range(level - top_level))
+            self._entry_point = key
+
+    def _search_layer(self, query: np.ndarray, entry_points: List[int], ef: int, layer: int):
+        """Búsqueda en anchura limitada por ``ef`` dentro de una capa"""
+        graph = self._layers[layer]
+        visited = set(entry_points)
+        entry_scores = self._vectors[entry_points] @ query
+
+        candidates = [(-score, key) for score, key in zip(entry_scores.tolist(), entry_points)]
+        heapq.heapify(candidates)
+        results = [(score, key) for score, key in zip(entry_scores.tolist(), entry_points)]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            neg_score, current = heapq.heappop(candidates)
+            if len(results) >= ef and -neg_score < results[0][0]:
+                break
+
+            neighbors = [n for n in graph.get(current, ()) if n not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+
+            for score, neighbor in zip((self._vectors[neighbors] @ query).tolist(), neighbors):
+                if len(results) < ef or score > results[0][0]:
+                    heapq.heappush(candidates, (-score, neighbor))
+                    heapq.heappush(results, (score, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted(results, reverse=True)
+
+    def search(self, query: np.ndarray, k: int, candidates: np.ndarray = None):
+        # Con candidatos prefiltrados el conjunto es pequeño: búsqueda exacta
+        if candidates is not None or self._entry_point is None:
+            return self.exact_search(query, k, candidates)
+
+        entry_points = [self._entry_point]
+        for layer in range(len(self._layers) - 1, 0, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+
+        # Se amplía ef con los borrados para seguir devolviendo k resultados
+        ef = max(self.ef_search, k) + min(self.num_deleted, k)
+        found = [(score, key) for score, key in self._search_layer(query, entry_points, ef, 0)
+                 if not self._deleted[key]][:k]
+        keys = np.array([key for _, key in found], dtype=np.int64)
+        scores = np.array([score for score, _ in found], dtype=np.float32)
+        return keys, scores
+
+    def memory_bytes(self) -> int:
+        links = sum(len(neighbors) for graph in self._layers for neighbors in graph.values())
+        return super().memory_bytes() + links * 8
+
+class IVFVectorEngine(FlatVectorEngine):
+    """Índice IVF-Flat: k-means sobre los vectores y listas invertidas
+
+    ``nlist`` fija el número de particiones y ``nprobe`` cuántas se exploran
+    por consulta (más particiones exploradas = más recall y más latencia).
+    Hasta reunir ``min_train_size`` vectores la búsqueda es exacta; después
+    se entrena automáticamente y los nuevos vectores se asignan al centroide
+    más cercano de forma incremental. Cuando los vectores activos se
+    multiplican por ``retrain_factor`` desde el último entrenamiento se
+    vuelve a entrenar, para que los centroides sigan a los datos (None lo
+    desactiva; train() reentrena en cualquier momento).
+    """
+
+    exact = False
+
+    def __init__(self, nlist: int = 100, nprobe: int = 8, min_train_size: int = None,
+                 kmeans_iterations: int = 20, seed: int = 42, retrain_factor: Optional[float] = 2.0):
+        if nlist < 1 or nprobe < 1:
+            raise ValueError(f"IVF requiere nlist >= 1 y nprobe >= 1 (nlist={nlist}, nprobe={nprobe})")
+        if retrain_factor is not None and retrain_factor <= 1:
+            raise ValueError("retrain_factor debe ser mayor que 1")
+        super().__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size or nlist * 39
+        self.kmeans_iterations = kmeans_iterations
+        self.retrain_factor = retrain_factor
+        self._rng = np.random.default_rng(seed)
+        self._centroids = None
+        self._lists: List[List[int]] = []
+        self._trained_count = 0
+
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        keys = self._append(vectors)
+        if self.is_trained and not self._needs_retrain():
+            self._assign(keys)
+        elif self.count >= self.min_train_size:
+            self.train()
+        return keys
+
+    def _needs_retrain(self) -> bool:
+        """Si los vectores activos han crecido ``retrain_factor`` veces desde el último entrenamiento"""
+        return self.retrain_factor is not None and self.count >= self._trained_count * self.retrain_factor
+
+    def train(self):
+        """Entrenar los centroides con k-means esférico y repartir todos los vectores"""
+        active = self.active_keys()
+        sample = active
+        if len(sample) > self.nlist * 256:
+            sample = self._rng.choice(active, self.nlist * 256, replace=False)
+        data = self._vectors[sample]
+
+        nlist = min(self.nlist, len(data))
+        centroids = data[self._rng.choice(len(data), nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            assignment = np.argmax(data @ centroids.T, axis=1)
+            for cluster in range(nlist):
+                members = data[assignment == cluster]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[cluster] = centroid / (np.linalg.norm(centroid) or 1.0)
+
+        self._centroids = centroids
+        self._lists = [[] for _ in range(nlist)]
+        self._assign(active)
+        self._trained_count = len(active)
+        logger.info(f"IVF entrenado con {len(data)} vectores y {nlist} particiones")
+
+    def _assign(self, keys: np.ndarray):
+        assignment = np.argmax(self._vectors[keys] @ self._centroids.T, axis=1)
+        for key, cluster in zip(keys.tolist(), assignment.tolist()):
+            self._lists[cluster].append(key)
+
+    def search(self, query: np.ndarray, k: int, candidates: np.ndarray = None):
+        if candidates is not None or not self.is_trained:
+            return self.exact_search(query, k, candidates)
+
+        probes = _top_k(self._centroids @ query, min(self.nprobe, len(self._centroids)))
+        keys = np.concatenate([np.asarray(self._lists[p], dtype=np.int64) for p in probes])
+        keys = keys[~self._deleted[keys]]
+        scores = self._vectors[keys] @ query
+        top = _top_k(scores, k)
+        return keys[top], scores[top]
+
+    def memory_bytes(self) -> int:
+        centroids = self._centroids.nbytes if self.is_trained else 0
+        return super().memory_bytes() + centroids + sum(len(l) for l in self._lists) * 8
+
+class QuantizedVectorEngine(FlatVectorEngine):
+    """Búsqueda por fuerza bruta sobre vectores compactos con re-ranking exacto
+
+    Los vectores residentes se guardan en float16 o cuantizados a int8 con una
+    escala por vector (2x / 4x menos memoria que float32). Cada consulta puntúa
+    todos los candidatos sobre esa representación, toma ``k * rerank_factor``
+    y los reordena con los vectores float32 originales, que se guardan en un
+    fichero mapeado en memoria: solo se leen del disco las filas que llegan
+    al re-ranking. El fichero es privado de cada motor (nombre único en
+    ``rerank_dir``, por defecto el directorio temporal del sistema) y se
+    borra en close(), así que varios procesos sobre la misma base de datos
+    nunca escriben en el mismo.
+    """
+
+    exact = False
+    DTYPES = {"float16": np.float16, "int8": np.int8}
+
+    def __init__(self, dtype: str = "int8", rerank_factor: int = 4, rerank_dir: str = None,
+                 rerank_prefix: str = "rerank-"):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Tipo de cuantización no soportado: {dtype}")
+        super().__init__()
+        self.dtype = dtype
+        self.rerank_factor = rerank_factor
+        self._scales = np.zeros(0, dtype=np.float32)
+
+        # mkstemp crea un fichero nuevo (O_EXCL): nunca se trunca uno ajeno
+        fd, self.rerank_path = tempfile.mkstemp(prefix=rerank_prefix, suffix=".f32", dir=rerank_dir)
+        self._rerank_file = os.fdopen(fd, "w+b")
+        self._rerank_view = None
+
+    def _append(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._vectors = np.zeros((0, self.dim), dtype=self.DTYPES[self.dtype])
+
+        needed = self.size + len(vectors)
+        if needed > len(self._vectors):
+            capacity = max(needed, 2 * len(self._vectors), 1024)
+            grown = np.zeros((capacity, self.dim), dtype=self._vectors.dtype)
+            grown[:self.size] = self._vectors[:self.size]
+            self._vectors = grown
+            self._scales = np.concatenate([self._scales, np.ones(capacity - len(self._scales), dtype=np.float32)])
+            self._deleted = np.concatenate([self._deleted, np.zeros(capacity - len(self._deleted), dtype=bool)])
+
+        keys = np.arange(self.size, needed)
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self._vectors[keys] = np.rint(vectors / scales[:, None]).astype(np.int8)
+            self._scales[keys] = scales
+        else:
+            self._vectors[keys] = vectors
+
+        # Los originales van al final del fichero de re-ranking
+        self._rerank_file.seek(self.size * self.dim * 4)
+        self._rerank_file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        self._rerank_file.flush()
+        self._rerank_view = None
+
+        self.size = needed
+        return keys
+
+    def _full_precision(self) -> np.ndarray:
+        """Vista mapeada en memoria de los vectores float32 originales"""
+        if self._rerank_view is None:
+            self._rerank_view = np.memmap(self.rerank_path, dtype=np.float32, mode="r",
+                                          shape=(self.size, self.dim))
+        return self._rerank_view
+
+    def get_vectors(self, keys: np.ndarray) -> np.ndarray:
+        return np.asarray(self._full_precision()[np.asarray(keys, dtype=np.int64)])
+
+    def _approximate_scores(self, query: np.ndarray, keys: np.ndarray) -> np.ndarray:
+        """Scores sobre los vectores compactos, por bloques para no materializar float32"""
+        scores = np.empty(len(keys), dtype=np.float32)
+        block = max(1, SCORE_BLOCK_CELLS // max(self.dim, 1))
+        for start in range(0, len(keys), block):
+            rows = keys[start:start + block]
+            scores[start:start + block] = self._vectors[rows].astype(np.float32) @ query
+        if self.dtype == "int8":
+            scores *= self._scales[keys]
+        return scores
+
+    def _active(self, candidates: np.ndarray = None) -> np.ndarray:
+        if candidates is None:
+            return self.active_keys()
+        keys = np.asarray(candidates, dtype=np.int64)
+        return keys[~self._deleted[keys]]
+
+    def _rerank(self, query: np.ndarray, keys: np.ndarray, k: int):
+        # Lectura en orden de fichero para aprovechar la localidad del mmap
+        keys = np.sort(keys)
+        scores = self.get_vectors(keys) @ query
+        top = _top_k(scores, k)
+        return keys[top], scores[top]
+
+    def exact_search(self, query: np.ndarray, k: int, candidates: np.ndarray = None):
+        """Top-k exacto sobre los vectores float32 originales"""
+        if self.size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return self._rerank(query, self._active(candidates), k)
+
+    def search(self, query: np.ndarray, k: int, candidates: np.ndarray = None):
+        keys = self._active(candidates)
+        if len(keys) == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        shortlist = keys[_top_k(self._approximate_scores(query, keys), k * self.rerank_factor)]
+        return self._rerank(query, shortlist, k)
+
+    def memory_bytes(self) -> int:
+        return super().memory_bytes() + self._scales.nbytes
+
+    def bytes_per_vector(self) -> int:
+        return super().bytes_per_vector() + self._scales.itemsize
+
+    def disk_bytes(self) -> int:
+        """Tamaño del fichero float32 usado para el re-ranking"""
+        return self.size * (self.dim or 0) * 4
+
+    def close(self):
+        self._rerank_view = None
+        if not self._rerank_file.closed:
+            self._rerank_file.close()
+            os.remove(self.rerank_path)
+
+def _shard_views(segment: shared_memory.SharedMemory, capacity: int, dim: int):
+    """Vistas (vectores, marcas de borrado) sobre un segmento de memoria compartida"""
+    vectors = np.ndarray((capacity, dim), dtype=np.float32, buffer=segment.buf)
+    deleted = np.ndarray((capacity,), dtype=bool, buffer=segment.buf, offset=capacity * dim * 4)
+    return vectors, deleted
+
+def _scan_shard(vectors: np.ndarray, deleted: np.ndarray, lo: int, hi: int,
+                queries: np.ndarray, k: int):
+    """Top-k exacto de varias consultas sobre las filas [lo, hi), por bloques"""
+    keys = np.empty((len(queries), 0), dtype=np.int64)
+    scores = np.empty((len(queries), 0), dtype=np.float32)
+    block = max(1, SCORE_BLOCK_CELLS // max(len(queries), 1))
+    for start in range(lo, hi, block):
+        stop = min(start + block, hi)
+        block_scores = queries @ vectors[start:stop].T
+        block_scores[:, deleted[start:stop]] = -np.inf
+        top, top_scores = _rows_top_k(block_scores, k)
+        # Fusionar con lo mejor de los bloques anteriores
+        merged_keys = np.concatenate([keys, top + start], axis=1)
+        merged_scores = np.concatenate([scores, top_scores], axis=1)
+        top, scores = _rows_top_k(merged_scores, k)
+        keys = np.take_along_axis(merged_keys, top, axis=1)
+    return keys, scores
+
+def _shard_worker(connection, name: str, capacity: int, dim: int):
+    """Bucle de un proceso de ShardedVectorEngine
+
+    Arranca enlazado al segmento ``name`` (``capacity`` filas de ``dim``
+    float32). Recibe (segmento, capacidad, dim, lo, hi, consultas, k), puntúa
+    su rango de filas directamente sobre la memoria compartida y devuelve el
+    top-k local. Se vuelve a enlazar al segmento cuando el motor lo amplía.
+    """
+    segment = None
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            name, capacity, dim, lo, hi, queries, k = message
+            if segment is None or segment.name != name:
+                if segment is not None:
+                    segment.close()
+                segment = shared_memory.SharedMemory(name=name)
+            vectors, deleted = _shard_views(segment, capacity, dim)
+            try:
+                connection.send(_scan_shard(vectors, deleted, lo, hi, queries, k))
+            except Exception as e:
+                connection.send(e)
+            del vectors, deleted
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        if segment is not None:
+            segment.close()
+
+class ShardedVectorEngine(FlatVectorEngine):
+    """Búsqueda exacta repartida entre varios procesos (scatter-gather)
+
+    Los vectores y las marcas de borrado viven en un segmento de memoria
+    compartida: el proceso principal escribe en él y ``num_shards`` procesos
+    worker lo leen sin copiarlo. Cada consulta (o bloque de consultas) se
+    envía a todos los shards, cada uno puntúa su rango contiguo de filas y el
+    proceso principal fusiona los top-k parciales. Con menos de
+    ``min_shard_size`` vectores por shard se usan menos shards, y con uno
+    solo se busca en el propio proceso para no pagar la comunicación. Si el
+    proceso de un shard muere, su rango pasa a buscarse en el propio proceso.
+    """
+
+    in_process = False
+
+    def __init__(self, num_shards: int = None, min_shard_size: int = 10000):
+        super().__init__()
+        self.num_shards = max(1, num_shards or os.cpu_count() or 1)
+        self.min_shard_size = min_shard_size
+        self._segment = None
+        self._workers = []
+        self._dead_shards = set()
+        self._local_only = False
+        self._lock = threading.Lock()
+
+    def _append(self, vectors: np.ndarray) -> np.ndarray:
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+
+            needed = self.size + len(vectors)
+            if needed > len(self._vectors):
+                # Nuevo segmento más grande; los workers se enlazan a él en la siguiente consulta
+                capacity = max(needed, 2 * len(self._vectors), 1024)
+                segment = shared_memory.SharedMemory(create=True, size=capacity * (self.dim * 4 + 1))
+                grown, deleted = _shard_views(segment, capacity, self.dim)
+                if self.size:
+                    grown[:self.size] = self._vectors[:self.size]
+                    deleted[:self.size] = self._deleted[:self.size]
+                deleted[self.size:] = False
+                self._release_segment()
+                self._segment, self._vectors, self._deleted = segment, grown, deleted
+
+            keys = np.arange(self.size, needed)
+            self._vectors[keys] = vectors
+            self.size = needed
+            return keys
+
+    def _release_segment(self):
+        """Soltar las vistas y liberar el segmento actual"""
+        if self._segment is not None:
+            self._vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+            self._deleted = np.zeros(0, dtype=bool)
+            self._segment.close()
+            self._segment.unlink()
+            self._segment = None
+
+    def _ensure_workers(self) -> bool:
+        """Arrancar los procesos de los shards la primera vez que hacen falta
+
+        Se crean sin fork (ver _worker_context) y reciben como argumentos el
+        nombre y la forma del segmento actual. Devuelve False si no se pueden
+        crear procesos (código ejecutado desde un notebook): entonces se
+        busca en el propio proceso.
+        """
+        if self._workers:
+            return True
+        if self._local_only:
+            return False
+        context = _worker_context()
+        if context is None:
+            self._local_only = True
+            logger.warning("ShardedVectorEngine: sin procesos worker desde un notebook; se busca en local")
+            return False
+        for shard in range(self.num_shards):
+            parent_end, child_end = context.Pipe()
+            process = context.Process(target=_shard_worker,
+                                      args=(child_end, self._segment.name, len(self._vectors), self.dim),
+                                      name=f"vector-shard-{shard}", daemon=True)
+            process.start()
+            child_end.close()
+            self._workers.append((process, parent_end))
+        logger.info(f"ShardedVectorEngine: {self.num_shards} procesos de búsqueda arrancados")
+        return True
+
+    def _shard_ranges(self) -> List[tuple]:
+        """Rangos contiguos de filas, uno por shard activo"""
+        shards = min(self.num_shards, max(1, -(-self.size // max(self.min_shard_size, 1))))
+        bounds = np.linspace(0, self.size, shards + 1).astype(np.int64)
+        return [(int(lo), int(hi)) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+    def _mark_dead(self, shard: int, error: Exception):
+        """Dejar de enviar consultas a un shard cuyo proceso ha terminado"""
+        self._dead_shards.add(shard)
+        logger.warning(f"ShardedVectorEngine: el proceso del shard {shard} ha terminado ({error!r}); "
+                       f"su rango se busca en el propio proceso")
+
+    def _scatter_gather(self, queries: np.ndarray, k: int):
+        """Top-k (claves, scores) de cada consulta sobre todas las filas"""
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        with self._lock:
+            ranges = self._shard_ranges()
+            if len(ranges) <= 1 or not self._ensure_workers():
+                return _scan_shard(self._vectors, self._deleted, 0, self.size, queries, k)
+
+            sent, local = [], []
+            for shard, ((lo, hi), (_, connection)) in enumerate(zip(ranges, self._workers)):
+                if shard not in self._dead_shards:
+                    try:
+                        connection.send((self._segment.name, len(self._vectors), self.dim, lo, hi, queries, k))
+                        sent.append((shard, lo, hi, connection))
+                        continue
+                    except (EOFError, OSError) as e:
+                        self._mark_dead(shard, e)
+                local.append((lo, hi))
+
+            # Los rangos de shards caídos se puntúan aquí mientras los demás trabajan
+            partials = [_scan_shard(self._vectors, self._deleted, lo, hi, queries, k) for lo, hi in local]
+            for shard, lo, hi, connection in sent:
+                try:
+                    partials.append(connection.recv())
+                except (EOFError, OSError) as e:
+                    self._mark_dead(shard, e)
+                    partials.append(_scan_shard(self._vectors, self._deleted, lo, hi, queries, k))
+
+        for partial in partials:
+            if isinstance(partial, Exception):
+                raise partial
+        keys = np.concatenate([partial[0] for partial in partials], axis=1)
+        scores = np.concatenate([partial[1] for partial in partials], axis=1)
+        top, scores = _rows_top_k(scores, k)
+        return np.take_along_axis(keys, top, axis=1), scores
+
+    def exact_search(self, query: np.ndarray, k: int, candidates: np.ndarray = None):
+        # Con candidatos (filtros) el subconjunto es pequeño: se puntúa en local
+        if candidates is not None or self.count == 0:
+            return super().exact_search(query, k, candidates)
+        keys, scores = self._scatter_gather(query[None, :], min(k, self.count))
+        found = np.isfinite(scores[0])
+        return keys[0][found], scores[0][found]
+
+    def search_batch(self, queries: np.ndarray, k: int) -> List[tuple]:
+        if self.count == 0:
+            return [super().exact_search(query, k) for query in queries]
+        keys, scores = self._scatter_gather(queries, min(k, self.count))
+        found = np.isfinite(scores)
+        return [(row_keys[row_found], row_scores[row_found])
+                for row_keys, row_scores, row_found in zip(keys, scores, found)]
+
+    def shard_stats(self) -> Dict:
+        """Shards configurados, activos y filas asignadas a cada uno"""
+        ranges = self._shard_ranges() if self.size else []
+        return {
+            'num_shards': self.num_shards,
+            'active_shards': len(ranges),
+            'workers_started': len(self._workers),
+            'dead_shards': len(self._dead_shards),
+            'rows_per_shard': [hi - lo for lo, hi in ranges]
+        }
+
+    def close(self):
+        with self._lock:
+            for process, connection in self._workers:
+                try:
+                    connection.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+            for process, connection in self._workers:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+                connection.close()
+            self._workers = []
+            self._dead_shards = set()
+            self._release_segment()
+
+VECTOR_ENGINES = {
+    "flat": FlatVectorEngine,
+    "hnsw": HNSWVectorEngine,
+    "ivf": IVFVectorEngine,
+    "quantized": QuantizedVectorEngine,
+    "sharded": ShardedVectorEngine
+}
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Normalizar vectores (o filas de una matriz) a norma 1"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+def _define_numpy_vector_store():
+    """Definir NumpyVectorStore (requiere LlamaIndex ya importado)"""
+
+    class NumpyVectorStore(BasePydanticVectorStore):
+        """Vector store de LlamaIndex respaldado por un motor NumPy
+
+        Traduce los node_id de LlamaIndex a claves del motor y delega en él la
+        inserción, el borrado por documento y la búsqueda top-k. El texto de los
+        nodos se queda en el docstore del índice.
+        """
+
+        stores_text: bool = False
+        _engine: Any = PrivateAttr()
+        _node_ids: List[Optional[str]] = PrivateAttr(default_factory=list)
+        _rows: Dict[str, int] = PrivateAttr(default_factory=dict)
+        _doc_rows: Dict[str, List[int]] = PrivateAttr(default_factory=dict)
+        _node_docs: Dict[str, str] = PrivateAttr(default_factory=dict)
+
+        def __init__(self, engine: FlatVectorEngine, **kwargs: Any):
+            super().__init__(**kwargs)
+            self._engine = engine
+
+        @property
+        def client(self) -> Any:
+            return self._engine
+
+        @property
+        def engine(self) -> FlatVectorEngine:
+            return self._engine
+
+        @property
+        def node_ids(self) -> List[str]:
+            """IDs de los nodos activos, en orden de inserción"""
+            return [node_id for node_id in self._node_ids if node_id is not None]
+
+        @property
+        def node_doc_ids(self) -> Dict[str, str]:
+            """doc_id de cada nodo activo"""
+            return self._node_docs
+
+        def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+            if not nodes:
+                return []
+
+            node_ids = [node.node_id for node in nodes]
+            self.add_embeddings(
+                node_ids,
+                [node.ref_doc_id for node in nodes],
+                np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+            )
+            return node_ids
+
+        def add_embeddings(self, node_ids: List[str], doc_ids: List[str], vectors: np.ndarray):
+            """Añadir vectores ya calculados (p. ej. un .npy mapeado) sin construir nodos"""
+            if not node_ids:
+                return
+            keys = self._engine.add(_normalize_rows(np.asarray(vectors, dtype=np.float32)))
+
+            key_list = keys.tolist()
+            self._node_ids.extend([None] * (key_list[-1] + 1 - len(self._node_ids)))
+            for node_id, key in zip(node_ids, key_list):
+                self._node_ids[key] = node_id
+            self._rows.update(zip(node_ids, key_list))
+            self._node_docs.update(zip(node_ids, doc_ids))
+            for doc_id, key in zip(doc_ids, key_list):
+                self._doc_rows.setdefault(doc_id, []).append(key)
+
+        def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+            keys = self._doc_rows.pop(ref_doc_id, [])
+            if not keys:
+                return
+
+            self._engine.remove(np.asarray(keys, dtype=np.int64))
+            for key in keys:
+                self._rows.pop(self._node_ids[key], None)
+                self._node_docs.pop(self._node_ids[key], None)
+                self._node_ids[key] = None
+
+        def delete_nodes(self, node_ids: List[str] = None, filters: Any = None, **delete_kwargs: Any) -> None:
+            if node_ids is None or filters is not None:
+                raise ValueError("NumpyVectorStore solo borra nodos por node_id")
+            keys = [self._rows.pop(node_id) for node_id in node_ids if node_id in self._rows]
+            if not keys:
+                return
+
+            self._engine.remove(np.asarray(keys, dtype=np.int64))
+            removed = set(keys)
+            for doc_id in {self._node_docs.pop(self._node_ids[key], None) for key in keys}:
+                remaining = [key for key in self._doc_rows.get(doc_id, ()) if key not in removed]
+                if remaining:
+                    self._doc_rows[doc_id] = remaining
+                else:
+                    self._doc_rows.pop(doc_id, None)
+            for key in keys:
+                self._node_ids[key] = None
+
+        def _candidate_keys(self, query: VectorStoreQuery) -> Optional[np.ndarray]:
+            """Claves permitidas por los filtros node_ids / doc_ids de la consulta"""
+            if query.node_ids is None and query.doc_ids is None:
+                return None
+
+            keys = set()
+            if query.node_ids is not None:
+                keys.update(self._rows[node_id] for node_id in query.node_ids if node_id in self._rows)
+            if query.doc_ids is not None:
+                doc_keys = {key for doc_id in query.doc_ids for key in self._doc_rows.get(doc_id, ())}
+                keys = keys & doc_keys if query.node_ids is not None else doc_keys
+            return np.fromiter(keys, dtype=np.int64, count=len(keys))
+
+        def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+            if query.filters is not None:
+                raise ValueError("NumpyVectorStore no soporta filtros de metadatos de LlamaIndex")
+
+            vector = _normalize_rows(np.asarray(query.query_embedding, dtype=np.float32))
+            keys, scores = self._engine.search(vector, query.similarity_top_k, self._candidate_keys(query))
+
+            return VectorStoreQueryResult(
+                ids=[self._node_ids[key] for key in keys.tolist()],
+                similarities=scores.tolist()
+            )
+
+        def query_batch(self, vectors: np.ndarray, top_k: int) -> List[List[tuple]]:
+            """Top-k (node_id, score) de varias consultas normalizadas con una llamada al motor"""
+            return [
+                list(zip([self._node_ids[key] for key in keys.tolist()], scores.tolist()))
+                for keys, scores in self._engine.search_batch(vectors, top_k)
+            ]
+
+        def get_embeddings(self, node_ids: List[str]) -> np.ndarray:
+            """Matriz de embeddings (normalizados) para los nodos indicados"""
+            return self._engine.get_vectors([self._rows[node_id] for node_id in node_ids])
+
+    return NumpyVectorStore
+
+# =============================================================================
+# MÉTRICAS DE LATENCIA POR ETAPA
+# =============================================================================
+
+# Límites superiores (segundos) de los buckets de los histogramas
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class LatencyHistogram:
+    """Histograma de latencias con buckets fijos, compatible con Prometheus"""
+
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """Percentil estimado por interpolación lineal dentro del bucket"""
+        if not self.count:
+            return 0.0
+        target = q / 100 * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= target:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (target - seen) / bucket_count, self.max)
+            seen += bucket_count
+        return self.max
+
+class StageMetrics:
+    """Histogramas de latencia por operación (search, ingest...) y etapa
+
+    ``timer()`` mide con un reloj monótono y, si se le pasa un diccionario,
+    acumula también la duración de la etapa en él para la petición en curso.
+    """
+
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms: Dict[tuple, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, operation: str, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get((operation, stage))
+            if histogram is None:
+                histogram = self._histograms[(operation, stage)] = LatencyHistogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, operation: str, stage: str, timings: Dict[str, float] = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(operation, stage, elapsed)
+            if timings is not None:
+                timings[stage] = timings.get(stage, 0.0) + elapsed
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict]]:
+        """Resumen por operación y etapa: número, total y percentiles en ms"""
+        with self._lock:
+            summary: Dict[str, Dict[str, Dict]] = {}
+            for (operation, stage), histogram in sorted(self._histograms.items()):
+                summary.setdefault(operation, {})[stage] = {
+                    'count': histogram.count,
+                    'total_ms': round(histogram.sum * 1000, 3),
+                    'mean_ms': round(histogram.sum / histogram.count * 1000, 3),
+                    'p50_ms': round(histogram.percentile(50) * 1000, 3),
+                    'p95_ms': round(histogram.percentile(95) * 1000, 3),
+                    'p99_ms': round(histogram.percentile(99) * 1000, 3),
+                    'max_ms': round(histogram.max * 1000, 3)
+                }
+            return summary
+
+    def prometheus_lines(self, name: str = "semantic_search_stage_duration_seconds") -> List[str]:
+        """Histogramas en formato de texto de Prometheus"""
+        lines = [f"# HELP {name} Latencia por operación y etapa",
+                 f"# TYPE {name} histogram"]
+        with self._lock:
+            for (operation, stage), histogram in sorted(self._histograms.items()):
+                labels = f'operation="{operation}",stage="{stage}"'
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+# =============================================================================
+# ANALÍTICAS INCREMENTALES
+# =============================================================================
+
+# Bucket único que acumula todas las búsquedas
+ROLLUP_TOTAL_BUCKET = datetime(1970, 1, 1)
+# Los buckets por minuto se conservan este tiempo; los horarios, siempre
+ROLLUP_MINUTE_RETENTION = timedelta(days=2)
+
+class LatencySketch:
+    """Sketch de cuantiles con error relativo acotado (estilo DDSketch)
+
+    Cada valor cae en el bucket logarítmico ``ceil(log_gamma(x))``, así que
+    cualquier percentil se estima con un error relativo de
+    ``relative_accuracy``. Los sketches se combinan sumando buckets, lo que
+    permite agregarlos por minuto, hora y total sin guardar cada muestra.
+    """
+
+    MIN_VALUE = 1e-6
+
+    def __init__(self, relative_accuracy: float = 0.01, counts: Dict[int, int] = None):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.counts: Dict[int, int] = dict(counts or {})
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts.values())
+
+    def add(self, value: float, count: int = 1):
+        index = math.ceil(math.log(max(value, self.MIN_VALUE)) / self._log_gamma)
+        self.counts[index] = self.counts.get(index, 0) + count
+
+    def merge(self, other: "LatencySketch"):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+    def percentile(self, q: float) -> float:
+        total = self.count
+        if not total:
+            return 0.0
+        rank = q / 100 * (total - 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.counts) / (self.gamma + 1)
+
+    def to_json(self) -> str:
+        return json.dumps({"accuracy": self.relative_accuracy, "counts": self.counts})
+
+    @classmethod
+    def from_json(cls, data: Optional[str]) -> "LatencySketch":
+        if not data:
+            return cls()
+        payload = json.loads(data)
+        return cls(payload["accuracy"], {int(index): count for index, count in payload["counts"].items()})
+
+def _rollup_buckets(timestamp: datetime) -> List[tuple]:
+    """Buckets (granularidad, inicio) a los que contribuye una búsqueda"""
+    return [
+        ("minute", timestamp.replace(second=0, microsecond=0)),
+        ("hour", timestamp.replace(minute=0, second=0, microsecond=0)),
+        ("total", ROLLUP_TOTAL_BUCKET)
+    ]
+
+def update_search_rollups(session: Session, rows: List[Dict]):
+    """Acumular un lote de búsquedas registradas en search_rollups y query_counts
+
+    Se ejecuta en la misma transacción que la inserción en search_queries, de
+    modo que las lecturas del panel solo recorren buckets y el top-N.
+    """
+    if not rows:
+        return
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    deltas: Dict[tuple, Dict] = {}
+    query_deltas: Dict[str, List] = {}
+
+    for row in rows:
+        timestamp = row.get('timestamp') or now
+        execution_time = row.get('execution_time') or 0.0
+        for key in _rollup_buckets(timestamp):
+            delta = deltas.get(key)
+            if delta is None:
+                delta = deltas[key] = {'searches': 0, 'time': 0.0, 'max': 0.0, 'results': 0,
+                                       'similarity': 0.0, 'sketch': LatencySketch(), 'stages': {}}
+            delta['searches'] += 1
+            delta['time'] += execution_time
+            delta['max'] = max(delta['max'], execution_time)
+            delta['results'] += row.get('results_count') or 0
+            delta['similarity'] += row.get('avg_similarity') or 0.0
+            delta['sketch'].add(execution_time)
+            for stage, column_name in STAGE_COLUMNS.items():
+                if row.get(column_name) is not None:
+                    totals = delta['stages'].setdefault(stage, [0.0, 0])
+                    totals[0] += row[column_name]
+                    totals[1] += 1
+
+        query = QueryEmbeddingCache.normalize(row['query_text'])
+        counts = query_deltas.setdefault(query, [0, timestamp])
+        counts[0] += 1
+        counts[1] = max(counts[1], timestamp)
+
+    existing = {
+        (rollup.granularity, rollup.bucket_start): rollup
+        for rollup in session.query(SearchRollup).filter(
+            tuple_(SearchRollup.granularity, SearchRollup.bucket_start).in_(list(deltas))
+        )
+    }
+    for (granularity, bucket_start), delta in deltas.items():
+        rollup = existing.get((granularity, bucket_start))
+        if rollup is None:
+            rollup = SearchRollup(granularity=granularity, bucket_start=bucket_start, searches=0,
+                                  total_execution_time=0.0, max_execution_time=0.0,
+                                  total_results=0, total_similarity=0.0)
+            session.add(rollup)
+
+        sketch = LatencySketch.from_json(rollup.latency_sketch)
+        sketch.merge(delta['sketch'])
+        stage_totals = json.loads(rollup.stage_totals) if rollup.stage_totals else {}
+        for stage, (seconds, count) in delta['stages'].items():
+            previous = stage_totals.get(stage, [0.0, 0])
+            stage_totals[stage] = [previous[0] + seconds, previous[1] + count]
+
+        rollup.searches += delta['searches']
+        rollup.total_execution_time += delta['time']
+        rollup.max_execution_time = max(rollup.max_execution_time, delta['max'])
+        rollup.total_results += delta['results']
+        rollup.total_similarity += delta['similarity']
+        rollup.latency_sketch = sketch.to_json()
+        rollup.stage_totals = json.dumps(stage_totals)
+
+    known = {
+        entry.query_text: entry
+        for entry in session.query(QueryCount).filter(QueryCount.query_text.in_(list(query_deltas)))
+    }
+    for query, (count, last_seen) in query_deltas.items():
+        entry = known.get(query)
+        if entry is None:
+            session.add(QueryCount(query_text=query, count=count, last_seen=last_seen))
+        else:
+            entry.count += count
+            entry.last_seen = max(entry.last_seen or last_seen, last_seen)
+
+    session.query(SearchRollup).filter(
+        SearchRollup.granularity == "minute",
+        SearchRollup.bucket_start < now - ROLLUP_MINUTE_RETENTION
+    ).delete(synchronize_session=False)
+
+def _rollup_summary(rollup: SearchRollup) -> Dict:
+    """Métricas legibles de un bucket de search_rollups"""
+    sketch = LatencySketch.from_json(rollup.latency_sketch)
+    searches = rollup.searches or 0
+    return {
+        'bucket_start': rollup.bucket_start,
+        'searches': searches,
+        'avg_execution_time': rollup.total_execution_time / searches if searches else 0.0,
+        'max_execution_time': rollup.max_execution_time,
+        'avg_results': rollup.total_results / searches if searches else 0.0,
+        'p50_execution_time': sketch.percentile(50),
+        'p95_execution_time': sketch.percentile(95),
+        'p99_execution_time': sketch.percentile(99)
+    }
+
+# =============================================================================
+# REGISTRO DE BÚSQUEDAS EN SEGUNDO PLANO
+# =============================================================================
+
+class SearchLogWriter:
+    """Cola acotada que escribe los SearchQuery en lotes desde un hilo propio
+
+    Las búsquedas solo encolan su registro; el hilo escritor inserta los
+    lotes en una única transacción cuando se alcanzan ``batch_size`` filas o
+    pasan ``flush_interval`` segundos. Si la cola se llena se aplica
+    ``overflow_policy``:
+
+    - ``"drop"``: se descarta el registro nuevo.
+    - ``"sample"``: por encima de la mitad de la cola solo se acepta una
+      fracción ``sample_rate`` de los registros; con la cola llena se descarta.
+    - ``"block"``: la búsqueda espera a que haya hueco.
+    """
+
+    OVERFLOW_POLICIES = ("drop", "sample", "block")
+
+    def __init__(self, session_factory: Callable[[], Session], max_queue_size: int = 10000,
+                 batch_size: int = 200, flush_interval: float = 1.0,
+                 overflow_policy: str = "drop", sample_rate: float = 0.1):
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Política de desbordamiento desconocida: {overflow_policy}")
+
+        self.session_factory = session_factory
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.sample_rate = sample_rate
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._rng = np.random.default_rng()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._counters = {
+            'enqueued': 0,
+            'written': 0,
+            'dropped': 0,
+            'sampled_out': 0,
+            'failed': 0,
+            'flushes': 0
+        }
+        self._last_flush_ms = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="search-log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def log(self, row: Dict) -> bool:
+        """Encolar un registro de búsqueda; devuelve False si se descartó"""
+        if self._closed:
+            self._count('dropped')
+            return False
+
+        if self.overflow_policy == "block":
+            self._queue.put(row)
+        else:
+            if (self.overflow_policy == "sample" and
+                    self._queue.qsize() >= self.max_queue_size // 2 and
+                    self._rng.random() >= self.sample_rate):
+                self._count('sampled_out')
+                return False
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                self._count('dropped')
+                return False
+
+        self._count('enqueued')
+        return True
+
+    def log_many(self, rows: List[Dict]) -> int:
+        """Encolar varios registros; devuelve cuántos se aceptaron"""
+        return sum(self.log(row) for row in rows)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Escribir ya todo lo encolado y esperar a que termine"""
+        if not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """Vaciar la cola y detener el hilo escritor"""
+        if self._closed:
+            return
+        self._closed = True
+        self.flush(timeout)
+        self._queue.put(None)
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = False
+
+            if isinstance(item, dict):
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+
+            # Lote completo, intervalo cumplido, flush explícito o cierre
+            if batch:
+                self._write(batch)
+                batch = []
+            deadline = time.monotonic() + self.flush_interval
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+    def _write(self, rows: List[Dict]):
+        start = time.perf_counter()
+        try:
+            with self.session_factory() as session:
+                session.execute(insert(SearchQuery), rows)
+                update_search_rollups(session, rows)
+                session.commit()
+            self._count('written', len(rows))
+        except Exception as e:
+            logger.error(f"Error al guardar {len(rows)} registros de búsqueda: {e}")
+            self._count('failed', len(rows))
+        finally:
+            self._count('flushes')
+            self._last_flush_ms = (time.perf_counter() - start) * 1000
+
+    def metrics(self) -> Dict:
+        """Contadores de la cola de registro"""
+        with self._lock:
+            return {
+                **self._counters,
+                'queue_depth': self._queue.qsize(),
+                'max_queue_size': self.max_queue_size,
+                'overflow_policy': self.overflow_policy,
+                'last_flush_ms': round(self._last_flush_ms, 3)
+            }
+
+# =============================================================================
+# INGESTA DE FICHEROS
+# =============================================================================
+
+DEFAULT_INGEST_PATTERNS = ("*.txt", "*.md")
+_WORKER_SPLITTERS: Dict[tuple, Any] = {}
+
+def _worker_context():
+    """Contexto de multiprocessing para procesos creados con hilos en marcha
+
+    "fork" copiaría el proceso con los locks de otros hilos (registro
+    diferido, pools de SQLAlchemy, torch) quizá tomados, así que se usa
+    "forkserver" (o "spawn" donde no existe): el hijo parte de un proceso
+    limpio e importa este módulo. Desde un notebook, con el código en un
+    __main__ sin fichero, el hijo no puede importarlo y se devuelve None.
+    """
+    if __name__ == "__main__" and not getattr(sys.modules["__main__"], "__file__", None):
+        return None
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+def _iter_files(root: str, patterns: Iterable[str], recursive: bool = True) -> Iterable[Path]:
+    """Recorrer ``root`` de forma perezosa devolviendo los ficheros que casan con algún patrón"""
+    patterns = tuple(patterns)
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if any(fnmatch.fnmatch(filename, pattern) for pattern in patterns):
+                yield Path(directory) / filename
+        if not recursive:
+            break
+
+def _decode_file(data: bytes) -> str:
+    """Decodificar UTF-8 (con o sin BOM) y, si falla, Latin-1"""
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+def _parse_file(task: tuple) -> Dict:
+    """Worker de ingest_directory: leer, decodificar y trocear un fichero
+
+    Se ejecuta en un proceso del pool; devuelve la fila SQL y los nodos ya
+    troceados (sin embeddings) o el error producido. ``previous_hash`` es el
+    hash del documento ya guardado para esa ruta (None si es nuevo): si el
+    contenido no ha cambiado no se trocea.
+    """
+    doc_id, path, chunk_size, chunk_overlap, previous_hash = task
+    start = time.perf_counter()
+    try:
+        path = Path(path)
+        content = _decode_file(path.read_bytes())
+        if not content.strip():
+            return {'doc_id': doc_id, 'path': str(path), 'skipped': True}
+        digest = content_hash(content)
+        if digest == previous_hash:
+            return {'doc_id': doc_id, 'path': str(path), 'unchanged': True}
+
+        _load_llama_index()
+        splitter = _WORKER_SPLITTERS.get((chunk_size, chunk_overlap))
+        if splitter is None:
+            splitter = _WORKER_SPLITTERS[(chunk_size, chunk_overlap)] = SentenceSplitter(
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+
+        row = {
+            "doc_id": doc_id,
+            "title": path.stem,
+            "content": content,
+            "file_path": str(path),
+            "file_type": path.suffix.lstrip(".").lower() or None,
+            "word_count": len(content.split()),
+            "embedding_model": EMBEDDING_MODEL,
+            "content_hash": digest
+        }
+        document = SemanticSearchSystem._make_document(
+            doc_id, row["title"], content, row["file_path"], row["file_type"]
+        )
+        return {'doc_id': doc_id, 'path': str(path), 'row': row, 'update': previous_hash is not None,
+                'nodes': splitter.get_nodes_from_documents([document]),
+                'parse_time': time.perf_counter() - start}
+
+    except Exception as e:
+        return {'doc_id': doc_id, 'path': str(path), 'error': f"{type(e).__name__}: {e}"}
+
+# =============================================================================
+# MIGRACIÓN DE MODELOS DE EMBEDDING
+# =============================================================================
+
+# Estados de EmbeddingMigrationRun que pueden reanudarse
+MIGRATION_RESUMABLE = ("running", "paused", "ready", "failed")
+
+class EmbeddingMigrationJob:
+    """Re-embedding en segundo plano hacia un índice sombra
+
+    Recorre los documentos en lotes de ``batch_size`` (por id, reanudable):
+    copia los nodos del índice activo, los embebe con ``model_name`` a través
+    de la caché de fragmentos y los inserta en un índice sombra con el mismo
+    tipo de motor. Cada lote queda registrado en embedding_migration_documents,
+    así que tras un reinicio los documentos ya hechos se restauran desde la
+    caché sin volver a llamar al modelo. Las búsquedas siguen usando el índice
+    activo hasta SemanticSearchSystem.cutover_embedding_migration().
+
+    Límites de CPU: el hilo baja su prioridad (``niceness``, Linux) y tras
+    cada lote duerme lo necesario para no pasar de ``max_cpu_fraction`` del
+    tiempo de pared ocupado.
+    """
+
+    def __init__(self, system: "SemanticSearchSystem", migration_id: int, model_name: str,
+                 batch_size: int = 32, max_cpu_fraction: float = 0.5, niceness: int = 10,
+                 auto_cutover: bool = False):
+        if not 0 < max_cpu_fraction <= 1:
+            raise ValueError("max_cpu_fraction debe estar en (0, 1]")
+        self.system = system
+        self.migration_id = migration_id
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_cpu_fraction = max_cpu_fraction
+        self.niceness = niceness
+        self.auto_cutover = auto_cutover
+
+        self.state = "running"
+        self.error: Optional[str] = None
+        self.embedded = 0
+        self.restored = 0
+        self.busy_time = 0.0
+        self.throttle_time = 0.0
+
+        self.shadow_index = None
+        self.shadow_store = None
+        self.shadow_context = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="embedding-migration", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Pedir la parada tras el lote en curso y esperarla"""
+        self._stop.set()
+        if self._thread.is_alive() and threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    @property
+    def is_alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def _lower_priority(self):
+        """Bajar la prioridad del hilo (en Linux nice es por hilo)"""
+        if self.niceness and hasattr(os, "setpriority"):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.niceness)
+            except OSError as e:
+                logger.warning(f"No se pudo bajar la prioridad de la migración: {e}")
+
+    def _throttle(self, busy: float):
+        """Dormir para que el trabajo ocupe como mucho max_cpu_fraction del tiempo"""
+        self.busy_time += busy
+        pause = busy * (1 / self.max_cpu_fraction - 1)
+        if pause > 0:
+            self.throttle_time += pause
+            self._stop.wait(pause)
+
+    def _ensure_shadow(self):
+        """Crear el índice sombra vacío con el mismo motor que el activo"""
+        if self.shadow_index is None:
+            self.shadow_store, self.shadow_context = self.system._new_vector_store()
+            self.shadow_index = VectorStoreIndex([], storage_context=self.shadow_context)
+
+    def _add_documents(self, doc_ids: List[str]) -> tuple:
+        """Copiar al índice sombra los nodos activos de esos documentos, re-embebidos
+
+        Los nodos se copian del docstore activo bajo _index_lock (las
+        escrituras concurrentes lo modifican); el embedding se calcula ya
+        fuera del lock. Devuelve los nodos copiados por documento y el
+        número de textos enviados al modelo.
+        """
+        with self.system._index_lock:
+            live = self.system.index
+            node_counts = {}
+            node_ids = []
+            for doc_id in doc_ids:
+                info = live.docstore.get_ref_doc_info(doc_id)
+                node_counts[doc_id] = len(info.node_ids) if info is not None else 0
+                if info is not None:
+                    node_ids.extend(info.node_ids)
+            nodes = [
+                node.model_copy(update={"embedding": None})
+                for node in live.docstore.get_nodes(node_ids, raise_error=False) if node is not None
+            ]
+        embedded = self.system._embed_nodes(nodes, model_name=self.model_name)
+
+        for doc_id in doc_ids:
+            if self.shadow_index.docstore.get_ref_doc_info(doc_id) is not None:
+                self.shadow_index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        if nodes:
+            self.shadow_index.insert_nodes(nodes)
+        return node_counts, embedded
+
+    def _record_progress(self, node_counts: Dict[str, int]):
+        """Marcar documentos como embebidos y actualizar el contador de la migración"""
+        embedded_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        with self.system.get_db_session() as session:
+            session.execute(insert(EmbeddingMigrationDocument), [
+                {"migration_id": self.migration_id, "doc_id": doc_id,
+                 "node_count": count, "embedded_at": embedded_at}
+                for doc_id, count in node_counts.items()
+            ])
+            session.query(EmbeddingMigrationRun).filter(EmbeddingMigrationRun.id == self.migration_id).update(
+                {"embedded_documents": EmbeddingMigrationRun.embedded_documents + len(node_counts)}
+            )
+            session.commit()
+
+    def _set_state(self, state: str, error: str = None):
+        self.state = state
+        self.error = error
+        with self.system.get_db_session() as session:
+            session.query(EmbeddingMigrationRun).filter(EmbeddingMigrationRun.id == self.migration_id).update(
+                {"status": state, "error": error}
+            )
+            session.commit()
+
+    def _backfill(self):
+        """Recorrer todos los documentos por id y llenar el índice sombra"""
+        with self.system.get_read_session() as session:
+            done = {
+                row.doc_id for row in session.query(EmbeddingMigrationDocument.doc_id).filter(
+                    EmbeddingMigrationDocument.migration_id == self.migration_id
+                )
+            }
+
+        last_id = 0
+        while not self._stop.is_set():
+            with self.system.get_read_session() as session:
+                rows = session.query(DocumentMetadata.id, DocumentMetadata.doc_id).filter(
+                    DocumentMetadata.id > last_id
+                ).order_by(DocumentMetadata.id).limit(self.batch_size).all()
+            if not rows:
+                return True
+            last_id = rows[-1].id
+
+            start = time.perf_counter()
+            doc_ids = [row.doc_id for row in rows]
+            pending = [doc_id for doc_id in doc_ids if doc_id not in done]
+            restored = [doc_id for doc_id in doc_ids if doc_id in done
+                        and self.shadow_index.docstore.get_ref_doc_info(doc_id) is None]
+            # Los ya embebidos salen de la caché de fragmentos y solo cuentan para
+            # el límite de CPU si hubo que llamar al modelo (p. ej. chunk_cache=False)
+            embedded = 0
+            if restored:
+                embedded += self._add_documents(restored)[1]
+                self.restored += len(restored)
+            if pending:
+                counts, pending_embedded = self._add_documents(pending)
+                embedded += pending_embedded
+                self._record_progress(counts)
+                self.embedded += len(pending)
+            if pending or embedded:
+                self._throttle(time.perf_counter() - start)
+        return False
+
+    def reconcile(self, throttle: bool = False) -> int:
+        """Igualar el índice sombra con el activo tras escrituras concurrentes
+
+        Compara por documento los node_id de ambos índices: los documentos
+        añadidos o actualizados después de su lote se vuelven a copiar (sus
+        fragmentos sin cambios salen de la caché) y los borrados se eliminan.
+        Los node_id activos se copian bajo _index_lock. Con ``throttle`` (el
+        hilo de la migración) los lotes que llaman al modelo respetan
+        max_cpu_fraction; el cambio de modelo reconcilia sin pausas porque
+        tiene bloqueadas las escrituras.
+        """
+        with self.system._index_lock:
+            live_nodes = {
+                doc_id: set(info.node_ids)
+                for doc_id, info in (self.system.index.docstore.get_all_ref_doc_info() or {}).items()
+            }
+        shadow_info = self.shadow_index.docstore.get_all_ref_doc_info() or {}
+
+        removed = [doc_id for doc_id in shadow_info if doc_id not in live_nodes]
+        for doc_id in removed:
+            self.shadow_index.delete_ref_doc(doc_id, delete_from_docstore=True)
+
+        changed = [
+            doc_id for doc_id, node_ids in live_nodes.items()
+            if doc_id not in shadow_info or node_ids != set(shadow_info[doc_id].node_ids)
+        ]
+        for start in range(0, len(changed), self.batch_size):
+            batch_start = time.perf_counter()
+            if self._add_documents(changed[start:start + self.batch_size])[1] and throttle:
+                self._throttle(time.perf_counter() - batch_start)
+        return len(changed) + len(removed)
+
+    def _run(self):
+        self._lower_priority()
+        try:
+            self._set_state("running")
+            self._ensure_shadow()
+            if not self._backfill():
+                self._set_state("paused")
+                logger.info(f"Migración {self.migration_id} pausada")
+                return
+
+            self.reconcile(throttle=True)
+            self._set_state("ready")
+            logger.info(
+                f"Migración {self.migration_id} lista para el cambio a {self.model_name}: "
+                f"{self.embedded} documentos embebidos, {self.restored} restaurados"
+            )
+            if self.auto_cutover:
+                self.system.cutover_embedding_migration()
+
+        except Exception as e:
+            logger.error(f"Error en la migración {self.migration_id}: {e}")
+            self._set_state("failed", f"{type(e).__name__}: {e}")
+
+    def status(self) -> Dict:
+        return {
+            'migration_id': self.migration_id,
+            'model_name': self.model_name,
+            'state': self.state,
+            'error': self.error,
+            'embedded_this_run': self.embedded,
+            'restored_from_cache': self.restored,
+            'busy_s': round(self.busy_time, 3),
+            'throttled_s': round(self.throttle_time, 3),
+            'max_cpu_fraction': self.max_cpu_fraction
+        }
+
+# =============================================================================
+# RESULTADOS DE BÚSQUEDA
+# =============================================================================
+
+# Claves de un resultado, en orden; las híbridas solo en mode="hybrid"
+RESULT_FIELDS = ('doc_id', 'title', 'content', 'similarity_score', 'metadata',
+                 'file_path', 'file_type', 'created_at', 'word_count')
+HYBRID_RESULT_FIELDS = ('vector_score', 'lexical_score')
+_SQL_RESULT_FIELDS = ('file_path', 'file_type', 'created_at', 'word_count')
+_NOT_HYBRID = object()
+
+class SearchResult(Mapping):
+    """Resultado de búsqueda compacto que carga sus campos bajo demanda
+
+    Se usa como el dict que devolvía search() (``result['content']``,
+    ``result.get(...)``, ``dict(result)``), pero solo guarda el doc_id, el
+    node_id del fragmento (None en aciertos léxicos) y los scores. Título,
+    texto, metadatos del nodo y columnas SQL se leen al acceder al primero
+    de ellos, para todos los resultados de la página a la vez (ver
+    _ResultLoader). Es de solo lectura, así que la caché de resultados y los
+    cursores de paginación lo comparten sin copiarlo.
+    """
+
+    __slots__ = ('doc_id', 'node_id', 'similarity_score', 'vector_score', 'lexical_score',
+                 '_loader', '_fields')
+
+    def __init__(self, doc_id: str, similarity_score: float, node_id: Optional[str] = None,
+                 vector_score: Any = _NOT_HYBRID, lexical_score: Any = _NOT_HYBRID):
+        self.doc_id = doc_id
+        self.similarity_score = similarity_score
+        self.node_id = node_id
+        self.vector_score = vector_score
+        self.lexical_score = lexical_score
+        self._loader: Optional["_ResultLoader"] = None
+        self._fields: Optional[Dict] = None
+
+    def _keys(self) -> tuple:
+        if self.vector_score is _NOT_HYBRID:
+            return RESULT_FIELDS
+        return RESULT_FIELDS + HYBRID_RESULT_FIELDS
+
+    def __getitem__(self, key: str) -> Any:
+        if key in ('doc_id', 'similarity_score') or (key in HYBRID_RESULT_FIELDS and key in self._keys()):
+            return getattr(self, key)
+        if key not in RESULT_FIELDS:
+            raise KeyError(key)
+        if self._fields is None:
+            if self._loader is None:
+                raise RuntimeError("Resultado sin cargador: obténgalo de search()")
+            self._loader.load()
+        return self._fields[key]
+
+    def __contains__(self, key: object) -> bool:
+        # Sin cargar los campos, a diferencia de Mapping.__contains__
+        return key in self._keys()
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self) -> int:
+        return len(self._keys())
+
+    def __repr__(self) -> str:
+        return f"SearchResult(doc_id={self.doc_id!r}, similarity_score={self.similarity_score:.4f})"
+
+class _ResultLoader:
+    """Carga conjunta de los campos de una página de SearchResult
+
+    Los nodos se leen del docstore del índice solo para los resultados de la
+    página; las columnas SQL salen de la caché de metadatos del sistema o de
+    una única consulta IN. Si el nodo ya no existe (documento modificado
+    después de la búsqueda) se usa el documento completo, como en los
+    aciertos léxicos.
+    """
+
+    __slots__ = ('system', 'results', '_lock')
+
+    def __init__(self, system: "SemanticSearchSystem", results: List[SearchResult]):
+        self.system = system
+        self.results = results
+        self._lock = threading.Lock()
+        for result in results:
+            result._loader = self
+
+    def load(self):
+        with self._lock:
+            pending = [result for result in self.results if result._fields is None]
+            if not pending:
+                return
+
+            node_ids = [result.node_id for result in pending if result.node_id is not None]
+            nodes = {
+                node.node_id: node
+                for node in self.system.index.docstore.get_nodes(node_ids, raise_error=False)
+            } if node_ids else {}
+            metadata_by_doc = self.system._fetch_metadata(
+                result.doc_id for result in pending if result.node_id in nodes
+            )
+            rows = self.system._document_rows(
+                result.doc_id for result in pending if result.node_id not in nodes
+            )
+
+            for result in pending:
+                node = nodes.get(result.node_id)
+                if node is not None:
+                    fields = dict.fromkeys(_SQL_RESULT_FIELDS)
+                    fields.update(metadata_by_doc.get(result.doc_id, {}))
+                    fields.update({
+                        'title': node.metadata.get('title', 'Sin título'),
+                        'content': node.text,
+                        'metadata': dict(node.metadata)
+                    })
+                else:
+                    # Acierto léxico: documento completo leído de SQL
+                    row = rows.get(result.doc_id)
+                    fields = dict.fromkeys(('title', 'content', 'metadata') + _SQL_RESULT_FIELDS)
+                    if row is not None:
+                        fields.update({
+                            'title': row.title,
+                            'content': row.content,
+                            'metadata': {
+                                'doc_id': result.doc_id,
+                                'title': row.title,
+                                'file_path': row.file_path,
+                                'file_type': row.file_type
+                            },
+                            'file_path': row.file_path,
+                            'file_type': row.file_type,
+                            'created_at': row.created_at,
+                            'word_count': row.word_count
+                        })
+                result._fields = fields
+
+            # Todo cargado: no retener la página
+            self.results = ()
+        if self.system.result_cache is not None:
+            self.system.result_cache.reaccount(pending)
+
+class SearchPage(list):
+    """Página de resultados de search(): una lista con ``next_page_token``
+
+    ``next_page_token`` es None en la última página (o sin ``paginate``);
+    pasado a search() junto con la misma consulta devuelve la página
+    siguiente del mismo ranking.
+    """
+
+    __slots__ = ('next_page_token',)
+
+    def __init__(self, results: Iterable[SearchResult] = (), next_page_token: Optional[str] = None):
+        super().__init__(results)
+        self.next_page_token = next_page_token
+
+class _SearchCursor:
+    """Ranking de una búsqueda paginada y lo necesario para ampliarlo
+
+    ``results`` crece (SemanticSearchSystem._deepen) al pedir páginas más
+    allá de lo ya puntuado; ``exhausted`` indica que no hay más resultados.
+    """
+
+    __slots__ = ('cursor_id', 'query', 'version', 'results', 'page_size', 'mode', 'conditions',
+                 'depth', 'exhausted', 'lock')
+
+    def __init__(self, query: str, version: tuple, results: List[SearchResult], page_size: int,
+                 mode: str, conditions: List, depth: int):
+        self.cursor_id = uuid.uuid4().hex
+        self.query = query
+        self.version = version
+        self.results = results
+        self.page_size = page_size
+        self.mode = mode
+        self.conditions = conditions
+        self.depth = depth
+        self.exhausted = len(results) < depth
+        self.lock = threading.Lock()
+
+# =============================================================================
+# CLASE PRINCIPAL DEL SISTEMA
+# =============================================================================
+
+class _LazyDocuments(MutableMapping):
+    """Documents de LlamaIndex por doc_id que se construyen al primer acceso
+
+    load_index() registra solo los campos de cada fila SQL (add_row); el
+    Document se crea cuando se lee, así el arranque en caliente no valida
+    miles de modelos pydantic que quizá nunca se usen.
+    """
+
+    def __init__(self, factory: Callable[..., "Document"]):
+        self._factory = factory
+        self._items: Dict[str, Any] = {}
+
+    def add_row(self, doc_id: str, fields: tuple):
+        self._items[doc_id] = fields
+
+    def __getitem__(self, doc_id: str) -> "Document":
+        item = self._items[doc_id]
+        if isinstance(item, tuple):
+            item = self._items[doc_id] = self._factory(*item)
+        return item
+
+    def __setitem__(self, doc_id: str, document: "Document"):
+        self._items[doc_id] = document
+
+    def __delitem__(self, doc_id: str):
+        del self._items[doc_id]
+
+    def __contains__(self, doc_id: object) -> bool:
+        return doc_id in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+class SemanticSearchSystem:
+    """Sistema principal de búsqueda semántica"""
+
+    def __init__(self, db_path: str = "semantic_search.db", persist_index: bool = True,
+                 query_cache_size: int = QUERY_CACHE_SIZE, query_cache_ttl: Optional[float] = None,
+                 persist_query_cache: bool = False, vector_engine: str = "simple",
+                 engine_params: Optional[Dict] = None, async_logging: bool = True,
+                 log_queue_size: int = 10000, log_overflow_policy: str = "drop",
+                 store_stage_timings: bool = False, read_pool_size: int = READ_POOL_SIZE,
+                 chunk_cache: bool = True, embedding_model: str = None,
+                 result_cache_size: int = RESULT_CACHE_SIZE,
+                 result_cache_threshold: float = RESULT_CACHE_THRESHOLD,
+                 page_depth: int = SEARCH_PAGE_DEPTH):
+        """Inicializar el sistema
+
+        ``vector_engine`` elige el vector store: "simple" (SimpleVectorStore de
+        LlamaIndex), "flat" (exacto en NumPy), "hnsw" o "ivf" (aproximados).
+        ``engine_params`` se pasa al constructor del motor, p. ej.
+        ``{"ef_search": 100}`` para HNSW o ``{"nlist": 256, "nprobe": 16}`` para IVF.
+        Con ``async_logging`` las búsquedas se registran mediante un
+        SearchLogWriter en segundo plano en lugar de un commit por consulta.
+        Con ``store_stage_timings`` cada búsqueda registrada guarda además la
+        duración de sus etapas en las columnas de STAGE_COLUMNS.
+        SQLite se abre en modo WAL con un único escritor serializado
+        (``engine``) y ``read_pool_size`` conexiones de solo lectura
+        (``read_engine``), ver create_sqlite_engines().
+        Con ``chunk_cache`` los embeddings de fragmentos se guardan en SQLite
+        por hash de contenido y modelo, y no se recalculan al reingerir.
+        ``embedding_model`` fija el modelo del índice; por defecto es el de la
+        última migración completada o EMBEDDING_MODEL
+        (ver start_embedding_migration()).
+        ``result_cache_size`` y ``result_cache_threshold`` configuran la caché
+        semántica de resultados de search() (0 entradas la desactiva).
+        ``page_depth`` es el número de páginas que search(paginate=True)
+        puntúa de una vez para servir las siguientes con ``page_token``.
+        Las bases en memoria ("" o ":memory:") no tienen fichero junto al que
+        guardar el snapshot del índice: ``persist_index`` se ignora y nunca
+        arrancan en caliente.
+        """
+        if vector_engine != "simple" and vector_engine not in VECTOR_ENGINES:
+            raise ValueError(f"Motor vectorial desconocido: {vector_engine}")
+
+        self.db_path = db_path
+        self.in_memory = db_path in ("", ":memory:")
+        self.vector_engine = vector_engine
+        self.engine_params = engine_params or {}
+        with _startup_stage("database"):
+            self.engine, self.read_engine = create_sqlite_engines(db_path, read_pool_size)
+            Base.metadata.create_all(self.engine)
+            # create_all no añade columnas ni índices nuevos a tablas ya existentes
+            self._ensure_columns()
+            for model in (DocumentMetadata, SearchQuery, QueryEmbeddingCacheEntry):
+                for table_index in model.__table__.indexes:
+                    table_index.create(self.engine, checkfirst=True)
+            self.SessionLocal = sessionmaker(bind=self.engine)
+            self.ReadSessionLocal = sessionmaker(bind=self.read_engine)
+            self.fts_enabled = self._ensure_fts()
+            self._ensure_document_stats()
+            self._ensure_search_rollups()
+            self.embedding_model = embedding_model or self._active_embedding_model()
+
+        # Componentes de LlamaIndex: se crean bajo demanda
+        self._node_parser = None
+        self.vector_store = None
+        self.storage_context = None
+        self._index = None
+        self._documents: MutableMapping = _LazyDocuments(self._make_document)
+
+        # Versión del índice: cambia con cada escritura e invalida la matriz de scoring
+        self._index_version = 0
+        self._scoring_cache = None
+        self._doc_rows_cache = None
+
+        # Versión de los datos visibles por search(): cambia con cada escritura en
+        # SQL o en el índice e invalida la caché semántica de resultados
+        self._data_version = 0
+        self.result_cache = SemanticResultCache(
+            max_entries=result_cache_size, threshold=result_cache_threshold
+        ) if result_cache_size else None
+
+        # Rankings ya puntuados de búsquedas con más páginas, por id de cursor (LRU)
+        self.page_depth = max(1, page_depth)
+        self._cursors: "OrderedDict[str, _SearchCursor]" = OrderedDict()
+        self._cursor_lock = threading.Lock()
+
+        # Las escrituras en el índice activo y el cambio de modelo se serializan;
+        # las búsquedas no bloquean y repiten si coinciden con un cambio (_serving_generation)
+        self._index_lock = threading.RLock()
+        self._serving_generation = 0
+        self._migration: Optional[EmbeddingMigrationJob] = None
+
+        # Caché LRU de metadatos SQL por doc_id, invalidada en cada escritura
+        self._metadata_cache: "OrderedDict[str, Dict]" = OrderedDict()
+        self._metadata_lock = threading.Lock()
+
+        # Histogramas de latencia por etapa (get_metrics / prometheus_metrics)
+        self.metrics = StageMetrics()
+        self.store_stage_timings = store_stage_timings
+
+        # Caché de embeddings de consultas repetidas
+        self.query_cache = QueryEmbeddingCache(
+            max_size=query_cache_size,
+            ttl=query_cache_ttl,
+            session_factory=self.SessionLocal if persist_query_cache else None,
+            read_session_factory=self.ReadSessionLocal if persist_query_cache else None
+        )
+
+        # Caché persistente de embeddings de fragmentos por hash de contenido
+        self.chunk_cache = ChunkEmbeddingCache(
+            self.ReadSessionLocal, self.SessionLocal
+        ) if chunk_cache else None
+
+        # Registro de búsquedas diferido (write-behind)
+        self.search_log = SearchLogWriter(
+            self.SessionLocal,
+            max_queue_size=log_queue_size,
+            overflow_policy=log_overflow_policy
+        ) if async_logging else None
+
+        # Snapshot binario del índice junto al fichero SQLite
+        self.persist_index = persist_index and not self.in_memory
+        self.vectors_path = f"{db_path}.vectors.npy"
+        self.nodes_path = f"{db_path}.nodes.json"
+        self.docstore_path = f"{db_path}.docstore.json"
+        self._index_dirty = False
+
+        # El arranque en caliente se difiere hasta el primer acceso al índice
+        self._warm_start_pending = self.persist_index and os.path.exists(self.nodes_path)
+
+        logger.info(f"Sistema inicializado con base de datos: {db_path}")
+
+    def _active_embedding_model(self) -> str:
+        """Modelo de la última migración completada o, si no hay, EMBEDDING_MODEL"""
+        with self.get_read_session() as session:
+            row = session.query(EmbeddingMigrationRun.model_name).filter(
+                EmbeddingMigrationRun.status == "completed"
+            ).order_by(EmbeddingMigrationRun.completed_at.desc(), EmbeddingMigrationRun.id.desc()).first()
+        return row.model_name if row is not None else EMBEDDING_MODEL
+
+    @property
+    def embed_model(self):
+        """Modelo de embeddings con el que se sirve el índice activo"""
+        return get_embed_model(self.embedding_model)
+
+    @property
+    def index(self):
+        """Índice de LlamaIndex (carga el snapshot guardado en el primer acceso)"""
+        self._ensure_index_loaded()
+        return self._index
+
+    @index.setter
+    def index(self, value):
+        self._index = value
+
+    @property
+    def documents(self) -> Dict[str, "Document"]:
+        """Documentos conocidos por el índice, por doc_id"""
+        self._ensure_index_loaded()
+        return self._documents
+
+    @property
+    def node_parser(self):
+        """SentenceSplitter compartido por todas las rutas de ingesta"""
+        if self._node_parser is None:
+            _load_llama_index()
+            self._node_parser = SentenceSplitter(chunk_size=512, chunk_overlap=50)
+        return self._node_parser
+
+    def _ensure_index_loaded(self):
+        """Ejecutar el arranque en caliente pendiente, si lo hay"""
+        if self._warm_start_pending:
+            self._warm_start_pending = False
+            self.load_index()
+
+    def warmup(self) -> Dict[str, float]:
+        """Cargar ya LlamaIndex, el modelo de embeddings y el índice guardado
+
+        Útil en workers de búsqueda para no pagar la carga en la primera
+        petición. Devuelve el desglose de tiempos de arranque en ms.
+        """
+        embed_model = self.embed_model
+        if hasattr(embed_model, "load"):
+            embed_model.load()
+        self._ensure_index_loaded()
+        return get_startup_timings()
+
+    def get_db_session(self) -> Session:
+        """Obtener sesión de base de datos (escritura, serializada)"""
+        return self.SessionLocal()
+
+    def get_read_session(self) -> Session:
+        """Obtener sesión de solo lectura del pool de lectores"""
+        return self.ReadSessionLocal()
+
+    def _ensure_columns(self):
+        """Añadir las columnas que falten si la base es de una versión anterior
+
+        Si content_hash es nueva, se calcula para los documentos existentes.
+        """
+        added_columns = {
+            SearchQuery.__tablename__: {name: "FLOAT" for name in STAGE_COLUMNS.values()},
+            DocumentMetadata.__tablename__: {"content_hash": "VARCHAR(64)"}
+        }
+        inspector = inspect(self.engine)
+        for table_name, columns in added_columns.items():
+            existing = {col["name"] for col in inspector.get_columns(table_name)}
+            missing = [name for name in columns if name not in existing]
+            if not missing:
+                continue
+            with self.engine.begin() as conn:
+                for name in missing:
+                    conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {columns[name]}"))
+                if "content_hash" in missing:
+                    rows = conn.execute(text(f"SELECT doc_id, content FROM {table_name}")).all()
+                    if rows:
+                        conn.execute(
+                            text(f"UPDATE {table_name} SET content_hash = :content_hash WHERE doc_id = :doc_id"),
+                            [{"doc_id": row.doc_id, "content_hash": content_hash(row.content)} for row in rows]
+                        )
+            logger.info(f"Columnas añadidas a {table_name}: {missing}")
+
+    def _ensure_fts(self) -> bool:
+        """Crear el índice FTS5 y sus triggers; reconstruirlo si la tabla es nueva"""
+        try:
+            with self.engine.begin() as conn:
+                exists = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'document_fts'"
+                )).first() is not None
+                for statement in FTS_DDL:
+                    conn.execute(text(statement))
+                if not exists:
+                    # Indexar los documentos que ya existían antes del FTS
+                    conn.execute(text("INSERT INTO document_fts(document_fts) VALUES ('rebuild')"))
+            return True
+
+        except Exception as e:
+            logger.warning(f"FTS5 no disponible, búsqueda léxica desactivada: {e}")
+            return False
+
+    def _ensure_document_stats(self):
+        """Crear los triggers de document_stats; poblar la tabla si son nuevos"""
+        with self.engine.begin() as conn:
+            exists = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'document_stats_ai'"
+            )).first() is not None
+            for statement in DOCUMENT_STATS_DDL:
+                conn.execute(text(statement))
+            if not exists:
+                conn.execute(text("DELETE FROM document_stats"))
+                conn.execute(text(
+                    """INSERT INTO document_stats(file_type, documents, words)
+                       SELECT COALESCE(file_type, ''), COUNT(*), COALESCE(SUM(word_count), 0)
+                       FROM document_metadata GROUP BY COALESCE(file_type, '')"""
+                ))
+
+    def _ensure_search_rollups(self, batch_size: int = 5000):
+        """Construir una vez los agregados de búsquedas registradas antes de existir"""
+        with self.get_db_session() as session:
+            if session.get(SearchRollup, ("total", ROLLUP_TOTAL_BUCKET)) is not None:
+                return
+            if session.query(SearchQuery.id).first() is None:
+                return
+
+            columns = [SearchQuery.query_text, SearchQuery.timestamp, SearchQuery.results_count,
+                       SearchQuery.avg_similarity, SearchQuery.execution_time,
+                       *(getattr(SearchQuery, name) for name in STAGE_COLUMNS.values())]
+            result = session.execute(select(*columns).order_by(SearchQuery.id).execution_options(yield_per=batch_size))
+            total = 0
+            for partition in result.mappings().partitions():
+                rows = [dict(row) for row in partition]
+                update_search_rollups(session, rows)
+                total += len(rows)
+            session.commit()
+            logger.info(f"Agregados de búsqueda construidos a partir de {total} registros")
+
+    def _new_vector_store(self, docstore: "BaseDocumentStore" = None) -> tuple:
+        """Vector store vacío del motor configurado y su StorageContext
+
+        El motor cuantizado crea su fichero de re-ranking privado junto a la
+        base de datos (en el directorio temporal para ":memory:").
+        """
+        _load_llama_index()
+        if self.vector_engine == "simple":
+            vector_store = SimpleVectorStore()
+        else:
+            params = dict(self.engine_params)
+            if self.vector_engine == "quantized" and not self.in_memory:
+                params.setdefault("rerank_dir", os.path.dirname(os.path.abspath(self.db_path)))
+                params.setdefault("rerank_prefix", f"{os.path.basename(self.db_path)}.rerank-")
+            vector_store = NumpyVectorStore(VECTOR_ENGINES[self.vector_engine](**params))
+        return vector_store, StorageContext.from_defaults(vector_store=vector_store, docstore=docstore)
+
+    def _reset_vector_store(self, docstore: "BaseDocumentStore" = None):
+        """Crear un vector store vacío para una reconstrucción completa"""
+        if self.vector_store is not None and self.vector_engine != "simple":
+            self.vector_store.engine.close()
+        self.vector_store, self.storage_context = self._new_vector_store(docstore)
+
+    @staticmethod
+    def _make_document(doc_id: str, title: str, content: str,
+                       file_path: str = None, file_type: str = None,
+                       created_at: datetime = None) -> "Document":
+        """Crear el Document de LlamaIndex asociado a un documento"""
+        _load_llama_index()
+        return Document(
+            text=content,
+            doc_id=doc_id,
+            metadata={
+                "doc_id": doc_id,
+                "title": title,
+                "file_path": file_path,
+                "file_type": file_type,
+                "created_at": (created_at or datetime.now()).isoformat()
+            },
+            # doc_id y created_at no describen el contenido: incluirlos en el texto
+            # embebido alteraría los embeddings e impediría reutilizarlos por hash
+            excluded_embed_metadata_keys=["doc_id", "created_at"],
+            excluded_llm_metadata_keys=["doc_id"]
+        )
+
+    def _fetch_metadata(self, doc_ids: Iterable[str]) -> Dict[str, Dict]:
+        """Obtener los metadatos SQL de varios documentos con una sola consulta IN"""
+        found = {}
+        missing = []
+        with self._metadata_lock:
+            for doc_id in dict.fromkeys(doc_ids):
+                if doc_id in self._metadata_cache:
+                    self._metadata_cache.move_to_end(doc_id)
+                    found[doc_id] = self._metadata_cache[doc_id]
+                else:
+                    missing.append(doc_id)
+
+        if missing:
+            with self.get_read_session() as session:
+                rows = session.query(
+                    DocumentMetadata.doc_id,
+                    DocumentMetadata.file_path,
+                    DocumentMetadata.file_type,
+                    DocumentMetadata.created_at,
+                    DocumentMetadata.word_count
+                ).filter(DocumentMetadata.doc_id.in_(missing)).all()
+
+            with self._metadata_lock:
+                for row in rows:
+                    metadata = {
+                        'file_path': row.file_path,
+                        'file_type': row.file_type,
+                        'created_at': row.created_at,
+                        'word_count': row.word_count
+                    }
+                    found[row.doc_id] = metadata
+                    self._metadata_cache[row.doc_id] = metadata
+
+                while len(self._metadata_cache) > METADATA_CACHE_SIZE:
+                    self._metadata_cache.popitem(last=False)
+
+        return found
+
+    def _invalidate_metadata(self, doc_ids: Iterable[str]):
+        """Descartar de la caché los metadatos de documentos modificados"""
+        self._data_version += 1
+        with self._metadata_lock:
+            for doc_id in doc_ids:
+                self._metadata_cache.pop(doc_id, None)
+
+    @staticmethod
+    def _document_version(doc_metadata) -> str:
+        """Versión de un documento en el snapshot: su modelo y el content_hash guardado
+
+        Basta con las columnas doc_id, embedding_model y content_hash; los
+        cambios de título o tipo pasan por update_document(), que reindexa
+        el documento y marca el índice para volver a guardarse.
+        """
+        return f"{doc_metadata.embedding_model}:{doc_metadata.content_hash}"
+
+    @staticmethod
+    def _new_doc_id() -> str:
+        """Generar ID único para un documento (marca de tiempo + sufijo aleatorio)"""
+        return f"doc_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:12]}"
+
+    @staticmethod
+    def _dedup_key(title: str, file_path: Optional[str], digest: str) -> tuple:
+        """Identidad de un documento: su ruta o, sin ruta, título y hash del contenido"""
+        return ("path", file_path) if file_path else ("content", title, digest)
+
+    def _existing_documents(self, keys: Iterable[tuple], lookup_batch_size: int = 500) -> Dict[tuple, Any]:
+        """Documentos ya guardados para las claves de _dedup_key(), con consultas IN"""
+        keys = list(dict.fromkeys(keys))
+        paths = [key[1] for key in keys if key[0] == "path"]
+        digests = list(dict.fromkeys(key[2] for key in keys if key[0] == "content"))
+        columns = (DocumentMetadata.doc_id, DocumentMetadata.title, DocumentMetadata.file_path,
+                   DocumentMetadata.file_type, DocumentMetadata.content_hash)
+        found = {}
+        with self.get_read_session() as session:
+            for start in range(0, len(paths), lookup_batch_size):
+                for row in session.query(*columns).filter(
+                    DocumentMetadata.file_path.in_(paths[start:start + lookup_batch_size])
+                ):
+                    found[("path", row.file_path)] = row
+            for start in range(0, len(digests), lookup_batch_size):
+                for row in session.query(*columns).filter(
+                    DocumentMetadata.file_path.is_(None),
+                    DocumentMetadata.content_hash.in_(digests[start:start + lookup_batch_size])
+                ):
+                    found.setdefault(("content", row.title, row.content_hash), row)
+        return found
+
+    def _embed_nodes(self, nodes: List["BaseNode"], batch_size: int = EMBED_BATCH_SIZE,
+                     model_name: str = None) -> int:
+        """Calcular en lotes los embeddings de los nodos que aún no lo tienen
+
+        Con la caché de fragmentos activa, los nodos cuyo texto embebido ya
+        se calculó con el mismo modelo la reutilizan y solo se envían al
+        modelo los fragmentos nuevos (una vez por texto distinto).
+        ``model_name`` por defecto es el modelo del índice activo. Devuelve
+        el número de textos enviados al modelo.
+        """
+        embed_model = get_embed_model(model_name or self.embedding_model)
+        pending = [node for node in nodes if node.embedding is None]
+        if not pending:
+            return 0
+
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending]
+        if self.chunk_cache is None:
+            for start in range(0, len(pending), batch_size):
+                embeddings = embed_model.get_text_embedding_batch(texts[start:start + batch_size])
+                for node, embedding in zip(pending[start:start + batch_size], embeddings):
+                    node.embedding = embedding
+            return len(texts)
+
+        model_name = embed_model.model_name
+        hashes = [content_hash(text) for text in texts]
+        cached = self.chunk_cache.get_many(hashes, model_name)
+        missing = list(dict.fromkeys((digest, text) for digest, text in zip(hashes, texts) if digest not in cached))
+
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            embeddings = embed_model.get_text_embedding_batch([text for _, text in batch])
+            computed = {digest: embedding for (digest, _), embedding in zip(batch, embeddings)}
+            self.chunk_cache.put_many(computed, model_name)
+            cached.update(computed)
+
+        for node, digest in zip(pending, hashes):
+            node.embedding = cached[digest]
+        return len(missing)
+
+    def _embed_query(self, query: str) -> List[float]:
+        """Embedding de una consulta, reutilizando la caché si es posible"""
+        embed_model = self.embed_model
+        model_name = embed_model.model_name
+        embedding = self.query_cache.get(query, model_name)
+        if embedding is None:
+            embedding = embed_model.get_query_embedding(query)
+            self.query_cache.put(query, model_name, embedding)
+        return embedding
+
+    def _embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Embeddings normalizados de varias consultas
+
+        Las que faltan en la caché se calculan juntas, en una llamada al
+        modelo, como embeddings de consulta (ver _query_embedding_batch): los
+        modelos con instrucción o prefijo de consulta la aplican, igual que en
+        _embed_query(), y la caché compartida nunca guarda embeddings de texto.
+        """
+        embed_model = self.embed_model
+        model_name = embed_model.model_name
+        embeddings = [self.query_cache.get(query, model_name) for query in queries]
+
+        missing = list(dict.fromkeys(q for q, e in zip(queries, embeddings) if e is None))
+        if missing:
+            computed = dict(zip(missing, _query_embedding_batch(embed_model, missing)))
+            for query, embedding in computed.items():
+                self.query_cache.put(query, model_name, embedding)
+            embeddings = [computed[q] if e is None else e for q, e in zip(queries, embeddings)]
+
+        return _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+
+    def _bump_index_version(self):
+        """Registrar una escritura en el índice"""
+        self._index_version += 1
+        self._data_version += 1
+        self._index_dirty = True
+
+    def _scoring_matrix(self):
+        """IDs de nodos y matriz normalizada para scoring exacto, cacheada por versión"""
+        version = self._index_version
+        if self._scoring_cache is None or self._scoring_cache[0] != version:
+            # Versión leída antes de copiar: una escritura simultánea invalida la copia
+            node_ids, matrix = self._node_embeddings()
+            matrix = _normalize_rows(matrix) if len(matrix) else matrix
+            self._scoring_cache = (version, np.asarray(node_ids, dtype=object), matrix)
+        return self._scoring_cache[1], self._scoring_cache[2]
+
+    def _candidate_rows(self, doc_ids: Iterable[str]) -> np.ndarray:
+        """Filas de la matriz de scoring que pertenecen a los documentos dados"""
+        version = self._index_version
+        if self._doc_rows_cache is None or self._doc_rows_cache[0] != version:
+            node_ids, _ = self._scoring_matrix()
+            node_to_doc = self.vector_store.data.text_id_to_ref_doc_id
+            doc_rows: Dict[str, List[int]] = {}
+            for row, node_id in enumerate(node_ids.tolist()):
+                doc_rows.setdefault(node_to_doc.get(node_id), []).append(row)
+            self._doc_rows_cache = (version, doc_rows)
+
+        doc_rows = self._doc_rows_cache[1]
+        rows = [row for doc_id in doc_ids for row in doc_rows.get(doc_id, ())]
+        return np.asarray(rows, dtype=np.int64)
+
+    def _retrieve(self, query: str, top_k: int, candidate_doc_ids: List[str] = None,
+                  timings: Dict[str, float] = None) -> List[tuple]:
+        """Top-k (node_id, score) de una consulta, opcionalmente solo entre ciertos documentos
+
+        Con candidatos, la similitud se calcula únicamente sobre sus nodos: los
+        motores NumPy lo hacen a partir del filtro doc_ids y con
+        SimpleVectorStore se puntúan las filas candidatas de la matriz de scoring
+        (o la matriz entera sin filtros, como en search_many()).
+        Los nodos no se leen del docstore aquí, sino al acceder a los resultados.
+        """
+        def retrieve():
+            with self.metrics.timer("search", "embed", timings):
+                embedding = self._embed_query(query)
+
+            with self.metrics.timer("search", "retrieve", timings):
+                if isinstance(self.vector_store, NumpyVectorStore):
+                    result = self.vector_store.query(VectorStoreQuery(
+                        query_embedding=embedding, similarity_top_k=top_k, doc_ids=candidate_doc_ids
+                    ))
+                    return list(zip(result.ids, result.similarities))
+
+                node_ids, matrix = self._scoring_matrix()
+                query_vector = _normalize_rows(np.asarray(embedding, dtype=np.float32))
+                if candidate_doc_ids is None:
+                    scores = matrix @ query_vector if len(node_ids) else np.empty(0, dtype=np.float32)
+                    top = _top_k(scores, top_k)
+                    return list(zip(node_ids[top].tolist(), scores[top].tolist()))
+
+                rows = self._candidate_rows(candidate_doc_ids)
+                scores = matrix[rows] @ query_vector
+                top = _top_k(scores, top_k)
+                return list(zip(node_ids[rows[top]].tolist(), scores[top].tolist()))
+
+        return self._consistent(retrieve)
+
+    def _node_doc_ids(self) -> Dict[str, str]:
+        """doc_id de cada nodo del vector store activo"""
+        if isinstance(self.vector_store, NumpyVectorStore):
+            return self.vector_store.node_doc_ids
+        return self.vector_store.data.text_id_to_ref_doc_id
+
+    def _consistent(self, compute: Callable[[], Any]) -> Any:
+        """Ejecutar ``compute`` con el modelo y el índice de un mismo corte
+
+        Lectura optimista (tipo seqlock): si un cambio de modelo ocurre
+        durante el cálculo, _serving_generation cambia y se repite con el
+        índice nuevo; las búsquedas nunca esperan al migrador.
+        """
+        while True:
+            generation = self._serving_generation
+            if generation % 2:
+                time.sleep(0.001)
+                continue
+            try:
+                result = compute()
+            except Exception:
+                if self._serving_generation != generation:
+                    continue
+                raise
+            if self._serving_generation == generation:
+                return result
+
+    @staticmethod
+    def _filter_conditions(file_type: Union[str, List[str]] = None, created_after: datetime = None,
+                           created_before: datetime = None, path_prefix: str = None) -> List:
+        """Condiciones SQL sobre DocumentMetadata para los filtros de búsqueda"""
+        conditions = []
+        if file_type is not None:
+            file_types = [file_type] if isinstance(file_type, str) else list(file_type)
+            conditions.append(DocumentMetadata.file_type.in_(file_types))
+        if created_after is not None:
+            conditions.append(DocumentMetadata.created_at >= created_after)
+        if created_before is not None:
+            conditions.append(DocumentMetadata.created_at < created_before)
+        if path_prefix:
+            # Rango en lugar de LIKE para que SQLite use el índice de file_path
+            upper = path_prefix[:-1] + chr(ord(path_prefix[-1]) + 1)
+            conditions.append(DocumentMetadata.file_path >= path_prefix)
+            conditions.append(DocumentMetadata.file_path < upper)
+        return conditions
+
+    @staticmethod
+    def _result_cache_key(mode: str, depth: int, file_type: Union[str, List[str]] = None,
+                          created_after: datetime = None, created_before: datetime = None,
+                          path_prefix: str = None) -> tuple:
+        """Parámetros de search() que deben coincidir para reutilizar resultados"""
+        if file_type is not None:
+            file_type = tuple(sorted([file_type] if isinstance(file_type, str) else file_type))
+        return (mode, depth, file_type, created_after, created_before, path_prefix)
+
+    def _candidate_doc_ids(self, conditions: List) -> List[str]:
+        """Resolver los filtros contra SQL en el conjunto de doc_id candidatos"""
+        with self.get_read_session() as session:
+            return [row.doc_id for row in session.query(DocumentMetadata.doc_id).filter(*conditions)]
+
+    def _score_queries(self, query_vectors: np.ndarray, top_k: int) -> List[List[tuple]]:
+        """Top-k (node_id, score) por consulta
+
+        Con motores exactos se hace un único producto matricial por bloque de
+        consultas y argpartition por fila; los motores aproximados y los
+        que puntúan fuera del proceso (sharded) reciben el bloque entero.
+        """
+        if isinstance(self.vector_store, NumpyVectorStore) and not (
+            self.vector_store.engine.exact and self.vector_store.engine.in_process
+        ):
+            return self.vector_store.query_batch(query_vectors, top_k)
+
+        node_ids, matrix = self._scoring_matrix()
+        k = min(top_k, len(node_ids))
+        if k == 0:
+            return [[] for _ in query_vectors]
+
+        hits = []
+        block = max(1, SCORE_BLOCK_CELLS // len(node_ids))
+        for start in range(0, len(query_vectors), block):
+            top, top_scores = _rows_top_k(query_vectors[start:start + block] @ matrix.T, k)
+            hits.extend(
+                list(zip(node_ids[row].tolist(), row_scores.tolist()))
+                for row, row_scores in zip(top, top_scores)
+            )
+        return hits
+
+    def _index_nodes(self, nodes: List["BaseNode"]):
+        """Insertar nodos ya embebidos, creando el índice si todavía no existe"""
+        with self._index_lock:
+            if self.index is None:
+                self._reset_vector_store()
+                self.index = VectorStoreIndex(nodes, storage_context=self.storage_context)
+            else:
+                self.index.insert_nodes(nodes)
+            self._bump_index_version()
+
+    def _document_nodes(self, document: "Document") -> List["BaseNode"]:
+        """Trocear un documento y embeber sus nodos, sin tocar el índice"""
+        with self.metrics.timer("ingest", "parse"):
+            nodes = self.node_parser.get_nodes_from_documents([document])
+        with self.metrics.timer("ingest", "embed"):
+            self._embed_nodes(nodes)
+        return nodes
+
+    def _index_document(self, document: "Document") -> int:
+        """Trocear un documento e insertar solo sus nodos en el índice activo"""
+        nodes = self._document_nodes(document)
+        with self.metrics.timer("ingest", "index"), self._index_lock:
+            self.index.insert_nodes(nodes)
+            self._bump_index_version()
+        return len(nodes)
+
+    def _indexed_node_ids(self, doc_ids: Iterable[str]) -> List[str]:
+        """node_id de los nodos indexados de los documentos dados (llamar con _index_lock)"""
+        node_ids = []
+        for doc_id in doc_ids:
+            ref_doc = self.index.docstore.get_ref_doc_info(doc_id)
+            if ref_doc is not None:
+                node_ids.extend(ref_doc.node_ids)
+        return node_ids
+
+    def _reindex_document(self, document: "Document") -> int:
+        """Sustituir en el índice activo los nodos de un documento
+
+        Los nodos nuevos se embeben antes de tomar _index_lock; con el lock
+        tomado una sola vez se insertan y después se borran los antiguos, así
+        que una búsqueda concurrente nunca encuentra el documento sin nodos.
+        Como en el cambio de modelo, _serving_generation es impar mientras
+        tanto y search() repite si coincide con la sustitución.
+        """
+        nodes = self._document_nodes(document)
+        with self.metrics.timer("ingest", "index"), self._index_lock:
+            old_ids = self._indexed_node_ids([document.doc_id])
+            self._serving_generation += 1
+            try:
+                self.index.insert_nodes(nodes)
+                if old_ids:
+                    self.index.delete_nodes(old_ids, delete_from_docstore=True)
+                self._bump_index_version()
+            finally:
+                self._serving_generation += 1
+        return len(nodes)
+
+    def _unindex_document(self, doc_id: str):
+        """Eliminar del índice activo los nodos de un documento"""
+        with self._index_lock:
+            self.index.delete_ref_doc(doc_id, delete_from_docstore=True)
+            self._bump_index_version()
+
+    def add_document(self, title: str, content: str, file_path: str = None,
+                    file_type: str = None) -> str:
+        """Agregar un documento al sistema
+
+        Si el índice ya está construido, solo se trocean y embeben los nodos
+        del nuevo documento en lugar de reconstruir todo el índice.
+        Un documento con la misma ruta (o, sin ruta, el mismo título y
+        contenido) no se duplica: si no ha cambiado se devuelve su doc_id y
+        si ha cambiado se actualiza con update_document().
+        """
+        try:
+            start_time = time.perf_counter()
+            digest = content_hash(content)
+
+            key = self._dedup_key(title, file_path, digest)
+            existing = self._existing_documents([key]).get(key)
+            if existing is not None:
+                if (existing.content_hash, existing.title, existing.file_type) == (digest, title, file_type):
+                    logger.info(f"Documento sin cambios: {existing.doc_id}")
+                    return existing.doc_id
+                return self.update_document(existing.doc_id, title=title, content=content, file_type=file_type)
+
+            # Generar ID único para el documento
+            doc_id = self._new_doc_id()
+
+            # Crear documento de LlamaIndex
+            document = self._make_document(doc_id, title, content, file_path, file_type)
+
+            self.documents[doc_id] = document
+
+            # Guardar metadatos en SQL
+            with self.metrics.timer("ingest", "sql"), self.get_db_session() as session:
+                doc_metadata = DocumentMetadata(
+                    doc_id=doc_id,
+                    title=title,
+                    content=content,
+                    file_path=file_path,
+                    file_type=file_type,
+                    word_count=len(content.split()),
+                    embedding_model=self.embedding_model,
+                    content_hash=digest
+                )
+                session.add(doc_metadata)
+                session.commit()
+
+            self._invalidate_metadata([doc_id])
+
+            if self.index is not None:
+                num_nodes = self._index_document(document)
+                logger.info(f"Documento {doc_id} indexado con {num_nodes} nodos")
+
+            self.metrics.observe("ingest", "total", time.perf_counter() - start_time)
+
+            logger.info(f"Documento agregado: {doc_id}")
+            return doc_id
+
+        except Exception as e:
+            logger.error(f"Error al agregar documento: {e}")
+            raise
+
+    def add_documents(self, documents: Iterable[Dict], batch_size: int = 1000,
+                      embed_batch_size: int = EMBED_BATCH_SIZE,
+                      progress_callback: Callable[[Dict], None] = None) -> List[str]:
+        """Agregar documentos en bloque
+
+        Consume ``documents`` (diccionarios con ``title``, ``content`` y
+        opcionalmente ``file_path`` y ``file_type``) en lotes de
+        ``batch_size``: cada lote se inserta en SQL con una única transacción y
+        sus fragmentos se embeben en llamadas de ``embed_batch_size`` nodos.
+        Al terminar, el índice queda construido e incluye los nuevos documentos.
+        Como en add_document(), los documentos ya guardados y sin cambios
+        devuelven su doc_id y los modificados se actualizan en su lugar.
+        El progreso y el rendimiento (docs/s, chunks/s) se registran por lote y
+        se pasan a ``progress_callback`` si se indica.
+        """
+        try:
+            # Indexar primero lo pendiente de add_document() para no perderlo
+            if self.index is None and self.documents:
+                self.build_index()
+
+            start_time = time.perf_counter()
+            doc_ids = []
+            total_chunks = 0
+            iterator = iter(documents)
+
+            while True:
+                batch = list(islice(iterator, batch_size))
+                if not batch:
+                    break
+
+                digests = [content_hash(doc["content"]) for doc in batch]
+                keys = [self._dedup_key(doc["title"], doc.get("file_path"), digest)
+                        for doc, digest in zip(batch, digests)]
+                existing = self._existing_documents(keys)
+
+                rows = []
+                batch_documents = []
+                batch_ids = []
+                seen = {}
+                for doc, digest, key in zip(batch, digests, keys):
+                    if key in seen:
+                        # Repetido dentro del mismo lote: cuenta como el primero
+                        batch_ids.append(seen[key])
+                        continue
+                    if key in existing:
+                        row = existing[key]
+                        if (row.content_hash, row.title, row.file_type) != (digest, doc["title"], doc.get("file_type")):
+                            self.update_document(row.doc_id, title=doc["title"], content=doc["content"],
+                                                 file_type=doc.get("file_type"))
+                        seen[key] = row.doc_id
+                        batch_ids.append(row.doc_id)
+                        continue
+
+                    doc_id = self._new_doc_id()
+                    seen[key] = doc_id
+                    batch_ids.append(doc_id)
+                    document = self._make_document(
+                        doc_id, doc["title"], doc["content"],
+                        doc.get("file_path"), doc.get("file_type")
+                    )
+                    self.documents[doc_id] = document
+                    batch_documents.append(document)
+                    rows.append({
+                        "doc_id": doc_id,
+                        "title": doc["title"],
+                        "content": doc["content"],
+                        "file_path": doc.get("file_path"),
+                        "file_type": doc.get("file_type"),
+                        "word_count": len(doc["content"].split()),
+                        "embedding_model": self.embedding_model,
+                        "content_hash": digest
+                    })
+
+                doc_ids.extend(batch_ids)
+                if not rows:
+                    continue
+
+                # Una sola transacción con inserción masiva por lote
+                batch_start = time.perf_counter()
+                with self.metrics.timer("bulk_ingest", "sql"), self.get_db_session() as session:
+                    session.execute(insert(DocumentMetadata), rows)
+                    session.commit()
+                self._invalidate_metadata(row["doc_id"] for row in rows)
+
+                with self.metrics.timer("bulk_ingest", "parse"):
+                    nodes = self.node_parser.get_nodes_from_documents(batch_documents)
+                with self.metrics.timer("bulk_ingest", "embed"):
+                    self._embed_nodes(nodes, batch_size=embed_batch_size)
+                with self.metrics.timer("bulk_ingest", "index"):
+                    self._index_nodes(nodes)
+                self.metrics.observe("bulk_ingest", "batch", time.perf_counter() - batch_start)
+
+                total_chunks += len(nodes)
+
+                elapsed = time.perf_counter() - start_time
+                progress = {
+                    "documents": len(doc_ids),
+                    "chunks": total_chunks,
+                    "elapsed": elapsed,
+                    "docs_per_s": len(doc_ids) / elapsed if elapsed else 0.0,
+                    "chunks_per_s": total_chunks / elapsed if elapsed else 0.0
+                }
+                logger.info(
+                    f"Ingesta: {progress['documents']} documentos, {progress['chunks']} fragmentos "
+                    f"({progress['docs_per_s']:.1f} docs/s, {progress['chunks_per_s']:.1f} chunks/s)"
+                )
+                if progress_callback:
+                    progress_callback(progress)
+
+            if doc_ids and self.persist_index:
+                self.save_index()
+
+            return doc_ids
+
+        except Exception as e:
+            logger.error(f"Error al agregar documentos en bloque: {e}")
+            raise
+
+    def ingest_directory(self, path: str, patterns: Iterable[str] = DEFAULT_INGEST_PATTERNS,
+                         recursive: bool = True, workers: int = None, batch_size: int = 256,
+                         embed_batch_size: int = EMBED_BATCH_SIZE, queue_size: int = 4,
+                         progress_callback: Callable[[Dict], None] = None) -> Dict:
+        """Ingerir en streaming los ficheros de un directorio
+
+        Pipeline de cuatro etapas unidas por colas acotadas:
+
+        1. el hilo llamante recorre ``path`` y envía los ficheros que casan
+           con ``patterns`` a un pool de ``workers`` procesos (por defecto uno
+           por núcleo; hilos si se ejecuta desde un notebook, ver
+           _worker_context), con un número limitado de tareas en vuelo;
+        2. los procesos leen, decodifican y trocean con SentenceSplitter;
+        3. un hilo agrupa ``batch_size`` documentos y calcula sus embeddings;
+        4. un hilo escritor inserta cada lote en SQL con una transacción y
+           añade sus nodos al índice.
+
+        Cuando una etapa va más lenta, su cola se llena y frena a las
+        anteriores, así que la memoria del pipeline no depende del tamaño del
+        corpus. Los ficheros ya ingeridos conservan su doc_id: si su hash no
+        ha cambiado no se trocean ni embeben, y si ha cambiado se actualizan
+        reutilizando los embeddings de los fragmentos intactos. Devuelve un
+        resumen con ficheros, documentos, actualizados, sin cambios,
+        fragmentos, omitidos (vacíos), errores y rendimiento.
+        """
+        if not os.path.isdir(path):
+            raise ValueError(f"No es un directorio: {path}")
+
+        # Indexar primero lo pendiente de add_document() para no perderlo
+        if self.index is None and self.documents:
+            self.build_index()
+
+        workers = workers or os.cpu_count() or 1
+        chunk_size, chunk_overlap = self.node_parser.chunk_size, self.node_parser.chunk_overlap
+        parsed: "queue.Queue" = queue.Queue(maxsize=queue_size * batch_size)
+        embedded: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        failed = threading.Event()
+        stage_errors: List[BaseException] = []
+        summary = {'files': 0, 'documents': 0, 'updated': 0, 'unchanged': 0,
+                   'chunks': 0, 'skipped': 0, 'errors': []}
+        start_time = time.perf_counter()
+
+        # doc_id y hash de lo ya ingerido bajo este directorio, con una sola consulta
+        with self.get_read_session() as session:
+            known = {
+                row.file_path: (row.doc_id, row.content_hash or "")
+                for row in session.query(
+                    DocumentMetadata.file_path, DocumentMetadata.doc_id, DocumentMetadata.content_hash
+                ).filter(*self._filter_conditions(path_prefix=str(Path(path))))
+            }
+
+        def embed_stage():
+            batch = []
+            while True:
+                item = parsed.get()
+                if item is not None:
+                    batch.append(item)
+                    if len(batch) < batch_size:
+                        continue
+                if batch and not failed.is_set():
+                    try:
+                        nodes = [node for result in batch for node in result['nodes']]
+                        with self.metrics.timer("ingest_directory", "embed"):
+                            self._embed_nodes(nodes, batch_size=embed_batch_size)
+                        embedded.put((batch, nodes))
+                    except BaseException as e:
+                        stage_errors.append(e)
+                        failed.set()
+                batch = []
+                if item is None:
+                    embedded.put(None)
+                    return
+
+        def write_stage():
+            while True:
+                item = embedded.get()
+                if item is None:
+                    return
+                if failed.is_set():
+                    continue
+                batch, nodes = item
+                try:
+                    rows = [result['row'] for result in batch]
+                    for row in rows:
+                        row["embedding_model"] = self.embedding_model
+                    new_rows = [result['row'] for result in batch if not result['update']]
+                    updated_rows = [result['row'] for result in batch if result['update']]
+                    with self.metrics.timer("ingest_directory", "sql"), self.get_db_session() as session:
+                        if new_rows:
+                            session.execute(insert(DocumentMetadata), new_rows)
+                        if updated_rows:
+                            # UPDATE masivo por doc_id: se conserva created_at
+                            documents_table = DocumentMetadata.__table__
+                            session.execute(
+                                update(documents_table).where(documents_table.c.doc_id == bindparam("match_doc_id")),
+                                [{**row, "match_doc_id": row["doc_id"]} for row in updated_rows]
+                            )
+                        session.commit()
+                    for row in rows:
+                        self.documents[row["doc_id"]] = self._make_document(
+                            row["doc_id"], row["title"], row["content"], row["file_path"], row["file_type"]
+                        )
+                    self._invalidate_metadata(row["doc_id"] for row in rows)
+                    with self.metrics.timer("ingest_directory", "index"), self._index_lock:
+                        # Como en _reindex_document(): los nodos antiguos se borran tras insertar los nuevos
+                        old_ids = (self._indexed_node_ids(row["doc_id"] for row in updated_rows)
+                                   if self.index is not None else [])
+                        self._index_nodes(nodes)
+                        if old_ids:
+                            self.index.delete_nodes(old_ids, delete_from_docstore=True)
+                            self._bump_index_version()
+
+                    summary['documents'] += len(new_rows)
+                    summary['updated'] += len(updated_rows)
+                    summary['chunks'] += len(nodes)
+                    elapsed = time.perf_counter() - start_time
+                    progress = {
+                        "files": summary['files'],
+                        "documents": summary['documents'],
+                        "chunks": summary['chunks'],
+                        "elapsed": elapsed,
+                        "docs_per_s": summary['documents'] / elapsed if elapsed else 0.0,
+                        "chunks_per_s": summary['chunks'] / elapsed if elapsed else 0.0
+                    }
+                    logger.info(
+                        f"Ingesta de {path}: {progress['documents']} documentos, {progress['chunks']} fragmentos "
+                        f"({progress['docs_per_s']:.1f} docs/s, {progress['chunks_per_s']:.1f} chunks/s)"
+                    )
+                    if progress_callback:
+                        progress_callback(progress)
+                except BaseException as e:
+                    stage_errors.append(e)
+                    failed.set()
+
+        def collect(future):
+            result = future.result()
+            if 'error' in result:
+                logger.warning(f"No se pudo ingerir {result['path']}: {result['error']}")
+                summary['errors'].append({'path': result['path'], 'error': result['error']})
+            elif result.get('skipped'):
+                summary['skipped'] += 1
+            elif result.get('unchanged'):
+                summary['unchanged'] += 1
+            else:
+                self.metrics.observe("ingest_directory", "parse", result['parse_time'])
+                parsed.put(result)
+
+        threads = [threading.Thread(target=embed_stage, name="ingest-embed", daemon=True),
+                   threading.Thread(target=write_stage, name="ingest-write", daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        # Sin fork: los hilos de las etapas ya están en marcha (ver _worker_context)
+        context = _worker_context()
+        in_flight = deque()
+        try:
+            with (ProcessPoolExecutor(max_workers=workers, mp_context=context) if context is not None
+                  else ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-parse")) as pool:
+                for file_path in _iter_files(path, patterns, recursive):
+                    if failed.is_set():
+                        break
+                    summary['files'] += 1
+                    doc_id, previous_hash = known.get(str(file_path), (self._new_doc_id(), None))
+                    task = (doc_id, str(file_path), chunk_size, chunk_overlap, previous_hash)
+                    in_flight.append(pool.submit(_parse_file, task))
+                    # Tareas en vuelo acotadas: se recogen en orden de envío
+                    if len(in_flight) >= 2 * workers:
+                        collect(in_flight.popleft())
+                while in_flight:
+                    collect(in_flight.popleft())
+        finally:
+            for future in in_flight:
+                future.cancel()
+            parsed.put(None)
+            for thread in threads:
+                thread.join()
+
+        if stage_errors:
+            logger.error(f"Error en la ingesta de {path}: {stage_errors[0]}")
+            raise stage_errors[0]
+
+        if (summary['documents'] or summary['updated']) and self.persist_index:
+            self.save_index()
+
+        elapsed = time.perf_counter() - start_time
+        summary['elapsed'] = round(elapsed, 3)
+        summary['docs_per_s'] = round(summary['documents'] / elapsed, 1) if elapsed else 0.0
+        summary['chunks_per_s'] = round(summary['chunks'] / elapsed, 1) if elapsed else 0.0
+        logger.info(f"Ingesta de {path} completada: {summary['documents']} documentos en {elapsed:.2f}s")
+        return summary
+
+    def update_document(self, doc_id: str, title: str = None, content: str = None,
+                        file_path: str = None, file_type: str = None) -> str:
+        """Actualizar un documento existente y reindexar solo sus nodos
+
+        Los fragmentos que no cambian se reutilizan desde la caché de
+        embeddings, así que solo se embeben los editados. Los nodos se
+        sustituyen tras confirmar el cambio en SQL (ver _reindex_document()).
+        """
+        try:
+            with self.get_db_session() as session:
+                doc_metadata = session.query(DocumentMetadata).filter(
+                    DocumentMetadata.doc_id == doc_id
+                ).first()
+
+                if doc_metadata is None:
+                    raise ValueError(f"Documento no encontrado: {doc_id}")
+
+                if title is not None:
+                    doc_metadata.title = title
+                if content is not None:
+                    doc_metadata.content = content
+                    doc_metadata.word_count = len(content.split())
+                    doc_metadata.content_hash = content_hash(content)
+                if file_path is not None:
+                    doc_metadata.file_path = file_path
+                if file_type is not None:
+                    doc_metadata.file_type = file_type
+                doc_metadata.embedding_model = self.embedding_model
+
+                document = self._make_document(
+                    doc_id,
+                    doc_metadata.title,
+                    doc_metadata.content,
+                    doc_metadata.file_path,
+                    doc_metadata.file_type
+                )
+                session.commit()
+
+            self.documents[doc_id] = document
+            self._invalidate_metadata([doc_id])
+
+            if self.index is not None:
+                num_nodes = self._reindex_document(document)
+                logger.info(f"Documento {doc_id} reindexado con {num_nodes} nodos")
+
+            logger.info(f"Documento actualizado: {doc_id}")
+            return doc_id
+
+        except Exception as e:
+            logger.error(f"Error al actualizar documento: {e}")
+            raise
+
+    def delete_document(self, doc_id: str) -> bool:
+        """Eliminar un documento de la base de datos y del índice"""
+        try:
+            with self.get_db_session() as session:
+                deleted = session.query(DocumentMetadata).filter(
+                    DocumentMetadata.doc_id == doc_id
+                ).delete()
+                session.commit()
+
+            known = self.documents.pop(doc_id, None) is not None
+            self._invalidate_metadata([doc_id])
+
+            if self.index is not None and (deleted or known):
+                self._unindex_document(doc_id)
+
+            if deleted or known:
+                logger.info(f"Documento eliminado: {doc_id}")
+                return True
+
+            logger.warning(f"Documento no encontrado: {doc_id}")
+            return False
+
+        except Exception as e:
+            logger.error(f"Error al eliminar documento: {e}")
+            raise
+
+    def build_index(self):
+        """Construir el índice de vectores desde cero
+
+        Para cambios puntuales use add_document(), update_document() o
+        delete_document(), que actualizan el índice de forma incremental.
+        """
+        try:
+            if not self.documents:
+                logger.warning("No hay documentos para indexar")
+                return
+
+            start_time = time.perf_counter()
+
+            # Parsear documentos en nodos y embeberlos en lotes
+            with self.metrics.timer("build_index", "parse"):
+                nodes = self.node_parser.get_nodes_from_documents(list(self.documents.values()))
+            with self.metrics.timer("build_index", "embed"):
+                self._embed_nodes(nodes)
+
+            # Crear índice sobre un vector store vacío para no duplicar nodos
+            with self.metrics.timer("build_index", "index"), self._index_lock:
+                self._reset_vector_store()
+                self.index = VectorStoreIndex(
+                    nodes,
+                    storage_context=self.storage_context
+                )
+                self._index_version += 1
+                self._data_version += 1
+            self.metrics.observe("build_index", "total", time.perf_counter() - start_time)
+
+            logger.info(f"Índice construido con {len(nodes)} nodos")
+
+            if self.persist_index:
+                self.save_index()
+
+        except Exception as e:
+            logger.error(f"Error al construir índice: {e}")
+            raise
+
+    def save_index(self, lookup_batch_size: int = 500):
+        """Guardar embeddings, tabla de nodos y docstore junto a la base de datos
+
+        Los embeddings se escriben como una matriz float32 (.npy) que se abre
+        con memory-mapping al cargar; la tabla de nodos guarda, por fila, el
+        id del nodo y el de su documento, y el docstore de LlamaIndex se guarda tal cual
+        (ya serializado) para no reconstruir los nodos al arrancar.
+        """
+        if self.index is None:
+            logger.warning("No hay índice que guardar")
+            return
+
+        try:
+            node_ids, matrix = self._node_embeddings()
+            node_docs = self._node_doc_ids()
+            doc_ids = list(dict.fromkeys(node_docs[node_id] for node_id in node_ids))
+
+            versions = {}
+            with self.get_read_session() as session:
+                for start in range(0, len(doc_ids), lookup_batch_size):
+                    for row in session.query(
+                        DocumentMetadata.doc_id, DocumentMetadata.embedding_model, DocumentMetadata.content_hash
+                    ).filter(DocumentMetadata.doc_id.in_(doc_ids[start:start + lookup_batch_size])):
+                        versions[row.doc_id] = self._document_version(row)
+
+            # Escritura atómica: primero a ficheros temporales y luego rename
+            with open(self.vectors_path + ".tmp", "wb") as f:
+                np.save(f, matrix)
+            self.index.docstore.persist(self.docstore_path + ".tmp")
+            with open(self.nodes_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({
+                    "embedding_model": self.embedding_model,
+                    "documents": versions,
+                    "node_ids": node_ids,
+                    "doc_ids": [node_docs[node_id] for node_id in node_ids]
+                }, f)
+            os.replace(self.vectors_path + ".tmp", self.vectors_path)
+            os.replace(self.docstore_path + ".tmp", self.docstore_path)
+            os.replace(self.nodes_path + ".tmp", self.nodes_path)
+
+            self._index_dirty = False
+            logger.info(f"Índice guardado con {len(node_ids)} nodos en {self.vectors_path}")
+
+        except Exception as e:
+            logger.error(f"Error al guardar índice: {e}")
+            raise
+
+    def load_index(self):
+        """Cargar el índice guardado y reindexar solo lo ausente o desactualizado
+
+        Los documentos se restauran desde SQL. Los nodos de documentos sin
+        cambios se recuperan del docstore guardado y sus embeddings pasan
+        directamente de la matriz mapeada al vector store, sin construir
+        TextNode ni listas de Python; el resto se trocea y embebe de nuevo.
+        Los Document se crean al primer acceso (_LazyDocuments). Las
+        instantáneas antiguas sin docstore reconstruyen los nodos a partir de
+        los offsets guardados (una sola vez: se vuelven a guardar).
+        """
+        self._warm_start_pending = False
+        try:
+            start_time = time.perf_counter()
+            _load_llama_index()
+
+            with open(self.nodes_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            matrix = np.load(self.vectors_path, mmap_mode="r")
+            # Formato actual: listas paralelas; las instantáneas antiguas traen "nodes"
+            entries = snapshot.get("nodes", [])
+            node_id_column = snapshot.get("node_ids", [entry["node_id"] for entry in entries])
+            doc_id_column = snapshot.get("doc_ids", [entry["doc_id"] for entry in entries])
+            docstore = (SimpleDocumentStore.from_persist_path(self.docstore_path)
+                        if os.path.exists(self.docstore_path) else None)
+
+            same_model = snapshot.get("embedding_model") == self.embedding_model
+            saved_versions = snapshot.get("documents", {})
+            saved_nodes: Dict[str, List[int]] = {}
+            for row, doc_id in enumerate(doc_id_column):
+                saved_nodes.setdefault(doc_id, []).append(row)
+
+            rows = []
+            stale_documents = []
+            with self.get_read_session() as session:
+                document_rows = session.query(
+                    DocumentMetadata.doc_id,
+                    DocumentMetadata.title,
+                    DocumentMetadata.content,
+                    DocumentMetadata.file_path,
+                    DocumentMetadata.file_type,
+                    DocumentMetadata.created_at,
+                    DocumentMetadata.embedding_model,
+                    DocumentMetadata.content_hash
+                ).order_by(DocumentMetadata.id)
+                for doc_metadata in document_rows:
+                    doc_id = doc_metadata.doc_id
+                    fields = tuple(doc_metadata[:6])
+                    self._documents.add_row(doc_id, fields)
+
+                    saved_rows = saved_nodes.get(doc_id, [])
+                    if (same_model and saved_rows and
+                            saved_versions.get(doc_id) == self._document_version(doc_metadata) and
+                            (all(docstore.document_exists(node_id_column[row]) for row in saved_rows)
+                             if docstore is not None else bool(entries))):
+                        rows.extend(saved_rows)
+                    else:
+                        stale_documents.append(self._documents[doc_id])
+
+            if docstore is None:
+                # Instantánea sin docstore: nodos reconstruidos desde sus offsets
+                docstore = SimpleDocumentStore()
+                docstore.add_documents([
+                    self._restore_node(self.documents[entries[row]["doc_id"]], entries[row]) for row in rows
+                ])
+            else:
+                kept = {doc_id_column[row] for row in rows}
+                for doc_id in saved_nodes.keys() - kept:
+                    docstore.delete_ref_doc(doc_id, raise_error=False)
+
+            rows.sort()
+            node_ids = [node_id_column[row] for row in rows]
+            with self._index_lock:
+                self._reset_vector_store(docstore)
+                # Todas las filas en orden: la matriz mapeada se pasa sin copiarla antes
+                self._add_embeddings(node_ids, [doc_id_column[row] for row in rows],
+                                     matrix if len(rows) == len(matrix) else matrix[rows])
+                self.index = VectorStoreIndex(nodes=[], storage_context=self.storage_context)
+                # index_store vuelve a serializar la estructura en el próximo insert_nodes
+                self.index.index_struct.nodes_dict.update(zip(node_ids, node_ids))
+                self._index_version += 1
+                self._data_version += 1
+
+            # Solo los documentos nuevos o modificados pasan por el modelo
+            if stale_documents:
+                stale_nodes = self.node_parser.get_nodes_from_documents(stale_documents)
+                self._embed_nodes(stale_nodes)
+                self._index_nodes(stale_nodes)
+
+            elapsed_ms = (time.perf_counter() - start_time) * 1000
+            STARTUP_TIMINGS["index_load"] = elapsed_ms / 1000
+            logger.info(
+                f"Índice cargado en {elapsed_ms:.1f} ms: {len(node_ids)} nodos restaurados, "
+                f"{len(stale_documents)} documentos reindexados"
+            )
+
+            if stale_documents or len(saved_versions) != len(self.documents) or \
+                    not os.path.exists(self.docstore_path):
+                self.save_index()
+
+        except Exception as e:
+            logger.error(f"Error al cargar índice: {e}")
+            raise
+
+    def _add_embeddings(self, node_ids: List[str], doc_ids: List[str], matrix: np.ndarray):
+        """Cargar embeddings guardados en el vector store activo sin pasar por nodos"""
+        if isinstance(self.vector_store, NumpyVectorStore):
+            self.vector_store.add_embeddings(node_ids, doc_ids, matrix)
+            return
+        # SimpleVectorStore guarda listas de Python: una única conversión para toda la matriz
+        data = self.vector_store.data
+        data.embedding_dict.update(zip(node_ids, np.asarray(matrix, dtype=np.float32).tolist()))
+        data.text_id_to_ref_doc_id.update(zip(node_ids, doc_ids))
+
+    @staticmethod
+    def _restore_node(document: "Document", entry: Dict) -> "TextNode":
+        """Reconstruir un nodo de una instantánea sin docstore a partir de su documento"""
+        if "text" in entry:
+            text, start, end = entry["text"], None, None
+        else:
+            start, end = entry["start"], entry["end"]
+            text = document.text[start:end]
+
+        return TextNode(
+            id_=entry["node_id"],
+            text=text,
+            start_char_idx=start,
+            end_char_idx=end,
+            metadata=dict(document.metadata),
+            excluded_embed_metadata_keys=list(document.excluded_embed_metadata_keys),
+            excluded_llm_metadata_keys=list(document.excluded_llm_metadata_keys),
+            relationships={NodeRelationship.SOURCE: document.as_related_node_info()}
+        )
+
+    def _node_embeddings(self):
+        """IDs de los nodos indexados y su matriz de embeddings float32"""
+        if isinstance(self.vector_store, NumpyVectorStore):
+            node_ids = self.vector_store.node_ids
+            return node_ids, self.vector_store.get_embeddings(node_ids)
+
+        embedding_dict = self.vector_store.data.embedding_dict
+        node_ids = list(embedding_dict.keys())
+        return node_ids, np.asarray([embedding_dict[node_id] for node_id in node_ids], dtype=np.float32)
+
+    def recall_report(self, queries: List[str] = None, k: int = 10, num_samples: int = 100) -> Dict:
+        """Comparar el motor vectorial aproximado con la búsqueda exacta
+
+        Usa las consultas dadas o, si no se indican, ``num_samples`` vectores
+        del propio índice como consultas. Devuelve el recall@k medio y la
+        latencia media de ambos métodos.
+        """
+        if self.index is None or not isinstance(self.vector_store, NumpyVectorStore):
+            raise ValueError("recall_report() requiere un índice con motor NumPy (flat, hnsw o ivf)")
+
+        engine = self.vector_store.engine
+        if queries:
+            query_vectors = _normalize_rows(
+                np.asarray([self._embed_query(query) for query in queries], dtype=np.float32)
+            )
+        else:
+            active = engine.active_keys()
+            rng = np.random.default_rng(0)
+            sample = rng.choice(active, min(num_samples, len(active)), replace=False)
+            query_vectors = engine.get_vectors(sample)
+
+        recalls, approx_times, exact_times = [], [], []
+        for vector in query_vectors:
+            start = time.perf_counter()
+            approx_keys, _ = engine.search(vector, k)
+            approx_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            exact_keys, _ = engine.exact_search(vector, k)
+            exact_times.append(time.perf_counter() - start)
+
+            if len(exact_keys):
+                recalls.append(len(set(approx_keys.tolist()) & set(exact_keys.tolist())) / len(exact_keys))
+
+        report = {
+            'engine': self.vector_engine,
+            'engine_params': self.engine_params,
+            'k': k,
+            'queries': len(query_vectors),
+            'vectors': engine.count,
+            f'recall@{k}': round(float(np.mean(recalls)), 4) if recalls else 0.0,
+            'approx_ms': round(float(np.mean(approx_times)) * 1000, 3) if approx_times else 0.0,
+            'exact_ms': round(float(np.mean(exact_times)) * 1000, 3) if exact_times else 0.0
+        }
+        logger.info(f"Informe de recall: {report}")
+        return report
+
+    def memory_footprint(self) -> Dict:
+        """Memoria residente de los embeddings del índice frente a float32
+
+        Para SimpleVectorStore se estima el coste de las listas de floats de
+        Python; los motores NumPy informan de sus arrays contiguos (incluida la
+        capacidad reservada) y, si re-rankean desde disco, del tamaño de ese
+        fichero. ``compression_vs_float32`` compara el coste por vector con el
+        de una fila float32.
+        """
+        footprint = {'engine': self.vector_engine, 'vectors': 0, 'dim': 0, 'bytes_per_vector': 0,
+                     'resident_bytes': 0, 'disk_bytes': 0}
+        if self.index is None:
+            return footprint
+
+        if isinstance(self.vector_store, NumpyVectorStore):
+            engine = self.vector_store.engine
+            footprint.update(vectors=engine.count, dim=engine.dim or 0,
+                             bytes_per_vector=engine.bytes_per_vector(),
+                             resident_bytes=engine.memory_bytes())
+            if isinstance(engine, QuantizedVectorEngine):
+                footprint.update(dtype=engine.dtype, disk_bytes=engine.disk_bytes())
+            if isinstance(engine, ShardedVectorEngine):
+                footprint['shards'] = engine.shard_stats()
+        else:
+            embeddings = self.vector_store.data.embedding_dict
+            if embeddings:
+                sample = next(iter(embeddings.values()))
+                per_vector = sys.getsizeof(sample) + len(sample) * sys.getsizeof(0.0)
+                footprint.update(vectors=len(embeddings), dim=len(sample), bytes_per_vector=per_vector,
+                                 resident_bytes=per_vector * len(embeddings))
+
+        footprint['float32_bytes'] = footprint['vectors'] * footprint['dim'] * 4
+        footprint['compression_vs_float32'] = (round(footprint['dim'] * 4 / footprint['bytes_per_vector'], 2)
+                                               if footprint['bytes_per_vector'] else 0.0)
+        return footprint
+
+    def start_embedding_migration(self, model_name: str, batch_size: int = 32,
+                                  max_cpu_fraction: float = 0.5, niceness: int = 10,
+                                  auto_cutover: bool = False) -> Dict:
+        """Re-embeber el índice con otro modelo en segundo plano, sin cortar el servicio
+
+        Crea (o reanuda, si hay una sin terminar para el mismo modelo) una
+        migración en embedding_migrations y lanza un EmbeddingMigrationJob
+        que construye un índice sombra. Las búsquedas siguen con el modelo
+        actual hasta cutover_embedding_migration(), que se llama sola al
+        terminar si ``auto_cutover``. Devuelve migration_status().
+        """
+        if self._migration is not None and self._migration.is_alive:
+            raise ValueError(f"Ya hay una migración en curso hacia {self._migration.model_name}")
+        if model_name == self.embedding_model:
+            raise ValueError(f"El índice ya usa el modelo {model_name}")
+        if self.index is None:
+            raise ValueError("Índice no construido. Ejecute build_index() primero")
+
+        try:
+            with self.get_db_session() as session:
+                run = session.query(EmbeddingMigrationRun).filter(
+                    EmbeddingMigrationRun.model_name == model_name,
+                    EmbeddingMigrationRun.previous_model == self.embedding_model,
+                    EmbeddingMigrationRun.status.in_(MIGRATION_RESUMABLE)
+                ).order_by(EmbeddingMigrationRun.id.desc()).first()
+                if run is None:
+                    run = EmbeddingMigrationRun(model_name=model_name, previous_model=self.embedding_model,
+                                                status="running", embedded_documents=0)
+                    session.add(run)
+                run.total_documents = session.query(func.count(DocumentMetadata.id)).scalar()
+                session.commit()
+                migration_id = run.id
+
+            previous = self._migration
+            job = EmbeddingMigrationJob(self, migration_id, model_name, batch_size=batch_size,
+                                        max_cpu_fraction=max_cpu_fraction, niceness=niceness,
+                                        auto_cutover=auto_cutover)
+            # Al reanudar en el mismo proceso se conserva el índice sombra ya construido
+            if previous is not None and previous.migration_id == migration_id:
+                job.shadow_index, job.shadow_store, job.shadow_context = (
+                    previous.shadow_index, previous.shadow_store, previous.shadow_context
+                )
+            self._migration = job
+            job.start()
+            logger.info(f"Migración {migration_id} hacia {model_name} iniciada")
+            return self.migration_status()
+
+        except Exception as e:
+            logger.error(f"Error al iniciar la migración de embeddings: {e}")
+            raise
+
+    def pause_embedding_migration(self, timeout: Optional[float] = None):
+        """Detener la migración tras el lote en curso; se reanuda con start_embedding_migration()"""
+        if self._migration is not None:
+            self._migration.stop(timeout)
+
+    def migration_status(self) -> Dict:
+        """Estado de la última migración (de SQL) y del job en este proceso"""
+        with self.get_read_session() as session:
+            run = session.query(EmbeddingMigrationRun).order_by(EmbeddingMigrationRun.id.desc()).first()
+            status = {'active_model': self.embedding_model, 'migration': None}
+            if run is not None:
+                status['migration'] = {
+                    'id': run.id,
+                    'model_name': run.model_name,
+                    'previous_model': run.previous_model,
+                    'status': run.status,
+                    'total_documents': run.total_documents,
+                    'embedded_documents': run.embedded_documents,
+                    'progress': min(1.0, round(run.embedded_documents / run.total_documents, 4))
+                    if run.total_documents else 1.0,
+                    'completed_at': run.completed_at,
+                    'error': run.error
+                }
+        if self._migration is not None:
+            status['job'] = self._migration.status()
+        return status
+
+    def cutover_embedding_migration(self):
+        """Pasar de forma atómica al índice sombra y al nuevo modelo
+
+        Primero se iguala el índice sombra con las escrituras recibidas
+        durante la migración; después, con las escrituras del índice
+        bloqueadas, se repite la comprobación (normalmente sin cambios), se
+        intercambian índice y modelo y se marca la migración como completada
+        en la misma transacción que actualiza embedding_model de los
+        documentos. Las búsquedas en curso se repiten con el índice nuevo.
+        """
+        job = self._migration
+        if job is None or job.state != "ready":
+            raise ValueError("No hay ninguna migración lista para el cambio")
+
+        try:
+            start_time = time.perf_counter()
+            job.reconcile()
+            with self._index_lock:
+                job.reconcile()
+                old_store = self.vector_store
+
+                self._serving_generation += 1
+                self._index, self.vector_store, self.storage_context = (
+                    job.shadow_index, job.shadow_store, job.shadow_context
+                )
+                self.embedding_model = job.model_name
+                self._scoring_cache = None
+                self._doc_rows_cache = None
+                self._bump_index_version()
+                self._serving_generation += 1
+
+                with self.get_db_session() as session:
+                    session.query(DocumentMetadata).update(
+                        {DocumentMetadata.embedding_model: job.model_name}, synchronize_session=False
+                    )
+                    session.query(EmbeddingMigrationRun).filter(
+                        EmbeddingMigrationRun.id == job.migration_id
+                    ).update({"status": "completed",
+                              "completed_at": datetime.now(timezone.utc).replace(tzinfo=None)})
+                    session.commit()
+
+            job.state = "completed"
+            if old_store is not None and self.vector_engine != "simple":
+                old_store.engine.close()
+            logger.info(
+                f"Cambio de modelo a {job.model_name} completado en "
+                f"{(time.perf_counter() - start_time) * 1000:.1f} ms"
+            )
+
+            if self.persist_index:
+                self.save_index()
+
+        except Exception as e:
+            logger.error(f"Error en el cambio de modelo de embeddings: {e}")
+            raise
+
+    def cancel_embedding_migration(self):
+        """Abandonar la migración en curso y descartar su índice sombra"""
+        job = self._migration
+        if job is None or job.state == "completed":
+            return
+        job.stop()
+        job._set_state("cancelled")
+        if job.shadow_store is not None and self.vector_engine != "simple":
+            job.shadow_store.engine.close()
+        self._migration = None
+        logger.info(f"Migración {job.migration_id} cancelada")
+
+    def close(self):
+        """Vaciar el registro de búsquedas y guardar los cambios del índice antes de cerrar"""
+        if self._migration is not None:
+            self._migration.stop()
+        if self.search_log is not None:
+            self.search_log.close()
+        if self.persist_index and self._index_dirty:
+            self.save_index()
+        if self.vector_store is not None and self.vector_engine != "simple":
+            self.vector_store.engine.close()
+        self.engine.dispose()
+        self.read_engine.dispose()
+
+    def search(self, query: str, top_k: int = 5, mode: str = "vector",
+               file_type: Union[str, List[str]] = None, created_after: datetime = None,
+               created_before: datetime = None, path_prefix: str = None,
+               paginate: bool = False, page_token: str = None) -> SearchPage:
+        """Realizar búsqueda semántica
+
+        ``mode`` elige el recuperador: "vector" (embeddings), "lexical" (BM25
+        sobre FTS5, sin calcular embeddings ni cargar el índice) o "hybrid"
+        (fusión de ambos por Reciprocal Rank Fusion a nivel de documento).
+
+        Los filtros ``file_type`` (uno o varios), ``created_after`` /
+        ``created_before`` y ``path_prefix`` se resuelven primero en SQL sobre
+        columnas indexadas de DocumentMetadata; la similitud vectorial solo se
+        calcula sobre los documentos que los cumplen.
+
+        En los modos "vector" e "hybrid", si una consulta anterior con los
+        mismos parámetros tiene un embedding lo bastante parecido (ver
+        SemanticResultCache) y los datos no han cambiado desde entonces, se
+        devuelven sus resultados (con los scores de aquella consulta).
+
+        Devuelve una SearchPage de SearchResult, que cargan texto y metadatos
+        al acceder a ellos. Sin ``paginate`` solo se recuperan ``top_k``
+        resultados. Con ``paginate`` se puntúan ``page_depth`` páginas de una
+        vez y, si hay más resultados, ``next_page_token`` permite pedir la
+        siguiente con ``search(query, page_token=...)``, que reutiliza ese
+        ranking y, al agotarlo, recupera de nuevo con el doble de profundidad
+        (tamaño de página, modo y filtros son los de la primera búsqueda).
+        ``next_page_token`` solo es None cuando no quedan resultados. Un token
+        de otra consulta o de antes de una escritura lanza ValueError.
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Modo de búsqueda desconocido: {mode}")
+
+        start_time = time.perf_counter()
+        timings: Dict[str, float] = {}
+        page = None
+        if page_token is not None:
+            with self.metrics.timer("search", "page", timings):
+                page = self._cursor_page(query, page_token)
+
+        try:
+            if page is None:
+                # Versión leída antes de calcular: si hay escrituras entretanto, no se reutiliza
+                version = (self._data_version, self.embedding_model)
+                conditions = self._filter_conditions(file_type, created_after, created_before, path_prefix)
+                depth = top_k * self.page_depth if paginate else top_k
+
+                if mode != "lexical" and not self.index:
+                    logger.error("Índice no construido. Ejecute build_index() primero")
+                    return SearchPage()
+
+                results = None
+                if mode != "lexical" and self.result_cache is not None:
+                    cache_key = self._result_cache_key(mode, depth, file_type, created_after,
+                                                       created_before, path_prefix)
+                    with self.metrics.timer("search", "cache", timings):
+                        query_vector = _normalize_rows(np.asarray(self._embed_query(query), dtype=np.float32))
+                        results = self.result_cache.get(query_vector, cache_key, version)
+
+                if results is None:
+                    results = self._rank(query, mode, depth, conditions, timings)
+                    if mode != "lexical" and self.result_cache is not None:
+                        self.result_cache.put(query_vector, cache_key, version, results)
+
+                cursor = None
+                if paginate:
+                    cursor = _SearchCursor(query, version, list(results), top_k, mode, conditions, depth)
+                page = self._open_cursor(cursor) if cursor is not None else self._page(None, results, 0, top_k)
+
+            similarities = [result.similarity_score for result in page]
+
+            # Calcular métricas
+            execution_time = time.perf_counter() - start_time
+            avg_similarity = np.mean(similarities) if similarities else 0.0
+
+            # Registrar consulta (en segundo plano si async_logging)
+            with self.metrics.timer("search", "log"):
+                self._log_searches([{
+                    'query_text': query,
+                    'timestamp': datetime.now(timezone.utc).replace(tzinfo=None),
+                    'results_count': len(page),
+                    'avg_similarity': float(avg_similarity),
+                    'execution_time': execution_time,
+                    **self._stage_columns(timings)
+                }])
+            self.metrics.observe("search", "total", time.perf_counter() - start_time)
+
+            logger.info(f"Búsqueda completada en {execution_time:.2f}s con {len(page)} resultados")
+            return page
+
+        except Exception as e:
+            logger.error(f"Error en búsqueda: {e}")
+            return SearchPage()
+
+    def _rank(self, query: str, mode: str, depth: int, conditions: List,
+              timings: Dict[str, float] = None) -> List[SearchResult]:
+        """Los ``depth`` mejores resultados de la consulta (sin cargar sus campos)"""
+        if mode == "lexical":
+            with self.metrics.timer("search", "lexical", timings):
+                hits = self.lexical_search(query, depth, conditions)
+            with self.metrics.timer("search", "metadata", timings):
+                return self._lexical_results(hits)
+
+        candidates = depth * HYBRID_CANDIDATES_FACTOR if mode == "hybrid" else depth
+        candidate_doc_ids = None
+        if conditions:
+            with self.metrics.timer("search", "filter", timings):
+                candidate_doc_ids = self._candidate_doc_ids(conditions)
+
+        def retrieve_results():
+            # Puntuar candidatos (sin leer todavía los nodos)
+            hits = []
+            if candidate_doc_ids is None or candidate_doc_ids:
+                hits = self._retrieve(query, candidates, candidate_doc_ids, timings)
+
+            # Procesar resultados (los campos se cargan al acceder a ellos)
+            with self.metrics.timer("search", "metadata", timings):
+                return self._build_results(hits)
+
+        # Nodos y doc_id del mismo corte del índice (ver _reindex_document)
+        results = self._consistent(retrieve_results)
+        if mode == "hybrid":
+            with self.metrics.timer("search", "lexical", timings):
+                hits = self.lexical_search(query, candidates, conditions)
+            with self.metrics.timer("search", "metadata", timings):
+                results = self._fuse_results(results, hits, depth)
+        return results
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    doc_id = Column(String(255), unique=True, nullable=False)
-    title = Column(String(500), nullable=False)
-    content = Column(Text, nullable=False)
-    file_path = Column(String(1000))
-    file_type = Column(String(50))
-    created_at = Column(DateTime, default=func.now())
-    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
-    word_count = Column(Integer)
-    embedding_model = Column(String(100))
+    def _open_cursor(self, cursor: "_SearchCursor") -> SearchPage:
+        """Primera página de un ranking; el cursor se guarda si puede haber más"""
+        page = self._page(cursor, cursor.results, 0, cursor.page_size)
+        if page.next_page_token is not None:
+            with self._cursor_lock:
+                self._cursors[cursor.cursor_id] = cursor
+                while len(self._cursors) > SEARCH_CURSOR_LIMIT:
+                    self._cursors.popitem(last=False)
+        return page
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'doc_id': self.doc_id,
-            'title': self.title,
-            'content': self.content[:200] + '...' if len(self.content) > 200 else self.content,
-            'file_path': self.file_path,
-            'file_type': self.file_type,
-            'created_at': self.created_at,
-            'word_count': self.word_count
-        }
+    def _cursor_page(self, query: str, page_token: str) -> SearchPage:
+        """Página de un cursor abierto por una búsqueda anterior"""
+        cursor_id, _, offset = page_token.partition(".")
+        with self._cursor_lock:
+            cursor = self._cursors.get(cursor_id)
+            if cursor is not None:
+                self._cursors.move_to_end(cursor_id)
+        if cursor is None or not offset.isdigit():
+            raise ValueError("page_token inválido o caducado")
 
-class SearchQuery(Base):
-    """Modelo para almacenar consultas de búsqueda"""
-    __tablename__ = "search_queries"
+        if cursor.query != query:
+            raise ValueError("page_token no corresponde a esta consulta")
+        if cursor.version != (self._data_version, self.embedding_model):
+            with self._cursor_lock:
+                self._cursors.pop(cursor_id, None)
+            raise ValueError("page_token caducado: los datos han cambiado desde la primera página")
+        return self._page(cursor, cursor.results, int(offset), cursor.page_size)
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    query_text = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=func.now())
-    results_count = Column(Integer)
-    avg_similarity = Column(Float)
-    execution_time = Column(Float)
+    def _page(self, cursor: Optional["_SearchCursor"], results: List[SearchResult], offset: int,
+              page_size: int) -> SearchPage:
+        """Resultados [offset, offset + page_size) con su cargador y el token de la siguiente
 
-# =============================================================================
-# CLASE PRINCIPAL DEL SISTEMA
-# =============================================================================
+        Si la página llega al final del ranking de un cursor que aún puede
+        tener más resultados, se recupera de nuevo con el doble de
+        profundidad antes de decidir si hay página siguiente.
+        """
+        end = offset + page_size
+        if cursor is not None:
+            with cursor.lock:
+                while len(cursor.results) <= end and not cursor.exhausted:
+                    self._deepen(cursor)
+            results = cursor.results
+        page = results[offset:end]
+        _ResultLoader(self, [result for result in page if result._loader is None])
+        next_page_token = f"{cursor.cursor_id}.{end}" if cursor is not None and end < len(results) else None
+        return SearchPage(page, next_page_token)
 
-class SemanticSearchSystem:
-    """Sistema principal de búsqueda semántica"""
+    def _deepen(self, cursor: "_SearchCursor"):
+        """Ampliar el ranking de un cursor sin alterar lo ya servido
 
-    def __init__(self, db_path: str = "semantic_search.db"):
-        self.db_path = db_path
-        self.engine = create_engine(f"sqlite:///{db_path}")
-        Base.metadata.create_all(self.engine)
-        self.SessionLocal = sessionmaker(bind=self.engine)
+        Se recupera de nuevo con el doble de profundidad y se añaden al final
+        los resultados que no estaban; si la recuperación devuelve menos de
+        lo pedido, el cursor queda agotado.
+        """
+        if cursor.version != (self._data_version, self.embedding_model):
+            raise ValueError("page_token caducado: los datos han cambiado desde la primera página")
+        cursor.depth *= 2
+        deeper = self._rank(cursor.query, cursor.mode, cursor.depth, cursor.conditions)
+        # Modo vectorial: un resultado por nodo; léxico e híbrido: uno por documento
+        key = (lambda result: result.node_id) if cursor.mode == "vector" else (lambda result: result.doc_id)
+        seen = {key(result) for result in cursor.results}
+        cursor.results.extend(result for result in deeper if key(result) not in seen)
+        cursor.exhausted = len(deeper) < cursor.depth
 
-        # Inicializar componentes de LlamaIndex
-        self.vector_store = SimpleVectorStore()
-        self.storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
-        self.index = None
-        self.documents = []
+    def lexical_search(self, query: str, top_k: int = 5, conditions: List = None) -> List[tuple]:
+        """Recuperador BM25: (doc_id, score) de los documentos que mejor casan con la consulta
 
-        logger.info(f"Sistema inicializado con base de datos: {db_path}")
+        ``conditions`` (ver _filter_conditions) restringe los documentos en la
+        misma consulta SQL.
+        """
+        if not self.fts_enabled:
+            return []
 
-    def get_db_session(self) -> Session:
-        """Obtener sesión de base de datos"""
-        return self.SessionLocal()
+        # Cada término entre comillas para no interpretar la sintaxis de FTS5
+        terms = re.findall(r"\w+", query.lower())
+        if not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in dict.fromkeys(terms))
 
-    def add_document(self, title: str, content: str, file_path: str = None,
-                    file_type: str = None) -> str:
-        """Agregar un documento al sistema"""
-        try:
-            # Generar ID único para el documento
-            doc_id = f"doc_{len(self.documents) + 1}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        fts = table("document_fts", column("rowid"))
+        rank = literal_column("bm25(document_fts, 2.0, 1.0)").label("rank")
+        statement = (
+            select(DocumentMetadata.doc_id, rank)
+            .select_from(fts.join(DocumentMetadata, DocumentMetadata.id == fts.c.rowid))
+            .where(text("document_fts MATCH :match"), *(conditions or []))
+            .order_by(rank)
+            .limit(top_k)
+        )
 
-            # Crear documento de LlamaIndex
-            document = Document(
-                text=content,
-                doc_id=doc_id,
-                metadata={
-                    "title": title,
-                    "file_path": file_path,
-                    "file_type": file_type,
-                    "created_at": datetime.now().isoformat()
-                }
-            )
+        with self.get_read_session() as session:
+            rows = session.execute(statement, {"match": match}).all()
 
-            self.documents.append(document)
+        # bm25() devuelve valores negativos: menor es mejor
+        return [(row.doc_id, -row.rank) for row in rows]
 
-            # Guardar metadatos en SQL
-            with self.get_db_session() as session:
-                doc_metadata = DocumentMetadata(
-                    doc_id=doc_id,
-                    title=title,
-                    content=content,
-                    file_path=file_path,
-                    file_type=file_type,
-                    word_count=len(content.split()),
-                    embedding_model=EMBEDDING_MODEL
-                )
-                session.add(doc_metadata)
-                session.commit()
+    def _lexical_results(self, hits: List[tuple]) -> List[SearchResult]:
+        """Resultados a nivel de documento para aciertos léxicos (campos leídos de SQL al acceder)"""
+        return [SearchResult(doc_id, score) for doc_id, score in hits]
 
-            logger.info(f"Documento agregado: {doc_id}")
-            return doc_id
+    def _document_rows(self, doc_ids: Iterable[str]) -> Dict[str, Any]:
+        """Contenido y metadatos SQL de varios documentos con una sola consulta IN"""
+        doc_ids = list(dict.fromkeys(doc_ids))
+        if not doc_ids:
+            return {}
+        with self.get_read_session() as session:
+            rows = session.query(
+                DocumentMetadata.doc_id,
+                DocumentMetadata.title,
+                DocumentMetadata.content,
+                DocumentMetadata.file_path,
+                DocumentMetadata.file_type,
+                DocumentMetadata.created_at,
+                DocumentMetadata.word_count
+            ).filter(DocumentMetadata.doc_id.in_(doc_ids)).all()
+        return {row.doc_id: row for row in rows}
 
-        except Exception as e:
-            logger.error(f"Error al agregar documento: {e}")
-            raise
+    def _fuse_results(self, vector_results: List[SearchResult], lexical_hits: List[tuple],
+                      top_k: int) -> List[SearchResult]:
+        """Reciprocal Rank Fusion de resultados vectoriales y léxicos por documento
 
-    def build_index(self):
-        """Construir el índice de vectores"""
-        try:
-            if not self.documents:
-                logger.warning("No hay documentos para indexar")
-                return
+        Cada documento conserva su mejor fragmento vectorial; los que solo
+        aparecen en la búsqueda léxica se devuelven con su contenido completo.
+        """
+        fused: Dict[str, float] = {}
+        best_result: Dict[str, SearchResult] = {}
 
-            # Parsear documentos en nodos
-            parser = SentenceSplitter(chunk_size=512, chunk_overlap=50)
-            nodes = parser.get_nodes_from_documents(self.documents)
+        for result in vector_results:
+            if result.doc_id not in best_result:
+                best_result[result.doc_id] = result
+                fused[result.doc_id] = 1 / (RRF_K + len(best_result))
 
-            # Crear índice
-            self.index = VectorStoreIndex(
-                nodes,
-                storage_context=self.storage_context
-            )
+        lexical_scores = dict(lexical_hits)
+        for rank, (doc_id, _) in enumerate(lexical_hits, 1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1 / (RRF_K + rank)
 
-            logger.info(f"Índice construido con {len(nodes)} nodos")
+        results = []
+        for doc_id in sorted(fused, key=fused.get, reverse=True)[:top_k]:
+            vector_result = best_result.get(doc_id)
+            results.append(SearchResult(
+                doc_id, fused[doc_id],
+                node_id=vector_result.node_id if vector_result is not None else None,
+                vector_score=vector_result.similarity_score if vector_result is not None else None,
+                lexical_score=lexical_scores.get(doc_id)
+            ))
+        return results
 
-        except Exception as e:
-            logger.error(f"Error al construir índice: {e}")
-            raise
+    def search_many(self, queries: List[str], top_k: int = 5) -> List[List[SearchResult]]:
+        """Realizar varias búsquedas semánticas en lote
 
-    def search(self, query: str, top_k: int = 5) -> List[Dict]:
-        """Realizar búsqueda semántica"""
+        Embebe todas las consultas en una llamada al modelo, las puntúa contra
+        la matriz de nodos con un producto matricial, obtiene los metadatos de
+        todos los documentos encontrados con una consulta SQL (al acceder al
+        primer resultado) y registra todas
+        las búsquedas juntas. Devuelve una lista de resultados por consulta,
+        con el mismo formato que search().
+        """
         try:
-            start_time = datetime.now()
+            start_time = time.perf_counter()
 
             if not self.index:
                 logger.error("Índice no construido. Ejecute build_index() primero")
+                return [[] for _ in queries]
+            if not queries:
                 return []
 
-            # Realizar búsqueda usando retriever
-            retriever = self.index.as_retriever(similarity_top_k=top_k)
-            nodes = retriever.retrieve(query)
+            timings: Dict[str, float] = {}
+            hits = self._search_hits(queries, top_k, timings)
+            all_results = self._complete_searches(
+                queries, hits, [start_time] * len(queries), time_divisor=len(queries), timings=timings
+            )
 
-            # Procesar resultados
-            results = []
-            similarities = []
+            self.metrics.observe("search_batch", "total", time.perf_counter() - start_time)
+            logger.info(f"{len(queries)} búsquedas completadas en {time.perf_counter() - start_time:.2f}s")
+            return all_results
 
-            for node in nodes:
-                # Obtener metadatos del documento
-                doc_id = node.metadata.get('doc_id', 'unknown')
+        except Exception as e:
+            logger.error(f"Error en búsqueda por lotes: {e}")
+            return [[] for _ in queries]
 
-                with self.get_db_session() as session:
-                    doc_metadata = session.query(DocumentMetadata).filter(
-                        DocumentMetadata.doc_id == doc_id
-                    ).first()
-
-                # Calcular score de similitud (si está disponible)
-                similarity_score = getattr(node, 'score', 0.0)
-
-                result = {
-                    'doc_id': doc_id,
-                    'title': node.metadata.get('title', 'Sin título'),
-                    'content': node.text,
-                    'similarity_score': similarity_score,
-                    'metadata': dict(node.metadata)
-                }
+    def _search_hits(self, queries: List[str], top_k: int,
+                     timings: Dict[str, float] = None) -> List[List[tuple]]:
+        """Parte de cómputo de una búsqueda en lote: embeddings y scoring"""
+        def score():
+            with self.metrics.timer("search_batch", "embed", timings):
+                query_vectors = self._embed_queries(queries)
+            with self.metrics.timer("search_batch", "retrieve", timings):
+                return self._score_queries(query_vectors, top_k)
 
-                if doc_metadata:
-                    result.update({
-                        'file_path': doc_metadata.file_path,
-                        'file_type': doc_metadata.file_type,
-                        'created_at': doc_metadata.created_at,
-                        'word_count': doc_metadata.word_count
-                    })
+        return self._consistent(score)
 
-                results.append(result)
-                similarities.append(similarity_score)
+    def _complete_searches(self, queries: List[str], hits: List[List[tuple]],
+                           start_times: List[float], time_divisor: int = 1,
+                           timings: Dict[str, float] = None, preload: bool = False) -> List[List[SearchResult]]:
+        """Parte SQL de una búsqueda en lote: nodos, metadatos y registro
 
-            # Calcular métricas
-            execution_time = (datetime.now() - start_time).total_seconds()
-            avg_similarity = np.mean(similarities) if similarities else 0.0
+        ``time_divisor`` reparte el tiempo medido (total y por etapa) entre las
+        consultas cuando todas se procesaron juntas desde el mismo instante inicial.
+        Nodos y metadatos SQL se leen al acceder a los resultados, de una vez
+        para todo el lote; con ``preload`` se leen ya aquí.
+        """
+        timings = dict(timings or {})
 
-            # Guardar consulta en base de datos
-            with self.get_db_session() as session:
-                search_query = SearchQuery(
-                    query_text=query,
-                    results_count=len(results),
-                    avg_similarity=avg_similarity,
-                    execution_time=execution_time
-                )
-                session.add(search_query)
-                session.commit()
+        # Nodos y metadatos de la unión de resultados, una sola vez al acceder
+        with self.metrics.timer("search_batch", "metadata", timings):
+            all_results = [self._build_results(query_hits) for query_hits in hits]
+            loader = _ResultLoader(self, [result for results in all_results for result in results])
+            if preload:
+                loader.load()
 
-            logger.info(f"Búsqueda completada en {execution_time:.2f}s con {len(results)} resultados")
-            return results
+        # Registro conjunto de todas las consultas
+        end_time = time.perf_counter()
+        timestamp = datetime.now(timezone.utc).replace(tzinfo=None)
+        stage_columns = self._stage_columns({stage: seconds / time_divisor for stage, seconds in timings.items()})
+        with self.metrics.timer("search_batch", "log"):
+            self._log_searches([
+                {
+                    'query_text': query,
+                    'timestamp': timestamp,
+                    'results_count': len(results),
+                    'avg_similarity': float(np.mean([r.similarity_score for r in results])) if results else 0.0,
+                    'execution_time': (end_time - start) / time_divisor,
+                    **stage_columns
+                }
+                for query, results, start in zip(queries, all_results, start_times)
+            ])
 
-        except Exception as e:
-            logger.error(f"Error en búsqueda: {e}")
-            return []
+        return all_results
+
+    def _stage_columns(self, timings: Dict[str, float]) -> Dict[str, float]:
+        """Columnas de SearchQuery con las etapas medidas, si store_stage_timings"""
+        if not self.store_stage_timings:
+            return {}
+        return {column_name: timings.get(stage) for stage, column_name in STAGE_COLUMNS.items()}
+
+    def _log_searches(self, rows: List[Dict]):
+        """Registrar búsquedas: encolar en el writer o insertar en una transacción"""
+        if self.search_log is not None:
+            self.search_log.log_many(rows)
+            return
 
-    def get_document_stats(self) -> Dict:
-        """Obtener estadísticas de documentos"""
         with self.get_db_session() as session:
-            total_docs = session.query(func.count(DocumentMetadata.id)).scalar()
-            total_words = session.query(func.sum(DocumentMetadata.word_count)).scalar() or 0
+            session.execute(insert(SearchQuery), rows)
+            update_search_rollups(session, rows)
+            session.commit()
 
-            file_types = session.query(
-                DocumentMetadata.file_type,
-                func.count(DocumentMetadata.id)
-            ).group_by(DocumentMetadata.file_type).all()
+    def _build_results(self, hits: List[tuple]) -> List[SearchResult]:
+        """Convertir aciertos (node_id, score) en resultados perezosos"""
+        node_docs = self._node_doc_ids()
+        return [
+            SearchResult(node_docs.get(node_id, 'unknown'), score, node_id=node_id)
+            for node_id, score in hits
+        ]
+
+    def get_document_stats(self) -> Dict:
+        """Obtener estadísticas de documentos
+
+        Se leen de document_stats (una fila por tipo de archivo, mantenida por
+        triggers), no recorriendo document_metadata.
+        """
+        with self.get_read_session() as session:
+            rows = session.query(DocumentStats).filter(DocumentStats.documents > 0).all()
 
             return {
-                'total_documents': total_docs,
-                'total_words': total_words,
-                'file_types': dict(file_types),
-                'embedding_model': EMBEDDING_MODEL
+                'total_documents': sum(row.documents for row in rows),
+                'total_words': sum(row.words for row in rows),
+                'file_types': {row.file_type or None: row.documents for row in rows},
+                'embedding_model': self.embedding_model
             }
 
-    def get_search_analytics(self) -> Dict:
-        """Obtener analíticas de búsquedas"""
-        with self.get_db_session() as session:
-            total_searches = session.query(func.count(SearchQuery.id)).scalar()
-            avg_execution_time = session.query(func.avg(SearchQuery.execution_time)).scalar() or 0
-            avg_results = session.query(func.avg(SearchQuery.results_count)).scalar() or 0
+    def get_search_analytics(self, top_n: int = 10) -> Dict:
+        """Obtener analíticas de búsquedas
+
+        Las cifras salen del bucket total de search_rollups (con un sketch de
+        percentiles de latencia), del top-N de query_counts y de las últimas
+        consultas por el índice de timestamp: el coste no crece con el historial.
+        """
+        # Escribir antes los registros pendientes para que las cifras estén al día
+        if self.search_log is not None:
+            self.search_log.flush()
+
+        with self.get_read_session() as session:
+            total = session.get(SearchRollup, ("total", ROLLUP_TOTAL_BUCKET))
+            summary = _rollup_summary(total) if total is not None else None
+            stage_totals = json.loads(total.stage_totals) if total is not None and total.stage_totals else {}
 
-            recent_queries = session.query(SearchQuery).order_by(
+            recent_queries = session.query(SearchQuery.query_text).order_by(
                 SearchQuery.timestamp.desc()
             ).limit(10).all()
 
+            top_queries = session.query(QueryCount).order_by(QueryCount.count.desc()).limit(top_n).all()
+
             return {
-                'total_searches': total_searches,
-                'avg_execution_time': round(avg_execution_time, 3),
-                'avg_results_per_search': round(avg_results, 1),
-                'recent_queries': [q.query_text for q in recent_queries]
+                'total_searches': summary['searches'] if summary else 0,
+                'avg_execution_time': round(summary['avg_execution_time'], 3) if summary else 0,
+                'avg_results_per_search': round(summary['avg_results'], 1) if summary else 0,
+                'latency_percentiles': {
+                    'p50': round(summary['p50_execution_time'], 4),
+                    'p95': round(summary['p95_execution_time'], 4),
+                    'p99': round(summary['p99_execution_time'], 4)
+                } if summary else {},
+                'avg_stage_times': {
+                    stage: round(seconds / count, 4)
+                    for stage, (seconds, count) in stage_totals.items() if count
+                },
+                'top_queries': [{'query': entry.query_text, 'count': entry.count} for entry in top_queries],
+                'recent_queries': [row.query_text for row in recent_queries]
+            }
+
+    def get_search_timeseries(self, granularity: str = "hour", limit: int = 24) -> List[Dict]:
+        """Últimos ``limit`` buckets por minuto u hora, del más antiguo al más reciente"""
+        if granularity not in ("minute", "hour"):
+            raise ValueError(f"Granularidad desconocida: {granularity}")
+
+        if self.search_log is not None:
+            self.search_log.flush()
+
+        with self.get_read_session() as session:
+            rollups = session.query(SearchRollup).filter(
+                SearchRollup.granularity == granularity
+            ).order_by(SearchRollup.bucket_start.desc()).limit(limit).all()
+            return [_rollup_summary(rollup) for rollup in reversed(rollups)]
+
+    def get_metrics(self) -> Dict:
+        """Métricas en proceso: latencias por etapa, cachés, cola de registro e índice"""
+        return {
+            'stages': self.metrics.snapshot(),
+            'query_cache': self.query_cache.stats(),
+            'result_cache': self.result_cache.stats() if self.result_cache is not None else None,
+            'chunk_cache': self.chunk_cache.stats() if self.chunk_cache is not None else None,
+            'search_log': self.search_log.metrics() if self.search_log is not None else None,
+            'index': {
+                'version': self._index_version,
+                'documents': len(self._documents),
+                'loaded': self._index is not None
             }
+        }
+
+    def prometheus_metrics(self) -> str:
+        """Volcado de get_metrics() en formato de texto de Prometheus"""
+        lines = self.metrics.prometheus_lines()
+
+        gauges = {f"query_cache_{name}": value for name, value in self.query_cache.stats().items()}
+        if self.chunk_cache is not None:
+            gauges.update((f"chunk_cache_{name}", value) for name, value in self.chunk_cache.stats().items())
+        if self.result_cache is not None:
+            gauges.update((f"result_cache_{name}", value) for name, value in self.result_cache.stats().items())
+        if self.search_log is not None:
+            gauges.update((f"search_log_{name}", value) for name, value in self.search_log.metrics().items())
+        gauges["index_version"] = self._index_version
+        gauges["index_documents"] = len(self._documents)
+
+        for name, value in gauges.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"# TYPE semantic_search_{name} gauge")
+                lines.append(f"semantic_search_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+# =============================================================================
+# SERVICIO ASÍNCRONO DE BÚSQUEDA
+# =============================================================================
+
+class AsyncSearchService:
+    """Punto de entrada asyncio para servir búsquedas concurrentes
+
+    Las consultas que llegan en una ventana de ``batch_window_ms`` se agrupan
+    (hasta ``max_batch_size``): las que no están en la caché de consultas se
+    embeben con una sola llamada al modelo y todas se puntúan juntas en un
+    executor de cómputo acotado; la parte SQL (nodos, metadatos y
+    registro) se ejecuta en un pool de hilos aparte. Así muchas peticiones
+    web simultáneas comparten el trabajo del modelo en lugar de hacer cola.
+    """
+
+    def __init__(self, system: "SemanticSearchSystem", max_batch_size: int = 32,
+                 batch_window_ms: float = 5.0, compute_workers: int = 1, sql_workers: int = 4):
+        self.system = system
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window_ms / 1000
+        self._compute_executor = ThreadPoolExecutor(max_workers=compute_workers,
+                                                    thread_name_prefix="search-compute")
+        self._sql_executor = ThreadPoolExecutor(max_workers=sql_workers,
+                                                thread_name_prefix="search-sql")
+        self._queue: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+        self._loop = None
+        self.batches = 0
+        self.batched_queries = 0
+
+    def _ensure_batcher(self):
+        loop = asyncio.get_running_loop()
+        if self._batcher is None or self._batcher.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._batcher = loop.create_task(self._batch_loop())
+
+    async def search(self, query: str, top_k: int = 5) -> List[SearchResult]:
+        """Búsqueda semántica asíncrona con el mismo resultado que search()"""
+        if not self.system.index:
+            logger.error("Índice no construido. Ejecute build_index() primero")
+            return []
+
+        start_time = time.perf_counter()
+        self._ensure_batcher()
+        future = self._loop.create_future()
+        await self._queue.put((query, top_k, future))
+        hits = await future
+
+        # Metadatos precargados en el pool SQL, no al acceder desde el bucle de eventos
+        results = await self._loop.run_in_executor(
+            self._sql_executor,
+            lambda: self.system._complete_searches([query], [hits], [start_time], preload=True)
+        )
+        return results[0]
+
+    async def search_many(self, queries: List[str], top_k: int = 5) -> List[List[SearchResult]]:
+        """Varias búsquedas asíncronas concurrentes"""
+        return list(await asyncio.gather(*(self.search(query, top_k) for query in queries)))
+
+    async def _batch_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.batch_window
+
+            # Micro-batching: esperar brevemente a más consultas
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            queries = [query for query, _, _ in batch]
+            top_k = max(k for _, k, _ in batch)
+            try:
+                hits = await self._loop.run_in_executor(
+                    self._compute_executor, self.system._search_hits, queries, top_k
+                )
+                for (_, k, future), query_hits in zip(batch, hits):
+                    if not future.done():
+                        future.set_result(query_hits[:k])
+            except Exception as e:
+                logger.error(f"Error en lote asíncrono de búsqueda: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+            self.batches += 1
+            self.batched_queries += len(batch)
+
+    def stats(self) -> Dict:
+        """Tamaño medio de los lotes agrupados"""
+        return {
+            'batches': self.batches,
+            'queries': self.batched_queries,
+            'avg_batch_size': round(self.batched_queries / self.batches, 2) if self.batches else 0.0
+        }
+
+    def close(self):
+        """Detener el agrupador y los pools de hilos"""
+        if self._batcher is not None:
+            self._batcher.cancel()
+        self._compute_executor.shutdown(wait=True)
+        self._sql_executor.shutdown(wait=True)
 
 # =============================================================================
 # FUNCIONES DE UTILIDAD
@@ -358,12 +4986,7 @@ def load_sample_documents(system: SemanticSearchSystem):
         }
     ]
 
-    for doc in sample_docs:
-        system.add_document(
-            title=doc["title"],
-            content=doc["content"],
-            file_type=doc["file_type"]
-        )
+    system.add_documents(sample_docs)
 
     print("Documentos de ejemplo cargados exitosamente")
 
@@ -381,12 +5004,10 @@ def run_sample_searches(system: SemanticSearchSystem):
     print("EJECUTANDO BÚSQUEDAS DE EJEMPLO")
     print("="*50)
 
-    for query in sample_queries:
+    for query, results in zip(sample_queries, system.search_many(sample_queries, top_k=3)):
         print(f"\n🔍 Consulta: '{query}'")
         print("-" * 40)
 
-        results = system.search(query, top_k=3)
-
         if results:
             for i, result in enumerate(results, 1):
                 print(f"{i}. {result['title']}")
@@ -419,11 +5040,300 @@ def display_analytics(system: SemanticSearchSystem):
     print(f"⏱️  Tiempo promedio: {search_stats['avg_execution_time']:.3f}s")
     print(f"📊 Resultados promedio: {search_stats['avg_results_per_search']}")
 
+    if search_stats['top_queries']:
+        print(f"\n🏆 Consultas más frecuentes:")
+        for entry in search_stats['top_queries'][:5]:
+            print(f"   - {entry['query']} ({entry['count']})")
+
     if search_stats['recent_queries']:
         print(f"\n🕒 Consultas recientes:")
         for query in search_stats['recent_queries'][:5]:
             print(f"   - {query}")
 
+# =============================================================================
+# BENCHMARKS
+# =============================================================================
+
+BENCHMARK_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+_HASHING_EMBEDDING = None
+
+def _define_hashing_embedding():
+    """Definir el embedding determinista de benchmarks (requiere LlamaIndex ya importado)"""
+    from llama_index.core.base.embeddings.base import BaseEmbedding
+
+    class HashingEmbedding(BaseEmbedding):
+        """Embedding falso y determinista para medir sin descargar modelos
+
+        Cada token recibe un vector gaussiano cuya semilla es el hash del propio
+        token; un texto es la suma normalizada de sus tokens. Textos con
+        vocabulario común quedan próximos, así que el recall sigue siendo
+        significativo, y el resultado es idéntico entre ejecuciones y máquinas.
+        """
+
+        dim: int = 384
+        _token_rows: Dict[str, int] = PrivateAttr(default_factory=dict)
+        _table: Any = PrivateAttr(default=None)
+        _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+        def __init__(self, dim: int = 384, embed_batch_size: int = EMBED_BATCH_SIZE):
+            super().__init__(model_name=f"hashing-{dim}", embed_batch_size=embed_batch_size, dim=dim)
+            self._table = np.zeros((0, dim), dtype=np.float32)
+
+        def _token_ids(self, text: str, token_rows: Dict[str, int]) -> List[int]:
+            ids = []
+            for token in re.findall(r"\w+", text.lower()):
+                row = token_rows.get(token)
+                if row is None:
+                    row = self._add_token(token)
+                ids.append(row)
+            return ids
+
+        def _add_token(self, token: str) -> int:
+            with self._lock:
+                row = self._token_rows.get(token)
+                if row is None:
+                    seed = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+                    row = len(self._token_rows)
+                    if row == len(self._table):
+                        grown = np.zeros((max(1024, 2 * row), self.dim), dtype=np.float32)
+                        grown[:row] = self._table
+                        self._table = grown
+                    self._table[row] = np.random.default_rng(seed).standard_normal(self.dim)
+                    self._token_rows[token] = row
+                return row
+
+        def _embed(self, texts: List[str]) -> List[List[float]]:
+            # Atributos privados de pydantic leídos una vez: su acceso es costoso
+            token_rows = self._token_rows
+            token_ids = [self._token_ids(text, token_rows) for text in texts]
+            vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+            non_empty = [i for i, ids in enumerate(token_ids) if ids]
+            if non_empty:
+                flat_ids = np.concatenate([token_ids[i] for i in non_empty])
+                starts = np.cumsum([0] + [len(token_ids[i]) for i in non_empty[:-1]])
+                vectors[non_empty] = np.add.reduceat(self._table[flat_ids], starts, axis=0)
+            return _normalize_rows(vectors).tolist()
+
+        def _get_query_embedding(self, query: str) -> List[float]:
+            return self._embed([query])[0]
+
+        async def _aget_query_embedding(self, query: str) -> List[float]:
+            return self._get_query_embedding(query)
+
+        def _get_text_embedding(self, text: str) -> List[float]:
+            return self._embed([text])[0]
+
+        def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+            return self._embed(texts)
+
+        def get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+            return self._embed(list(queries))
+
+    return HashingEmbedding
+
+def use_hashing_embedding(dim: int = 384):
+    """Sustituir el modelo de embeddings por HashingEmbedding (sin red ni pesos)"""
+    global _HASHING_EMBEDDING
+    _load_llama_index()
+    if _HASHING_EMBEDDING is None:
+        _HASHING_EMBEDDING = _define_hashing_embedding()
+    Settings.embed_model = _HASHING_EMBEDDING(dim=dim)
+    return Settings.embed_model
+
+def generate_synthetic_corpus(num_docs: int, words_per_doc: int = 80, vocab_size: int = 5000,
+                              num_topics: int = 50, seed: int = 42,
+                              path_prefix: str = "doc_") -> Iterable[Dict]:
+    """Generar documentos sintéticos reproducibles agrupados por temas
+
+    Cada tema ordena el vocabulario de forma distinta y las palabras se
+    muestrean con una distribución de Zipf, de modo que los documentos de un
+    mismo tema comparten términos frecuentes. Con el tamaño por defecto cada
+    documento produce un único fragmento. path_prefix distingue las rutas de
+    corpus generados por separado (una ruta repetida es una actualización).
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f"w{i}" for i in range(vocab_size)])
+    topics = [rng.permutation(vocab_size) for _ in range(num_topics)]
+    file_types = ("txt", "md", "pdf", "html")
+
+    for i in range(num_docs):
+        topic = int(rng.integers(num_topics))
+        ranks = (rng.zipf(1.3, words_per_doc) - 1) % vocab_size
+        yield {
+            "title": f"Documento {i} tema {topic}",
+            "content": " ".join(vocabulary[topics[topic][ranks]]),
+            "file_path": f"/benchmark/tema_{topic}/{path_prefix}{i}.txt",
+            "file_type": file_types[i % len(file_types)]
+        }
+
+def _synthetic_queries(num_queries: int, words_per_query: int = 6, vocab_size: int = 5000,
+                       num_topics: int = 50, seed: int = 42) -> List[str]:
+    """Consultas cortas con la misma distribución de temas que el corpus"""
+    corpus = generate_synthetic_corpus(num_queries, words_per_query, vocab_size, num_topics, seed)
+    # Mismos temas que el corpus (misma semilla), consultas distintas a cualquier documento
+    rng = np.random.default_rng(seed + 1)
+    return [" ".join(rng.permutation(doc["content"].split())) for doc in corpus]
+
+def _rss_mb() -> Dict[str, Optional[float]]:
+    """RSS actual (Linux, /proc) y pico del proceso en MB"""
+    current = peak = None
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+    except ImportError:
+        pass
+    return {'rss_mb': round(current, 1) if current is not None else None,
+            'peak_rss_mb': round(peak, 1) if peak is not None else None}
+
+def _latency_summary(seconds: List[float]) -> Dict[str, float]:
+    milliseconds = np.asarray(seconds) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(milliseconds, 50)), 3),
+        'p95_ms': round(float(np.percentile(milliseconds, 95)), 3),
+        'p99_ms': round(float(np.percentile(milliseconds, 99)), 3),
+        'mean_ms': round(float(milliseconds.mean()), 3)
+    }
+
+def _git_commit() -> Optional[str]:
+    try:
+        import subprocess
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except Exception:
+        return None
+
+def benchmark_corpus(num_docs: int, vector_engine: str = "flat", engine_params: Dict = None,
+                     num_queries: int = 200, top_k: int = 10, single_adds: int = 100,
+                     workdir: str = None, seed: int = 42) -> Dict:
+    """Medir ingesta, construcción del índice y búsqueda sobre un corpus sintético
+
+    Requiere haber llamado antes a use_hashing_embedding() (o tener un modelo
+    real configurado). Usa una base de datos temporal que se borra al final.
+    """
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        system = SemanticSearchSystem(os.path.join(tmp, "benchmark.db"), persist_index=False,
+                                      vector_engine=vector_engine, engine_params=engine_params)
+        result = {'documents': num_docs, 'engine': vector_engine, 'engine_params': engine_params or {}}
+        try:
+            # Ingesta en bloque (SQL + fragmentación + embeddings + índice)
+            start = time.perf_counter()
+            system.add_documents(generate_synthetic_corpus(num_docs, seed=seed))
+            elapsed = time.perf_counter() - start
+            chunks = len(system.index.docstore.docs)
+            result['chunks'] = chunks
+            result['bulk_ingest'] = {'seconds': round(elapsed, 3),
+                                     'docs_per_s': round(num_docs / elapsed, 1),
+                                     'chunks_per_s': round(chunks / elapsed, 1)}
+
+            # Reconstrucción completa del índice
+            start = time.perf_counter()
+            system.build_index()
+            result['build_index'] = {'seconds': round(time.perf_counter() - start, 3)}
+
+            # add_document individual sobre un índice ya construido (rutas
+            # propias: documentos nuevos, no actualizaciones del corpus base)
+            latencies = []
+            for document in generate_synthetic_corpus(single_adds, seed=seed + 2,
+                                                      path_prefix="bench-single-"):
+                start = time.perf_counter()
+                system.add_document(**document)
+                latencies.append(time.perf_counter() - start)
+            if latencies:
+                result['add_document'] = {'docs_per_s': round(len(latencies) / sum(latencies), 1),
+                                          **_latency_summary(latencies)}
+
+            # Latencia de búsqueda (consultas distintas, sin caché de embeddings)
+            queries = _synthetic_queries(num_queries, seed=seed + 3)
+            system.search(queries[0], top_k=top_k)
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                system.search(query, top_k=top_k)
+                latencies.append(time.perf_counter() - start)
+            result['search'] = {'queries': len(queries), 'top_k': top_k, **_latency_summary(latencies)}
+
+            # Recall frente a la búsqueda exacta
+            if isinstance(system.vector_store, NumpyVectorStore):
+                report = system.recall_report(queries=queries, k=top_k)
+                result['recall'] = report[f'recall@{top_k}']
+            else:
+                result['recall'] = 1.0
+
+            result['memory'] = {**_rss_mb(), 'index': system.memory_footprint()}
+
+            # Arranque en caliente: otro sistema carga la instantánea guardada
+            system.save_index()
+            start = time.perf_counter()
+            reloaded = SemanticSearchSystem(system.db_path, vector_engine=vector_engine,
+                                            engine_params=engine_params)
+            try:
+                reloaded.load_index()
+                result['warm_start'] = {'seconds': round(time.perf_counter() - start, 3),
+                                        'nodes': len(reloaded.index.index_struct.nodes_dict)}
+            finally:
+                reloaded.close()
+        finally:
+            system.close()
+
+    logger.info(f"Benchmark {num_docs} documentos: {result}")
+    return result
+
+def run_benchmark(sizes: Iterable[int] = BENCHMARK_SIZES, vector_engine: str = "flat",
+                  engine_params: Dict = None, num_queries: int = 200, top_k: int = 10,
+                  embedding_dim: int = 384, output_path: str = None, seed: int = 42) -> Dict:
+    """Ejecutar la suite de benchmarks offline y devolver (y opcionalmente guardar) el JSON
+
+    El pico de RSS es el del proceso completo; para comparar tamaños entre sí
+    conviene ejecutar cada tamaño en un proceso nuevo.
+    """
+    import platform
+
+    use_hashing_embedding(embedding_dim)
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'config': {'sizes': list(sizes), 'vector_engine': vector_engine, 'engine_params': engine_params or {},
+                   'num_queries': num_queries, 'top_k': top_k, 'embedding_dim': embedding_dim, 'seed': seed},
+        'results': []
+    }
+    for size in sizes:
+        report['results'].append(benchmark_corpus(size, vector_engine, engine_params, num_queries, top_k, seed=seed))
+
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        logger.info(f"Resultados del benchmark guardados en {output_path}")
+    return report
+
+def benchmark_cli(argv: List[str] = None) -> Dict:
+    """Línea de comandos: ``python sistema_de_búsqueda_semántica_con_llamaindex_y_sql.py benchmark --sizes 1000 10000``"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark offline del sistema de búsqueda semántica")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(BENCHMARK_SIZES))
+    parser.add_argument("--engine", default="flat", choices=["simple", *VECTOR_ENGINES])
+    parser.add_argument("--engine-params", type=json.loads, default=None, help="JSON con parámetros del motor")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.sizes, args.engine, args.engine_params, args.queries, args.top_k,
+                           args.dim, args.output, args.seed)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    return report
+
 # =============================================================================
 # PRUEBAS UNITARIAS
 # =============================================================================
@@ -465,6 +5375,121 @@ def test_system_functionality():
         stats = test_system.get_document_stats()
         assert stats['total_documents'] > 0
         print(f"   Total de documentos: {stats['total_documents']}")
+        analytics = test_system.get_search_analytics()
+        assert analytics['total_searches'] >= 1 and analytics['top_queries']
+        assert analytics['latency_percentiles']['p99'] >= analytics['latency_percentiles']['p50']
+
+        # Prueba 5: Actualización incremental del índice
+        print("✅ Prueba 5: Actualizando y eliminando documentos sin reconstruir...")
+        extra_id = test_system.add_document(
+            title="Documento Incremental",
+            content="Las bases de datos vectoriales permiten búsquedas por similitud.",
+            file_type="test"
+        )
+        test_system.update_document(extra_id, content="Contenido actualizado sobre índices vectoriales.")
+        assert test_system.delete_document(extra_id)
+        assert extra_id not in test_system.index.ref_doc_info
+        assert test_system.get_document_stats()['total_documents'] == 1
+        print("   Índice actualizado de forma incremental")
+
+        # Prueba 6: Arranque en caliente desde el índice guardado
+        print("✅ Prueba 6: Recargando el índice guardado...")
+        test_system.close()
+        reloaded_system = SemanticSearchSystem("test_semantic_search.db")
+        assert reloaded_system.index is not None
+        assert set(reloaded_system.documents) == set(test_system.documents)
+        assert len(reloaded_system.search("documento prueba", top_k=1)) > 0
+        print("   Índice recargado sin reindexar")
+
+        # Prueba 7: Búsqueda léxica e híbrida
+        print("✅ Prueba 7: Búsqueda léxica (FTS5) e híbrida...")
+        lexical = reloaded_system.search("funcionamiento", top_k=1, mode="lexical")
+        assert lexical and lexical[0]['doc_id'] == doc_id
+        assert len(reloaded_system.search("documento prueba", top_k=1, mode="hybrid")) > 0
+        assert reloaded_system.search("funcionamiento", file_type="pdf") == []
+        filtered = reloaded_system.search("funcionamiento", top_k=1, file_type="test", mode="hybrid")
+        assert filtered and filtered[0]['doc_id'] == doc_id
+        stages = reloaded_system.get_metrics()['stages']['search']
+        assert {'embed', 'retrieve', 'lexical', 'metadata', 'total'} <= set(stages)
+        assert 'semantic_search_stage_duration_seconds_count{operation="search",stage="total"}' \
+            in reloaded_system.prometheus_metrics()
+        print("   Búsqueda léxica e híbrida correctas")
+
+        # Prueba 8: Ingesta de un directorio con el pool de procesos
+        print("✅ Prueba 8: Ingestando un directorio en streaming...")
+        with tempfile.TemporaryDirectory() as corpus_dir:
+            Path(corpus_dir, "notas.md").write_text("Los grafos de conocimiento enlazan entidades.", encoding="utf-8")
+            Path(corpus_dir, "informe.txt").write_text("Los índices invertidos aceleran la búsqueda.", encoding="utf-8")
+            Path(corpus_dir, "datos.csv").write_text("a,b\n1,2", encoding="utf-8")
+            summary = reloaded_system.ingest_directory(corpus_dir, workers=2)
+        assert summary['documents'] == 2 and not summary['errors']
+        assert reloaded_system.search("grafos de conocimiento", top_k=1)[0]['file_type'] == "md"
+        print(f"   {summary['documents']} ficheros ingeridos ({summary['chunks']} fragmentos)")
+
+        # Prueba 9: Deduplicación por hash y caché de embeddings de fragmentos
+        print("✅ Prueba 9: Reingiriendo contenido sin duplicar ni re-embeber...")
+        texto = "La deduplicación por hash evita recalcular embeddings de fragmentos repetidos."
+        dedup_id = reloaded_system.add_document("Deduplicación", texto, file_type="test")
+        assert reloaded_system.add_document("Deduplicación", texto, file_type="test") == dedup_id
+        with tempfile.TemporaryDirectory() as corpus_dir:
+            Path(corpus_dir, "a.txt").write_text("Primer fichero del corpus.", encoding="utf-8")
+            Path(corpus_dir, "b.txt").write_text("Segundo fichero del corpus.", encoding="utf-8")
+            reloaded_system.ingest_directory(corpus_dir, workers=1)
+            Path(corpus_dir, "b.txt").write_text("Segundo fichero, ya editado.", encoding="utf-8")
+            summary = reloaded_system.ingest_directory(corpus_dir, workers=1)
+            assert (summary['documents'], summary['updated'], summary['unchanged']) == (0, 1, 1)
+            # Al revertir la edición el fragmento original sale de la caché
+            hits = reloaded_system.get_metrics()['chunk_cache']['hits']
+            Path(corpus_dir, "b.txt").write_text("Segundo fichero del corpus.", encoding="utf-8")
+            reloaded_system.ingest_directory(corpus_dir, workers=1)
+        assert reloaded_system.get_metrics()['chunk_cache']['hits'] == hits + 1
+        reloaded_system.close()
+        print("   Documentos repetidos reutilizados sin volver a embeber")
+
+        # Prueba 10: Almacenamiento cuantizado con re-ranking
+        print("✅ Prueba 10: Motor cuantizado int8 con re-ranking exacto...")
+        vectors = _normalize_rows(np.random.default_rng(0).normal(size=(2000, 64)).astype(np.float32))
+        flat_engine, quantized_engine = FlatVectorEngine(), QuantizedVectorEngine(dtype="int8")
+        flat_engine.add(vectors)
+        quantized_engine.add(vectors)
+        for query_vector in vectors[:20]:
+            assert quantized_engine.search(query_vector, 5)[0].tolist() == flat_engine.search(query_vector, 5)[0].tolist()
+        assert quantized_engine.bytes_per_vector() * 3 < flat_engine.bytes_per_vector()
+        quantized_engine.close()
+        print("   Resultados idénticos a la búsqueda exacta con ~4x menos memoria")
+
+        # Prueba 11: Búsqueda repartida en shards de procesos
+        print("✅ Prueba 11: Scatter-gather entre procesos con memoria compartida...")
+        sharded_engine = ShardedVectorEngine(num_shards=2, min_shard_size=500)
+        sharded_engine.add(vectors)
+        sharded_engine.remove(np.arange(0, 2000, 5))
+        flat_engine.remove(np.arange(0, 2000, 5))
+        batch_hits = sharded_engine.search_batch(vectors[:20], 5)
+        for query_vector, (keys, _) in zip(vectors[:20], batch_hits):
+            assert keys.tolist() == flat_engine.search(query_vector, 5)[0].tolist()
+        assert sharded_engine.shard_stats()['active_shards'] == 2
+        sharded_engine.close()
+        print("   Top-k fusionado idéntico a la búsqueda exacta en un proceso")
+
+        # Prueba 12: Migración de modelo de embeddings en segundo plano
+        print("✅ Prueba 12: Migrando a otro modelo de embeddings sin cortar búsquedas...")
+        _EMBED_MODELS["hashing-32"] = _define_hashing_embedding()(dim=32)
+        with tempfile.TemporaryDirectory() as db_dir:
+            migration_system = SemanticSearchSystem(os.path.join(db_dir, "migracion.db"), persist_index=False)
+            migration_system.add_documents([
+                {"title": f"Nota {i}", "content": f"Apuntes del tema {i % 3} sobre búsqueda semántica"}
+                for i in range(40)
+            ])
+            migration_system.start_embedding_migration("hashing-32", batch_size=8, max_cpu_fraction=1.0)
+            while migration_system.migration_status()['migration']['status'] == "running":
+                assert migration_system.search("búsqueda semántica", top_k=1)
+                time.sleep(0.01)
+            assert migration_system.migration_status()['migration']['status'] == "ready"
+            migration_system.cutover_embedding_migration()
+            assert migration_system.embedding_model == "hashing-32"
+            assert migration_system.search("tema 1", top_k=1)
+            migration_system.close()
+        print("   Índice sombra construido y cambio de modelo aplicado")
 
         print("\n🎉 Todas las pruebas pasaron exitosamente!")
 
@@ -473,10 +5498,397 @@ def test_system_functionality():
         raise
 
     finally:
-        # Limpiar base de datos de prueba
-        import os
-        if os.path.exists("test_semantic_search.db"):
-            os.remove("test_semantic_search.db")
+        # Limpiar base de datos de prueba y snapshot del índice
+        for path in ("test_semantic_search.db",
+                     "test_semantic_search.db-wal",
+                     "test_semantic_search.db-shm",
+                     "test_semantic_search.db.vectors.npy",
+                     "test_semantic_search.db.nodes.json",
+                     "test_semantic_search.db.docstore.json"):
+            if os.path.exists(path):
+                os.remove(path)
+
+@contextmanager
+def _temporary_system(db_path: str = None, **kwargs):
+    """SemanticSearchSystem de prueba que se cierra al salir
+
+    Sin ``db_path`` usa una base nueva en un directorio temporal que se
+    borra al salir. El índice no se persiste salvo con ``persist_index=True``.
+    """
+    kwargs.setdefault("persist_index", False)
+    if db_path is None:
+        with tempfile.TemporaryDirectory() as db_dir:
+            with _temporary_system(os.path.join(db_dir, "prueba.db"), **kwargs) as system:
+                yield system
+        return
+
+    system = SemanticSearchSystem(db_path, **kwargs)
+    try:
+        yield system
+    finally:
+        system.close()
+
+def test_quantized_engine_shared_database():
+    """Dos sistemas cuantizados sobre la misma base de datos no comparten el fichero de re-ranking"""
+    with tempfile.TemporaryDirectory() as db_dir:
+        db_path = os.path.join(db_dir, "compartida.db")
+        with _temporary_system(db_path, vector_engine="quantized") as first, \
+                _temporary_system(db_path, vector_engine="quantized") as second:
+            # Las filas de second (0-60) y las últimas de first (50-99) ocupan los mismos desplazamientos
+            first.add_documents([{"title": f"T{i}", "content": f"Texto de relleno número {i}"} for i in range(50)])
+            second.add_documents([{"title": f"S{i}", "content": f"Más texto de relleno {i}"} for i in range(60)])
+            doc_id = second.add_document("Astronomía", "Telescopios, galaxias y nebulosas lejanas")
+            first.add_documents([{"title": f"U{i}", "content": f"Otro relleno distinto {i}"} for i in range(50)])
+
+            assert second.search("telescopios galaxias nebulosas", top_k=1)[0]['doc_id'] == doc_id
+            for system in (first, second):
+                # Los float32 del fichero deben coincidir con los int8 residentes del mismo motor
+                engine = system.vector_store.engine
+                keys = engine.active_keys()
+                approximate = engine._vectors[keys].astype(np.float32) * engine._scales[keys, None]
+                assert np.abs(engine.get_vectors(keys) - approximate).max() < 0.01
+            paths = {first.vector_store.engine.rerank_path, second.vector_store.engine.rerank_path}
+            assert len(paths) == 2 and all(os.path.dirname(path) == db_dir for path in paths)
+        assert not any(os.path.exists(path) for path in paths)
+
+def test_ivf_engine_validation_and_retrain():
+    """IVF rechaza nprobe < 1 y se reentrena cuando los vectores se duplican"""
+    try:
+        IVFVectorEngine(nprobe=0)
+        raise AssertionError("nprobe=0 debía rechazarse")
+    except ValueError:
+        pass
+
+    vectors = _normalize_rows(np.random.default_rng(2).normal(size=(500, 16)).astype(np.float32))
+    engine = IVFVectorEngine(nlist=4, nprobe=4, min_train_size=100)
+    engine.add(vectors[:100])
+    assert engine.is_trained and engine._trained_count == 100
+    engine.add(vectors[100:150])
+    assert engine._trained_count == 100
+    engine.add(vectors[150:])
+    assert engine._trained_count == 500
+    assert sum(len(keys) for keys in engine._lists) == 500
+    # Con todas las particiones exploradas el resultado es exacto
+    assert engine.search(vectors[321], 1)[0].tolist() == [321]
+
+def test_sharded_engine_survives_dead_worker():
+    """Si muere el proceso de un shard, su rango se busca en local con el mismo resultado"""
+    vectors = _normalize_rows(np.random.default_rng(1).normal(size=(1000, 32)).astype(np.float32))
+    flat_engine, sharded_engine = FlatVectorEngine(), ShardedVectorEngine(num_shards=2, min_shard_size=100)
+    flat_engine.add(vectors)
+    sharded_engine.add(vectors)
+    try:
+        expected = [flat_engine.search(query_vector, 5)[0].tolist() for query_vector in vectors[:10]]
+        assert [keys.tolist() for keys, _ in sharded_engine.search_batch(vectors[:10], 5)] == expected
+        if sharded_engine._workers:  # sin procesos worker (notebook) ya se busca en local
+            process, _ = sharded_engine._workers[1]
+            process.kill()
+            process.join()
+            # La primera búsqueda detecta la caída; la segunda ya no envía nada al shard
+            for _ in range(2):
+                assert [keys.tolist() for keys, _ in sharded_engine.search_batch(vectors[:10], 5)] == expected
+            assert sharded_engine.shard_stats()['dead_shards'] == 1
+    finally:
+        sharded_engine.close()
+
+def test_update_document_keeps_document_visible():
+    """Mientras se actualiza un documento, las búsquedas concurrentes siguen encontrándolo"""
+    for vector_engine in ("simple", "flat"):
+        with _temporary_system(vector_engine=vector_engine, result_cache_size=0) as system:
+            system.add_documents([{"title": f"Relleno {i}", "content": f"Recetas de cocina número {i}"}
+                                  for i in range(20)])
+            doc_id = system.add_document("Astronomía", "Telescopios y galaxias lejanas")
+            misses, stop = [], threading.Event()
+
+            def read():
+                while not stop.is_set():
+                    results = system.search("telescopios galaxias", top_k=1)
+                    if not results or results[0].doc_id != doc_id:
+                        misses.append(results)
+
+            reader = threading.Thread(target=read)
+            reader.start()
+            try:
+                for i in range(30):
+                    system.update_document(doc_id, content=("Telescopios y galaxias lejanas",
+                                                            "Galaxias y telescopios lejanos")[i % 2])
+            finally:
+                stop.set()
+                reader.join()
+            assert not misses, (vector_engine, len(misses))
+            assert len(system.index.docstore.get_ref_doc_info(doc_id).node_ids) == 1
+            assert len(system.index.index_struct.nodes_dict) == 21
+
+def test_warm_start_reuses_snapshot():
+    """El arranque en caliente no embebe ni reconstruye nodos de documentos sin cambios"""
+    with tempfile.TemporaryDirectory() as db_dir:
+        db_path = os.path.join(db_dir, "caliente.db")
+        with _temporary_system(db_path, persist_index=True, vector_engine="flat") as system:
+            system.add_documents(generate_synthetic_corpus(2000))
+            expected = [result['doc_id'] for result in system.search("w1 w2 w3", top_k=5)]
+            node_ids = set(system.index.index_struct.nodes_dict)
+
+        with _temporary_system(db_path, persist_index=True, vector_engine="flat") as reloaded:
+            embedded = []
+            reloaded._embed_nodes = lambda nodes, *args, **kwargs: embedded.extend(nodes)
+
+            reloaded.load_index()
+            assert embedded == []
+            assert len(node_ids) == 2000 and set(reloaded.index.index_struct.nodes_dict) == node_ids
+            assert [result['doc_id'] for result in reloaded.search("w1 w2 w3", top_k=5)] == expected
+
+def test_result_cache_reuses_similar_queries():
+    """Una paráfrasis cercana reutiliza los resultados hasta la siguiente escritura"""
+    with _temporary_system(result_cache_threshold=0.9) as system:
+        system.add_documents([
+            {"title": f"Tema {i}", "content": f"Inteligencia artificial aplicada al caso {i}"} for i in range(10)
+        ])
+        first = system.search("inteligencia artificial caso 3", top_k=2)
+        assert system.search("Inteligencia artificial, caso 3", top_k=2) == first
+        assert system.result_cache.stats()['hits'] == 1
+        system.add_document("Nuevo", "Inteligencia artificial caso 3 ampliado")
+        system.search("inteligencia artificial caso 3", top_k=2)
+        stats = system.result_cache.stats()
+        assert stats['hits'] == 1 and stats['invalidations'] > 0 and stats['memory_bytes'] > 0
+
+def test_lazy_results_and_cursor_expiry():
+    """Los resultados cargan sus campos al acceder y los cursores caducan tras una escritura"""
+    with _temporary_system(result_cache_size=0) as system:
+        system.add_documents([
+            {"title": f"Capítulo {i}", "content": f"Redes neuronales y aprendizaje profundo, parte {i}"}
+            for i in range(12)
+        ])
+        first_page = system.search("redes neuronales", top_k=3, paginate=True)
+        assert isinstance(first_page[0], SearchResult) and first_page[0]._fields is None
+        assert first_page[0]['content'].startswith("Redes neuronales") and first_page.next_page_token
+        second_page = system.search("redes neuronales", page_token=first_page.next_page_token)
+        expected = system.search("redes neuronales", top_k=6)
+        assert [r.similarity_score for r in first_page + second_page] == [r.similarity_score for r in expected]
+        system.add_document("Nuevo", "Redes neuronales convolucionales")
+        try:
+            system.search("redes neuronales", page_token=second_page.next_page_token)
+            raise AssertionError("El cursor debía caducar tras una escritura")
+        except ValueError:
+            pass
+
+def test_pagination_reaches_every_result():
+    """Los cursores llegan al último resultado y la primera página solo puntúa top_k sin paginate"""
+    with _temporary_system(vector_engine="flat", result_cache_size=0, page_depth=2) as system:
+        system.add_documents(generate_synthetic_corpus(40))
+        requested = []
+        retrieve = system._retrieve
+        system._retrieve = lambda query, top_k, *args: requested.append(top_k) or retrieve(query, top_k, *args)
+
+        page = system.search("w1 w2 w3", top_k=3)
+        assert len(page) == 3 and page.next_page_token is None and requested == [3]
+
+        for mode in ("vector", "hybrid"):
+            page = system.search("w1 w2 w3", top_k=3, mode=mode, paginate=True)
+            walked = list(page)
+            while page.next_page_token is not None:
+                page = system.search("w1 w2 w3", page_token=page.next_page_token)
+                assert page, "Un token no debe llevar a una página vacía"
+                walked.extend(page)
+            assert len({result.doc_id for result in walked}) == len(walked) == 40, mode
+            if mode == "vector":
+                expected = system.search("w1 w2 w3", top_k=40)
+                assert [r.node_id for r in walked] == [r.node_id for r in expected]
+
+def test_result_cache_accounts_loaded_fields():
+    """memory_bytes() de la caché de resultados crece cuando los resultados cargan sus campos"""
+    with _temporary_system(result_cache_size=4) as system:
+        system.add_documents([
+            {"title": f"Informe {i}", "content": f"Resultados trimestrales del informe {i} " * 40}
+            for i in range(5)
+        ])
+        results = system.search("resultados trimestrales", top_k=3)
+        before = system.result_cache.memory_bytes()
+        content_bytes = sum(len(result['content']) for result in results)
+        after = system.result_cache.memory_bytes()
+        assert after - before >= content_bytes, (before, after, content_bytes)
+
+        # Expulsar la entrada libera también los bytes de sus campos cargados
+        for i in range(4):
+            system.search(f"consulta distinta número {i} sobre galaxias", top_k=3)
+        assert system.result_cache.stats()['evictions'] == 1
+        assert system.result_cache.memory_bytes() < after
+
+        # Las claves (top_k distintos) sin entradas se retiran del índice de claves
+        for top_k in range(1, 41):
+            system.search(f"consulta con top_k {top_k}", top_k=top_k)
+        stats = system.result_cache.stats()
+        assert stats['entries'] == 4 and stats['keys'] <= 4, stats
+
+def test_memory_database_threads():
+    """Con ":memory:" escritor y lectores concurrentes no comparten conexión
+
+    La caché persistente de consultas lee con el pool de solo lectura.
+    """
+    errors = []
+    with _temporary_system(":memory:", persist_query_cache=True, result_cache_size=0) as system:
+        system.add_documents([{"title": f"T{i}", "content": f"Redes de sensores, caso {i}"} for i in range(20)])
+
+        def write():
+            try:
+                for i in range(20):
+                    system.add_document(f"N{i}", f"Telescopios y galaxias, caso {i}")
+            except Exception as e:
+                errors.append(e)
+
+        def read(worker: int):
+            try:
+                for i in range(30):
+                    results = system.search(f"redes de sensores {i % 5} {worker}", top_k=3)
+                    assert len(results) == 3 and results[0]['content']
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read, args=(n,)) for n in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+
+        system.query_cache.clear()
+        system.query_cache.session_factory = None  # get() no debe usar el escritor
+        # La caché se indexa por el modelo que calcula los embeddings (p. ej. "hashing-384")
+        assert system.query_cache.get("redes de sensores 1 0", system.embed_model.model_name) is not None
+        assert system.query_cache.stats()['persistent_hits'] == 1
+
+def test_query_cache_prunes_persistent_table():
+    """La tabla persistente de la caché de consultas no crece sin límite"""
+    with _temporary_system() as system:
+        cache = QueryEmbeddingCache(max_size=4, ttl=60, session_factory=system.SessionLocal,
+                                    read_session_factory=system.ReadSessionLocal,
+                                    max_persistent_size=5, prune_interval=1)
+        for i in range(12):
+            cache.put(f"consulta {i}", "modelo", [float(i)] * 4)
+        cache.clear()
+        assert cache.get("consulta 11", "modelo") is not None
+        assert cache.get("consulta 0", "modelo") is None
+
+        with system.get_db_session() as session:
+            session.merge(QueryEmbeddingCacheEntry(cache_key="caducada", model_name="modelo",
+                                                   query_text="caducada", embedding=b"\0" * 16,
+                                                   created_at=time.time() - 120))
+            session.commit()
+        cache.put("consulta nueva", "modelo", [1.0] * 4)
+        with system.get_read_session() as session:
+            keys = [row.cache_key for row in session.query(QueryEmbeddingCacheEntry.cache_key)]
+        assert len(keys) == 5 and "caducada" not in keys
+        assert cache.stats()['persistent_pruned'] == 2
+
+def test_memory_databases_are_isolated():
+    """Dos sistemas ":memory:" no comparten documentos ni dejan snapshots en disco"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            with _temporary_system(":memory:", persist_index=True, result_cache_size=0) as first:
+                first.add_documents([{"title": "Redes", "content": "Redes neuronales y aprendizaje profundo"}])
+                assert first.search("redes neuronales", top_k=1)
+            assert os.listdir(work_dir) == []
+
+            with _temporary_system(":memory:", persist_index=True, result_cache_size=0) as second:
+                assert not second._warm_start_pending
+                assert second.get_document_stats()['total_documents'] == 0
+                assert second.index is None and not second.documents
+        finally:
+            os.chdir(cwd)
+
+def test_search_many_uses_query_embeddings():
+    """search_many() embebe como consultas, en un lote, igual que search(), y comparten caché"""
+    _load_llama_index()
+    calls = []
+
+    class PrefixedEmbedding(_define_hashing_embedding()):
+        """Modelo con prefijo de consulta (como E5 o BGE)"""
+
+        def _get_query_embedding(self, query: str) -> List[float]:
+            return self._embed([f"consulta: {query}"])[0]
+
+        def get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+            calls.append(list(queries))
+            return self._embed([f"consulta: {query}" for query in queries])
+
+    model = PrefixedEmbedding(dim=256)
+    model.model_name = "prefijo-256"
+    _EMBED_MODELS[model.model_name] = model
+    try:
+        with _temporary_system(embedding_model=model.model_name, result_cache_size=0) as system:
+            system.add_documents([
+                {"title": "Redes", "content": "Redes neuronales y aprendizaje profundo"},
+                {"title": "SQL", "content": "Bases de datos relacionales e índices"},
+                {"title": "Grafos", "content": "Grafos de conocimiento y entidades"}
+            ])
+            batch = system.search_many(["redes neuronales", "bases de datos", "grafos"], top_k=2)
+            assert calls == [["redes neuronales", "bases de datos", "grafos"]]
+            cached = system.query_cache.get("bases de datos", system.embed_model.model_name)
+            assert np.allclose(cached, model.get_query_embedding("bases de datos"))
+            single = system.search("bases de datos", top_k=2)
+            assert [r.doc_id for r in batch[1]] == [r.doc_id for r in single]
+            assert np.allclose([r.similarity_score for r in batch[1]], [r.similarity_score for r in single])
+            assert batch[1][0]['title'] == "SQL"
+    finally:
+        _EMBED_MODELS.pop(model.model_name, None)
+
+def test_async_batch_single_model_call():
+    """Las búsquedas asíncronas agrupadas en un lote llaman una vez al modelo"""
+    _load_llama_index()
+    calls = []
+
+    class CountingEmbedding(_define_hashing_embedding()):
+        def get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+            calls.append(list(queries))
+            return self._embed(list(queries))
+
+    model = CountingEmbedding(dim=128)
+    model.model_name = "contador-128"
+    _EMBED_MODELS[model.model_name] = model
+    try:
+        with _temporary_system(embedding_model=model.model_name, result_cache_size=0) as system:
+            service = AsyncSearchService(system, max_batch_size=8, batch_window_ms=200)
+            try:
+                system.add_documents([
+                    {"title": "Redes", "content": "Redes neuronales y aprendizaje profundo"},
+                    {"title": "SQL", "content": "Bases de datos relacionales e índices"}
+                ])
+                queries = ["redes", "bases de datos", "índices", "aprendizaje"]
+                results = asyncio.run(service.search_many(queries, top_k=1))
+                assert len(results) == len(queries)
+                assert service.stats()['batches'] == 1
+                assert calls == [queries]
+            finally:
+                service.close()
+    finally:
+        _EMBED_MODELS.pop(model.model_name, None)
+
+# Pruebas enfocadas que run_tests() ejecuta tras test_system_functionality()
+FOCUSED_TESTS = [
+    test_quantized_engine_shared_database,
+    test_ivf_engine_validation_and_retrain,
+    test_sharded_engine_survives_dead_worker,
+    test_update_document_keeps_document_visible,
+    test_warm_start_reuses_snapshot,
+    test_result_cache_reuses_similar_queries,
+    test_lazy_results_and_cursor_expiry,
+    test_pagination_reaches_every_result,
+    test_result_cache_accounts_loaded_fields,
+    test_memory_database_threads,
+    test_query_cache_prunes_persistent_table,
+    test_memory_databases_are_isolated,
+    test_search_many_uses_query_embeddings,
+    test_async_batch_single_model_call,
+]
+
+def run_tests():
+    """Ejecutar la prueba general y las pruebas enfocadas"""
+    test_system_functionality()
+    for test in FOCUSED_TESTS:
+        print(f"✅ {test.__name__}")
+        test()
+    print(f"🎉 {len(FOCUSED_TESTS)} pruebas enfocadas superadas")
 
 # =============================================================================
 # INTERFAZ PRINCIPAL
@@ -487,16 +5899,18 @@ def main():
     print("🚀 SISTEMA DE BÚSQUEDA SEMÁNTICA CON LLAMAINDEX Y SQL")
     print("=" * 60)
 
-    # Inicializar sistema
+    # Inicializar sistema (reutiliza el índice guardado si existe)
     system = SemanticSearchSystem()
 
     # Cargar documentos de ejemplo
-    print("\n📚 Cargando documentos de ejemplo...")
-    load_sample_documents(system)
+    if not system.documents:
+        print("\n📚 Cargando documentos de ejemplo...")
+        load_sample_documents(system)
 
     # Construir índice
-    print("\n🔧 Construyendo índice de vectores...")
-    system.build_index()
+    if system.index is None:
+        print("\n🔧 Construyendo índice de vectores...")
+        system.build_index()
 
     # Ejecutar búsquedas de ejemplo
     run_sample_searches(system)
@@ -505,7 +5919,7 @@ def main():
     display_analytics(system)
 
     # Ejecutar pruebas
-    test_system_functionality()
+    run_tests()
 
     print("\n✨ Sistema de búsqueda semántica funcionando correctamente!")
     print("💡 Puedes usar el sistema creando una instancia de SemanticSearchSystem")
@@ -520,17 +5934,20 @@ def create_interactive_interface():
     try:
         import gradio as gr
 
-        # Inicializar sistema global
+        # Inicializar sistema global y servicio asíncrono compartido
         global_system = SemanticSearchSystem()
-        load_sample_documents(global_system)
-        global_system.build_index()
+        if not global_system.documents:
+            load_sample_documents(global_system)
+        if global_system.index is None:
+            global_system.build_index()
+        search_service = AsyncSearchService(global_system)
 
-        def search_interface(query, top_k):
+        async def search_interface(query, top_k):
             """Interfaz de búsqueda para Gradio"""
             if not query.strip():
                 return "Por favor, ingrese una consulta de búsqueda."
 
-            results = global_system.search(query, top_k=int(top_k))
+            results = await search_service.search(query, top_k=int(top_k))
 
             if not results:
                 return "No se encontraron resultados para su consulta."
@@ -573,7 +5990,11 @@ Contenido: {result['content'][:300]}...
 # EJECUCIÓN DEL SISTEMA
 # =============================================================================
 
-if __name__ == "__main__":
+if __name__ == "__main__" and sys.argv[1:2] == ["benchmark"]:
+    # Benchmarks offline con embeddings sintéticos
+    benchmark_cli(sys.argv[2:])
+
+elif __name__ == "__main__":
     # Ejecutar sistema principal
     main()
 
@@ -582,8 +6003,7 @@ if __name__ == "__main__":
     interface = create_interactive_interface()
 
     if interface:
-        print("✅ Interfaz creada. Ejecute interface.launch() para iniciar la aplicación web.")
+        print("✅ Interfaz creada. Iniciando la aplicación web...")
+        interface.launch()
     else:
         print("❌ No se pudo crear la interfaz web.")
-
-interface.launch()
\ No newline at end of file